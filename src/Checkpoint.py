@@ -0,0 +1,41 @@
+import os
+import json
+import time
+from pathlib import Path
+
+# Bumped whenever the layout of the snapshot changes; older snapshots are ignored.
+SNAPSHOT_VERSION = 2
+
+
+def save(path: str, state: dict) -> None:
+    """
+    Write a snapshot of the bot state. The file is replaced atomically,
+    so a crash while saving leaves the previous snapshot intact.
+    """
+    snapshot = {"version": SNAPSHOT_VERSION, "saved_at": time.time(), **state}
+    target = Path(path)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    temporary = target.with_name(target.name + ".tmp")
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    temporary.replace(target)
+
+
+def load(path: str) -> dict | None:
+    """
+    Read a snapshot. Returns None if there is none, or if it is unreadable or from another version.
+    """
+    try:
+        snapshot = json.loads(Path(path).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Checkpoint {path} unreadable: {e}")
+        return None
+
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        print(f"Checkpoint {path} has version {snapshot.get('version')}, expected {SNAPSHOT_VERSION}: ignored")
+        return None
+    return snapshot
@@ -0,0 +1,75 @@
+import time
+import heapq
+import asyncio
+
+
+class Clock:
+    """
+    Real time. Calling the clock returns monotonic seconds, so it can be passed
+    wherever a `clock` callable is expected, and `sleep` waits for real.
+    """
+
+    def __call__(self) -> float:
+        return time.monotonic()
+
+    async def sleep(self, seconds: float) -> None:
+        await asyncio.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    """
+    Time that only moves when advanced, for accelerated simulations.
+
+    Sleeping tasks are woken in deadline order as `advance` moves the clock
+    past their deadlines, and each woken task runs before time moves again,
+    so hours of timers and watchers play out in milliseconds.
+    """
+
+    def __init__(self, start: float = 0.0, settle_steps: int = 20):
+        """
+        Args:
+            start: Initial time in seconds.
+            settle_steps: Event loop iterations given to woken tasks before time moves on.
+        """
+        self.now = start
+        self.settle_steps = settle_steps
+        # (deadline, sequence, future) of the sleeping tasks
+        self._sleepers: list[tuple[float, int, asyncio.Future]] = []
+        self._sequence = 0
+
+    def __call__(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float) -> None:
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self.now + seconds, self._sequence, future))
+        self._sequence += 1
+        await future
+
+    @property
+    def next_deadline(self) -> float | None:
+        """ Time at which the next sleeping task wakes up, if any. """
+        while self._sleepers and self._sleepers[0][2].done():
+            heapq.heappop(self._sleepers)
+        return self._sleepers[0][0] if self._sleepers else None
+
+    async def advance(self, seconds: float) -> None:
+        """
+        Move time forward, waking every task whose deadline is reached on the way.
+        """
+        target = self.now + seconds
+        await self._settle()
+        while (deadline := self.next_deadline) is not None and deadline <= target:
+            _, _, future = heapq.heappop(self._sleepers)
+            self.now = max(self.now, deadline)
+            future.set_result(None)
+            await self._settle()
+        self.now = target
+
+    async def _settle(self):
+        for _ in range(self.settle_steps):
+            await asyncio.sleep(0)
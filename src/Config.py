@@ -3,6 +3,8 @@ from pathlib import Path
 
 DEFAULT_CONFIG_PATH = "config/config.json"
 DEFAULT_CONTEXT_PATH = "config/context.txt"
+# Settings an llm_routes entry may override (the fields of LlmBackend.Route).
+ROUTE_KEYS = ("model", "max_tokens", "temperature", "timeout")
 
 class Config:
     def __init__(self):
@@ -12,8 +14,23 @@ class Config:
         # Define the personality, who is the bot,the initial context and extra rules for the LLM.
         self.initial_context: str = ""
         # This does not affect any of the initial context or rules, just limits the size of the stored context.
-        # When the limit is reached, the context is reset to initial_context.
+        # When the limit is reached, the learned memories are condensed by the LLM in the background into a
+        # digest shorter than context_compact_length. Without context_compaction, or if the context reaches twice
+        # the limit anyway, it is reset to initial_context.
         self.max_context_length: int = 12000
+        self.context_compaction: bool = True
+        self.context_compact_length: int = 4000
+        # Keep learned memories in a local BM25 index instead of the context, and send only the
+        # memory_top_k most relevant to each prompt. The oldest memories past memory_max_lines are forgotten.
+        self.memory_retrieval: bool = False
+        self.memory_top_k: int = 8
+        self.memory_max_lines: int = 2000
+        # Keep a conversation per channel and send only the messages that arrived since its last turn;
+        # the earlier turns are resent unchanged and served from the provider's prompt cache. A session starts
+        # over after history_session_max_turns turns, history_session_ttl idle seconds, or when the history diverges.
+        self.history_sessions: bool = False
+        self.history_session_max_turns: int = 6
+        self.history_session_ttl: float = 300
         # Maximum tokens for the LLM response.
         self.max_tokens_response: int = 500
         # Which channels the bot is allowed to operate in. Empty list means all channels are allowed.
@@ -22,6 +39,119 @@ class Config:
         self.test_channels = []
         # Keywords that trigger the bot to respond.
         self.keywords = []
+        # Stream the LLM completion and post the reply as soon as the "response" field is complete.
+        # A "response": null is detected early and the stream is closed without waiting for "context".
+        self.stream_response: bool = False
+        # Triggers that show Discord's typing indicator while the LLM is deciding.
+        self.typing_triggers: list[str] = ["mention", "reply", "keyword", "command"]
+        # Maximum seconds spent on a single trigger, retries included. Triggers not listed use llm_default_deadline.
+        self.llm_deadlines: dict[str, float] = {"conversation_activity": 10, "join": 15, "command": 30}
+        self.llm_default_deadline: float = 20
+        self.llm_temperature: float = 0.9
+        # Trigger -> request settings overriding the defaults above: "model" (a name, or endpoint name -> name),
+        # "max_tokens", "temperature" and "timeout" (seconds per attempt). Cheap, fast settings suit the
+        # high-volume speculative triggers, e.g. {"conversation_activity": {"max_tokens": 200, "temperature": 0.7}}.
+        # Other settings are reported and ignored when the file is read.
+        self.llm_routes: dict[str, dict] = {}
+        # Retries for transient LLM errors (timeouts, connection errors, 429, 5xx), with jittered exponential backoff.
+        self.llm_max_retries: int = 2
+        self.llm_retry_base_delay: float = 0.5
+        self.llm_retry_max_delay: float = 4
+        # Latency-critical triggers that send a second identical request if the first one is slower than hedge_delay.
+        self.hedge_triggers: list[str] = []
+        self.hedge_delay: float = 3
+        # Consecutive LLM failures that open the circuit breaker, and seconds before probing the backend again.
+        self.circuit_failure_threshold: int = 5
+        self.circuit_cooldown: float = 30
+        # Triggers dropped while the backend is unhealthy.
+        self.low_priority_triggers: list[str] = ["join", "conversation_activity", "inactive", "summary", "compaction"]
+        # OpenAI-compatible endpoints used by the LLM. Each entry accepts name, model, base_url,
+        # api_key_env (the environment variable holding the key), json_mode (provider supports JSON output mode)
+        # and stream_usage (provider reports token usage at the end of streams).
+        self.llm_endpoints: list[dict] = [
+            {"name": "openai", "model": "gpt-4o-mini", "api_key_env": "BISBOT_API_KEY", "json_mode": True, "stream_usage": True}
+        ]
+        # How requests are spread across endpoints: "least_outstanding" or "latency".
+        self.llm_balance: str = "least_outstanding"
+        # Seconds an endpoint is skipped after a 429 without Retry-After, or after endpoint_failure_threshold failures.
+        self.endpoint_cooldown: float = 30
+        self.endpoint_failure_threshold: int = 3
+        # Connection pool shared by the LLM endpoints: connections open at most, idle connections kept and for how
+        # many seconds, and HTTP/2 (where the h2 package is installed). Endpoints idle for llm_keepalive_interval
+        # seconds are pinged (None disables it), so the first reply after a quiet period skips the connection setup.
+        self.llm_max_connections: int = 50
+        self.llm_max_keepalive_connections: int = 20
+        self.llm_keepalive_expiry: float = 120
+        self.llm_http2: bool = True
+        self.llm_keepalive_interval: float | None = 60
+        # Triggers skipped without an LLM call when the bot wrote the last message, the history is empty
+        # or it has not changed since the trigger last evaluated the channel.
+        self.shortcut_triggers: list[str] = ["join", "conversation_activity", "inactive"]
+        # Local classifier filtering speculative triggers before the LLM call. Disabled until a model file exists.
+        self.gate_triggers: list[str] = ["join", "conversation_activity"]
+        self.gate_model_file: str | None = None
+        # Minimum estimated reply probability to call the LLM.
+        self.gate_threshold: float = 0.2
+        # JSONL file collecting (payload, was_null) outcomes to train the classifier. None disables logging.
+        self.gate_log_file: str | None = None
+        # Evaluate every active channel of a conversation_activity sweep in as few requests as possible,
+        # sharing the system prompt. Each request carries at most batch_token_budget (estimated) payload tokens.
+        self.batch_conversation_activity: bool = False
+        self.batch_token_budget: int = 4000
+        # Raw messages kept per channel. With summarize_history, older messages are folded into a
+        # running summary in the background, summary_batch at a time, keeping it under summary_max_tokens.
+        self.history_tail: int = 20
+        self.summarize_history: bool = False
+        self.summary_batch: int = 5
+        self.summary_max_tokens: int = 200
+        # Messages loaded per allowed channel from the Discord API on startup (0 disables it),
+        # with at most backfill_concurrency channels fetched at the same time.
+        self.backfill_messages: int = 0
+        self.backfill_concurrency: int = 3
+        # Outbound pacing as [messages, seconds], per channel and across all channels.
+        self.channel_send_rate: list = [5, 5]
+        self.global_send_rate: list = [50, 1]
+        # Seconds after which a queued reply is dropped instead of being sent late.
+        self.send_max_age: float = 60
+        # JSONL file receiving tracing spans (None disables tracing), fraction of traces kept,
+        # size at which the file is rotated, and spans buffered before they are written.
+        self.trace_file: str | None = None
+        self.trace_sample_rate: float = 1.0
+        self.trace_max_bytes: int = 10 * 1024 * 1024
+        self.trace_flush_size: int = 50
+        # /bisbot-profile: longest run allowed, seconds between stack samples,
+        # and directory receiving the collapsed stacks (for flamegraph tools).
+        self.profile_max_seconds: int = 60
+        self.profile_interval: float = 0.005
+        self.profile_dir: str = "profiles"
+        # Event loop watchdog: seconds between lag measurements, lag (seconds) at which the stack of the
+        # blocking code is logged (None disables the watchdog), and seconds between lag summaries in the log.
+        self.loop_lag_interval: float = 0.1
+        self.loop_lag_threshold: float | None = 0.25
+        self.loop_lag_report_interval: float = 300
+        # SQLite file recording every LLM call (None keeps the ledger in memory), written ledger_flush_size calls at a time.
+        self.ledger_file: str | None = None
+        self.ledger_flush_size: int = 20
+        # model -> [input, cached input, output] USD per million tokens.
+        self.llm_prices: dict = {"gpt-4o-mini": [0.15, 0.075, 0.60]}
+        # Spend limits, e.g. {"channel": "general", "trigger": "*", "daily": 0.5, "monthly": 10}.
+        # "*" matches every channel or trigger; calls over a spent budget are not sent.
+        self.llm_budgets: list[dict] = []
+        # File where the per-channel state is saved on SIGTERM and restored from on boot (None disables it),
+        # and seconds allowed for in-progress replies to finish before shutting down.
+        self.checkpoint_file: str | None = None
+        self.shutdown_timeout: float = 20
+        # Request only the intents the bot uses, skip member lists and member chunking, and keep
+        # message_cache_size messages (for resolving replies) instead of discord.py's default 1000.
+        self.lean_client: bool = False
+        self.message_cache_size: int = 100
+        # Messages in a channel before the bot joins the conversation. With join_target_per_hour, the threshold
+        # of each channel follows its message rate (averaged with join_rate_half_life seconds of half-life)
+        # to join about that many times per hour, within join_bounds.
+        self.join_messages: int = 10
+        self.join_target_per_hour: float | None = None
+        self.join_bounds: list = [3, 60]
+        self.join_rate_half_life: float = 600
 
 
     def read(self, path: str = "config/config.json") -> "Config":
@@ -38,10 +168,79 @@ class Config:
 
         self.response_use_llm = data.get("response_use_llm", self.response_use_llm)
         self.max_context_length = data.get("max_context_length", self.max_context_length)
+        self.context_compaction = data.get("context_compaction", self.context_compaction)
+        self.context_compact_length = data.get("context_compact_length", self.context_compact_length)
+        self.memory_retrieval = data.get("memory_retrieval", self.memory_retrieval)
+        self.memory_top_k = data.get("memory_top_k", self.memory_top_k)
+        self.memory_max_lines = data.get("memory_max_lines", self.memory_max_lines)
+        self.history_sessions = data.get("history_sessions", self.history_sessions)
+        self.history_session_max_turns = data.get("history_session_max_turns", self.history_session_max_turns)
+        self.history_session_ttl = data.get("history_session_ttl", self.history_session_ttl)
         self.max_tokens_response = data.get("max_tokens_response", self.max_tokens_response)
         self.allowed_channels = data.get("allowed_channels", self.allowed_channels)
         self.test_channels = data.get("test_channels", self.test_channels)
         self.keywords = data.get("keywords", self.keywords)
+        self.stream_response = data.get("stream_response", self.stream_response)
+        self.typing_triggers = data.get("typing_triggers", self.typing_triggers)
+        self.llm_deadlines = data.get("llm_deadlines", self.llm_deadlines)
+        self.llm_default_deadline = data.get("llm_default_deadline", self.llm_default_deadline)
+        self.llm_temperature = data.get("llm_temperature", self.llm_temperature)
+        self.llm_routes = self._valid_routes(data.get("llm_routes", self.llm_routes))
+        self.llm_max_retries = data.get("llm_max_retries", self.llm_max_retries)
+        self.llm_retry_base_delay = data.get("llm_retry_base_delay", self.llm_retry_base_delay)
+        self.llm_retry_max_delay = data.get("llm_retry_max_delay", self.llm_retry_max_delay)
+        self.hedge_triggers = data.get("hedge_triggers", self.hedge_triggers)
+        self.hedge_delay = data.get("hedge_delay", self.hedge_delay)
+        self.circuit_failure_threshold = data.get("circuit_failure_threshold", self.circuit_failure_threshold)
+        self.circuit_cooldown = data.get("circuit_cooldown", self.circuit_cooldown)
+        self.low_priority_triggers = data.get("low_priority_triggers", self.low_priority_triggers)
+        self.llm_endpoints = data.get("llm_endpoints", self.llm_endpoints)
+        self.llm_balance = data.get("llm_balance", self.llm_balance)
+        self.endpoint_cooldown = data.get("endpoint_cooldown", self.endpoint_cooldown)
+        self.endpoint_failure_threshold = data.get("endpoint_failure_threshold", self.endpoint_failure_threshold)
+        self.llm_max_connections = data.get("llm_max_connections", self.llm_max_connections)
+        self.llm_max_keepalive_connections = data.get("llm_max_keepalive_connections", self.llm_max_keepalive_connections)
+        self.llm_keepalive_expiry = data.get("llm_keepalive_expiry", self.llm_keepalive_expiry)
+        self.llm_http2 = data.get("llm_http2", self.llm_http2)
+        self.llm_keepalive_interval = data.get("llm_keepalive_interval", self.llm_keepalive_interval)
+        self.shortcut_triggers = data.get("shortcut_triggers", self.shortcut_triggers)
+        self.gate_triggers = data.get("gate_triggers", self.gate_triggers)
+        self.gate_model_file = data.get("gate_model_file", self.gate_model_file)
+        self.gate_threshold = data.get("gate_threshold", self.gate_threshold)
+        self.gate_log_file = data.get("gate_log_file", self.gate_log_file)
+        self.batch_conversation_activity = data.get("batch_conversation_activity", self.batch_conversation_activity)
+        self.batch_token_budget = data.get("batch_token_budget", self.batch_token_budget)
+        self.history_tail = data.get("history_tail", self.history_tail)
+        self.summarize_history = data.get("summarize_history", self.summarize_history)
+        self.summary_batch = data.get("summary_batch", self.summary_batch)
+        self.summary_max_tokens = data.get("summary_max_tokens", self.summary_max_tokens)
+        self.backfill_messages = data.get("backfill_messages", self.backfill_messages)
+        self.backfill_concurrency = data.get("backfill_concurrency", self.backfill_concurrency)
+        self.channel_send_rate = data.get("channel_send_rate", self.channel_send_rate)
+        self.global_send_rate = data.get("global_send_rate", self.global_send_rate)
+        self.send_max_age = data.get("send_max_age", self.send_max_age)
+        self.trace_file = data.get("trace_file", self.trace_file)
+        self.trace_sample_rate = data.get("trace_sample_rate", self.trace_sample_rate)
+        self.trace_max_bytes = data.get("trace_max_bytes", self.trace_max_bytes)
+        self.trace_flush_size = data.get("trace_flush_size", self.trace_flush_size)
+        self.profile_max_seconds = data.get("profile_max_seconds", self.profile_max_seconds)
+        self.profile_interval = data.get("profile_interval", self.profile_interval)
+        self.profile_dir = data.get("profile_dir", self.profile_dir)
+        self.loop_lag_interval = data.get("loop_lag_interval", self.loop_lag_interval)
+        self.loop_lag_threshold = data.get("loop_lag_threshold", self.loop_lag_threshold)
+        self.loop_lag_report_interval = data.get("loop_lag_report_interval", self.loop_lag_report_interval)
+        self.ledger_file = data.get("ledger_file", self.ledger_file)
+        self.ledger_flush_size = data.get("ledger_flush_size", self.ledger_flush_size)
+        self.llm_prices = data.get("llm_prices", self.llm_prices)
+        self.llm_budgets = data.get("llm_budgets", self.llm_budgets)
+        self.checkpoint_file = data.get("checkpoint_file", self.checkpoint_file)
+        self.shutdown_timeout = data.get("shutdown_timeout", self.shutdown_timeout)
+        self.lean_client = data.get("lean_client", self.lean_client)
+        self.message_cache_size = data.get("message_cache_size", self.message_cache_size)
+        self.join_messages = data.get("join_messages", self.join_messages)
+        self.join_target_per_hour = data.get("join_target_per_hour", self.join_target_per_hour)
+        self.join_bounds = data.get("join_bounds", self.join_bounds)
+        self.join_rate_half_life = data.get("join_rate_half_life", self.join_rate_half_life)
 
         # Load external context file if present
         context_file = data.get("context_file")
@@ -54,6 +253,19 @@ class Config:
 
         return self
 
+    @staticmethod
+    def _valid_routes(routes: dict) -> dict:
+        """ Drops the llm_routes settings a request cannot use, reporting each one. """
+        valid = {}
+        for trigger, route in routes.items():
+            if not isinstance(route, dict):
+                print(f"[Config] llm_routes[{trigger!r}] is not an object: ignored")
+                continue
+            for key in route.keys() - set(ROUTE_KEYS):
+                print(f"[Config] llm_routes[{trigger!r}] has unknown setting {key!r} (expected {', '.join(ROUTE_KEYS)}): ignored")
+            valid[trigger] = {key: value for key, value in route.items() if key in ROUTE_KEYS}
+        return valid
+
     def generate_default(self, path: str = "config/config.json"):
         config_path = Path(path)
         config_path.parent.mkdir(parents=True, exist_ok=True)
@@ -75,10 +287,79 @@ class Config:
         return {
             "response_use_llm": self.response_use_llm,
             "max_context_length": self.max_context_length,
+            "context_compaction": self.context_compaction,
+            "context_compact_length": self.context_compact_length,
+            "memory_retrieval": self.memory_retrieval,
+            "memory_top_k": self.memory_top_k,
+            "memory_max_lines": self.memory_max_lines,
+            "history_sessions": self.history_sessions,
+            "history_session_max_turns": self.history_session_max_turns,
+            "history_session_ttl": self.history_session_ttl,
             "max_tokens_response": self.max_tokens_response,
             "allowed_channels": self.allowed_channels,
             "test_channels": self.test_channels,
             "keywords": self.keywords,
+            "stream_response": self.stream_response,
+            "typing_triggers": self.typing_triggers,
+            "llm_deadlines": self.llm_deadlines,
+            "llm_default_deadline": self.llm_default_deadline,
+            "llm_temperature": self.llm_temperature,
+            "llm_routes": self.llm_routes,
+            "llm_max_retries": self.llm_max_retries,
+            "llm_retry_base_delay": self.llm_retry_base_delay,
+            "llm_retry_max_delay": self.llm_retry_max_delay,
+            "hedge_triggers": self.hedge_triggers,
+            "hedge_delay": self.hedge_delay,
+            "circuit_failure_threshold": self.circuit_failure_threshold,
+            "circuit_cooldown": self.circuit_cooldown,
+            "low_priority_triggers": self.low_priority_triggers,
+            "llm_endpoints": self.llm_endpoints,
+            "llm_balance": self.llm_balance,
+            "endpoint_cooldown": self.endpoint_cooldown,
+            "endpoint_failure_threshold": self.endpoint_failure_threshold,
+            "llm_max_connections": self.llm_max_connections,
+            "llm_max_keepalive_connections": self.llm_max_keepalive_connections,
+            "llm_keepalive_expiry": self.llm_keepalive_expiry,
+            "llm_http2": self.llm_http2,
+            "llm_keepalive_interval": self.llm_keepalive_interval,
+            "shortcut_triggers": self.shortcut_triggers,
+            "gate_triggers": self.gate_triggers,
+            "gate_model_file": self.gate_model_file,
+            "gate_threshold": self.gate_threshold,
+            "gate_log_file": self.gate_log_file,
+            "batch_conversation_activity": self.batch_conversation_activity,
+            "batch_token_budget": self.batch_token_budget,
+            "history_tail": self.history_tail,
+            "summarize_history": self.summarize_history,
+            "summary_batch": self.summary_batch,
+            "summary_max_tokens": self.summary_max_tokens,
+            "backfill_messages": self.backfill_messages,
+            "backfill_concurrency": self.backfill_concurrency,
+            "channel_send_rate": self.channel_send_rate,
+            "global_send_rate": self.global_send_rate,
+            "send_max_age": self.send_max_age,
+            "trace_file": self.trace_file,
+            "trace_sample_rate": self.trace_sample_rate,
+            "trace_max_bytes": self.trace_max_bytes,
+            "trace_flush_size": self.trace_flush_size,
+            "profile_max_seconds": self.profile_max_seconds,
+            "profile_interval": self.profile_interval,
+            "profile_dir": self.profile_dir,
+            "loop_lag_interval": self.loop_lag_interval,
+            "loop_lag_threshold": self.loop_lag_threshold,
+            "loop_lag_report_interval": self.loop_lag_report_interval,
+            "ledger_file": self.ledger_file,
+            "ledger_flush_size": self.ledger_flush_size,
+            "llm_prices": self.llm_prices,
+            "llm_budgets": self.llm_budgets,
+            "checkpoint_file": self.checkpoint_file,
+            "shutdown_timeout": self.shutdown_timeout,
+            "lean_client": self.lean_client,
+            "message_cache_size": self.message_cache_size,
+            "join_messages": self.join_messages,
+            "join_target_per_hour": self.join_target_per_hour,
+            "join_bounds": self.join_bounds,
+            "join_rate_half_life": self.join_rate_half_life,
             "context_file": "context.txt",
         }
 
@@ -1,30 +1,123 @@
+import sys
 import discord
 import json
+import time
+import signal
+import asyncio
+import contextlib
+from typing import Literal
 from GptWrapper import BisbalWrapper
 from Config import Config
+from Clock import Clock
+import Checkpoint
+from Dispatcher import OutboundDispatcher
 from discord import app_commands
-from Helpers import MessageCounter, MessageHistory, InactiveTimer, DiscordMessageHandler, ConversationWatcher
+from Normalizer import MessageNormalizer
+from Profiler import LoopLagMonitor, SamplingProfiler
+from Tracing import tracer
+from Helpers import HistorySummarizer, MessageCounter, MessageHistory, InactiveTimer, DiscordMessageHandler, ConversationWatcher
+
+def peak_resident_memory_mb() -> float:
+    """ Peak resident memory of the process, in MB (0 where it cannot be measured). """
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
 
 class DiscordBot(discord.Client):
-    def __init__(self, llm):
-        intents = discord.Intents.default()
-        intents.message_content = True
-        super().__init__(intents=intents)
+    def __init__(self, llm, clock: Clock | None = None):
+        """
+        Args:
+            llm: BisbalWrapper answering the triggers.
+            clock: Time source of the timers, watchers and history. A VirtualClock runs simulations faster than real time.
+        """
+        self._started = time.perf_counter()
+        if llm.config.lean_client:
+            super().__init__(**self.lean_options(llm.config.message_cache_size))
+        else:
+            intents = discord.Intents.default()
+            intents.message_content = True
+            super().__init__(intents=intents)
         self.config = Config()
-        self.message_counter = MessageCounter()
-        self.message_history = MessageHistory()
-        self.message_handler = DiscordMessageHandler(llm)
-        self.conversation_watcher = ConversationWatcher(seconds=30, callback=self.on_conversation_activity)
-        self.inactive_timer = InactiveTimer(seconds = 30 * 60, callback = self.on_inactive)
+        self.llm = llm
+        self.clock = clock or Clock()
+        self.message_counter = MessageCounter(
+            max_messages=llm.config.join_messages,
+            target_per_hour=llm.config.join_target_per_hour,
+            bounds=tuple(llm.config.join_bounds),
+            half_life=llm.config.join_rate_half_life,
+            clock=self.clock,
+        )
+        self.normalizer = MessageNormalizer()
+        self.message_history = MessageHistory(
+            max_messages=llm.config.history_tail,
+            normalizer=self.normalizer,
+            summarizer=HistorySummarizer(llm, llm.config.summary_batch, llm.config.summary_max_tokens)
+            if llm.config.summarize_history else None,
+            clock=self.clock,
+        )
+        self.message_handler = DiscordMessageHandler(
+            llm, normalizer=self.normalizer,
+            dispatcher=OutboundDispatcher.from_config(llm.config, self.clock, self.clock.sleep),
+        )
+        self.conversation_watcher = ConversationWatcher(seconds=30, callback=self.on_conversation_activity, sleep=self.clock.sleep)
+        self.inactive_timer = InactiveTimer(seconds = 30 * 60, callback = self.on_inactive, sleep=self.clock.sleep, clock=self.clock)
+        self.profiler = SamplingProfiler()
+        self.loop_monitor = LoopLagMonitor(
+            interval=llm.config.loop_lag_interval,
+            threshold=llm.config.loop_lag_threshold,
+            report_interval=llm.config.loop_lag_report_interval,
+        ) if llm.config.loop_lag_threshold else None
         self.permitted_channels: set[int] = set()  # If empty, all channels are permitted
         self.test_channels: set[int] = set()
         self.keywords: list[str] = []
+        # Handler work to finish before shutting down
+        self._inflight: set[asyncio.Task] = set()
+        self.closing = False
+        self._restored = False
+        self._backfilled = False
+        # Inactivity countdown left when the restored checkpoint was taken
+        self._inactive_remaining: float | None = None
+        self._keep_warm: asyncio.Task | None = None
+
+    @staticmethod
+    def lean_options(message_cache_size: int) -> dict:
+        """
+        Client options keeping only what the bot uses: guild channels and messages with their content.
+        No member lists, presences, reactions, typing or voice events, no member chunking at startup,
+        and a message cache only for resolving replies Discord did not include.
+        """
+        intents = discord.Intents.none()
+        intents.guilds = True
+        intents.guild_messages = True
+        intents.message_content = True
+        return {
+            "intents": intents,
+            "member_cache_flags": discord.MemberCacheFlags.none(),
+            "chunk_guilds_at_startup": False,
+            "max_messages": message_cache_size or None,
+        }
+
+    @contextlib.contextmanager
+    def _tracked(self):
+        task = asyncio.current_task()
+        self._inflight.add(task)
+        try:
+            yield
+        finally:
+            self._inflight.discard(task)
 
     async def on_conversation_activity(self, active_channels: set[int]):
-        await self.message_handler.handle_conversation_activity(self, active_channels)
+        with self._tracked():
+            await self.message_handler.handle_conversation_activity(self, active_channels)
 
     async def on_inactive(self):
-        await self.message_handler.handle_inactive(self)
+        with self._tracked():
+            await self.message_handler.handle_inactive(self)
         self.inactive_timer.reset()
 
     async def on_slash_command(self, interaction: discord.Interaction, channel_name: str, prompt: str):
@@ -42,62 +135,244 @@ class DiscordBot(discord.Client):
         response = await self.message_handler.handle_command(self, target_channel, prompt)
         await interaction.followup.send(f"Response: {response}", ephemeral=True)
 
+    async def _check_admin(self, interaction: discord.Interaction) -> bool:
+        # Admin commands only work for admins, and only from test channels
+        if interaction.channel_id in self.test_channels and interaction.permissions.administrator:
+            return True
+        await interaction.response.send_message("This command is restricted to admins in test channels.", ephemeral=True)
+        return False
+
+    async def on_profile_command(self, interaction: discord.Interaction, seconds: int):
+        if not await self._check_admin(interaction):
+            return
+
+        if self.profiler.running:
+            await interaction.response.send_message("A profile is already running.", ephemeral=True)
+            return
+
+        seconds = max(1, min(seconds, self.config.profile_max_seconds))
+        self.profiler.interval = self.config.profile_interval
+        self.profiler.output_dir = self.config.profile_dir
+        await interaction.response.defer(ephemeral=True)
+        report = await self.profiler.run(seconds)
+        summary = report.summary()
+        if self.loop_monitor:
+            lag = self.loop_monitor.stats()
+            summary += (f"\nLoop lag: now {lag['lag_ms']:.1f} ms, p99 {lag['p99_ms']:.1f} ms, "
+                        f"max {lag['max_ms']:.0f} ms, {lag['stalls']} stalls since start")
+        await interaction.followup.send(f"```\n{summary}\n```", ephemeral=True)
+
+    async def on_cost_command(self, interaction: discord.Interaction, period: str):
+        if not await self._check_admin(interaction):
+            return
+
+        report = f"{self.llm.ledger.report(period)}\n{self.message_handler.shortcut.summary()}"
+        await interaction.response.send_message(f"```\n{report}\n```", ephemeral=True)
+
+    async def close(self):
+        if self.loop_monitor:
+            self.loop_monitor.stop()
+        await self.llm.close()
+        tracer.flush()
+        await super().close()
+
+    async def setup_hook(self):
+        if self.loop_monitor:
+            self.loop_monitor.start()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            # Not available on Windows, where the default handling stays
+            with contextlib.suppress(NotImplementedError):
+                loop.add_signal_handler(sig, lambda: asyncio.ensure_future(self.shutdown()))
+
+    async def shutdown(self):
+        """
+        Stop taking messages, let the handlers in progress finish and their replies
+        be sent, save a checkpoint of the bot state and disconnect.
+        """
+        if self.closing:
+            return
+        self.closing = True
+        print("Shutting down...")
+
+        pending = [task for task in self._inflight if not task.done()]
+        if pending:
+            await asyncio.wait(pending, timeout=self.config.shutdown_timeout)
+        try:
+            await asyncio.wait_for(self.message_handler.dispatcher.drain(), self.config.shutdown_timeout)
+        except TimeoutError:
+            print("Shutdown: outbound queue not drained in time")
+
+        if self.config.checkpoint_file:
+            Checkpoint.save(self.config.checkpoint_file, self.snapshot())
+            print(f"Checkpoint saved to {self.config.checkpoint_file}")
+
+        self.inactive_timer.cancel()
+        self.conversation_watcher.cancel()
+        if self._keep_warm:
+            self._keep_warm.cancel()
+        if self.message_history.summarizer:
+            self.message_history.summarizer.cancel()
+        await self.close()
+
+    def snapshot(self) -> dict:
+        """
+        Per-channel state that should survive a restart.
+        """
+        return {
+            "counters": self.message_counter.counter,
+            "join_rates": self.message_counter.snapshot(),
+            **self.message_history.snapshot(),
+            "active_channels": sorted(self.conversation_watcher.active_channels()),
+            "inactive_remaining": self.inactive_timer.remaining(),
+            "llm": self.llm.snapshot(),
+        }
+
+    def restore(self, snapshot: dict):
+        """
+        Restore a checkpoint, accounting for the time the bot was down.
+        The inactivity timer is re-armed with what was left of it on the next on_ready.
+        """
+        elapsed = max(0.0, time.time() - snapshot["saved_at"])
+        self.message_counter.counter = {int(channel_id): count for channel_id, count in snapshot["counters"].items()}
+        # Checkpoints from before the adaptive threshold have no rates
+        self.message_counter.restore(snapshot.get("join_rates", {}), elapsed)
+        self.message_history.restore(snapshot, elapsed)
+        for channel_id in snapshot["active_channels"]:
+            self.conversation_watcher.mark_activity(channel_id)
+        if snapshot["inactive_remaining"] is not None:
+            self._inactive_remaining = max(0.0, snapshot["inactive_remaining"] - elapsed)
+        self.llm.restore(snapshot["llm"])
+        print(f"Restored checkpoint from {elapsed:.0f}s ago")
+
     async def on_ready(self):
-        print(f"Connected as {self.user}")
+        print(f"Connected as {self.user} in {time.perf_counter() - self._started:.1f}s, {peak_resident_memory_mb():.0f} MB peak resident memory")
         self.config = self.config.read()
         self._load_config(self.config)
+        if not self._restored and self.config.checkpoint_file:
+            self._restored = True
+            snapshot = Checkpoint.load(self.config.checkpoint_file)
+            if snapshot:
+                self.restore(snapshot)
+        await self.llm.warm_up()
+        if self._keep_warm is None:
+            self._keep_warm = asyncio.create_task(self.llm.keep_warm(self.clock.sleep))
+        if not self._backfilled and self.config.backfill_messages:
+            # on_ready fires again on every reconnect
+            self._backfilled = True
+            await self.backfill_history(self._backfill_channels())
         tree = app_commands.CommandTree(self)
 
         @tree.command(name="bisbot")
         async def bisbot(interaction: discord.Interaction, channel: str, prompt: str):
             await self.on_slash_command(interaction, channel, prompt)
 
+        @tree.command(name="bisbot-profile", description="Sample the running bot for some seconds")
+        @app_commands.default_permissions(administrator=True)
+        async def bisbot_profile(interaction: discord.Interaction, seconds: int = 10):
+            await self.on_profile_command(interaction, seconds)
+
+        @tree.command(name="bisbot-cost", description="LLM spend of the current day or month")
+        @app_commands.default_permissions(administrator=True)
+        async def bisbot_cost(interaction: discord.Interaction, period: Literal["daily", "monthly"] = "daily"):
+            await self.on_cost_command(interaction, period)
+
         await tree.sync()
-        self.inactive_timer.init()
+        self.inactive_timer.init(self._inactive_remaining)
+        self._inactive_remaining = None
         self.conversation_watcher.start()
 
+    async def backfill_history(self, channels: list):
+        """
+        Load the last `backfill_messages` messages of each channel into the history,
+        so the first triggers after a restart already have context.
+        Only messages older than the oldest one already stored (restored from the
+        checkpoint or received since connecting) are fetched.
+        Channels are fetched concurrently, at most `backfill_concurrency` at a time.
+        """
+        start = time.perf_counter()
+        now = discord.utils.utcnow()  # Messages received from now on arrive through on_message
+        semaphore = asyncio.Semaphore(self.config.backfill_concurrency)
+
+        async def backfill(channel):
+            async with semaphore:
+                oldest = self.message_history.oldest_id(channel.id)
+                before = discord.Object(id=oldest) if oldest is not None else now
+                try:
+                    messages = [m async for m in channel.history(limit=self.config.backfill_messages, before=before)]
+                except discord.HTTPException as e:
+                    print(f"Backfill failed for {channel.name}: {e}")
+                    return 0
+
+            messages = [
+                (m, m.author == self.user)
+                for m in reversed(messages)  # history() returns the newest first
+                if m.author == self.user or not m.author.bot
+            ]
+            self.message_history.backfill(channel.id, messages)
+            return len(messages)
+
+        counts = await asyncio.gather(*(backfill(channel) for channel in channels))
+        print(f"Backfilled {sum(counts)} messages in {len(channels)} channels in {time.perf_counter() - start:.1f}s")
+
+    def _backfill_channels(self) -> list:
+        if self.permitted_channels:
+            channels = (self.get_channel(id) for id in self.permitted_channels)
+        else:
+            channels = self.get_all_channels()
+        return [c for c in channels if isinstance(c, discord.TextChannel)]
+
     async def on_message(self, message: discord.Message):
-        if not self.is_allowed_channel(message.channel.id):
+        if self.closing:
             return
 
-        if message.channel.id in self.test_channels:
-            pass # TODO Slash commands private testing
+        with self._tracked(), tracer.span("on_message", channel=message.channel.id) as span:
+            if not self.is_allowed_channel(message.channel.id):
+                return
+
+            if message.channel.id in self.test_channels:
+                pass # TODO Slash commands private testing
+
+            if message.author == self.user:
+                channel = message.channel.id
+                self.message_counter.reset(channel)
+                self.message_history.add(message, is_self=True)
+                self.inactive_timer.reset()
+                self.conversation_watcher.reset(channel)
+                return
+
+            elif message.author.bot:
+                return
 
-        if message.author == self.user:
             channel = message.channel.id
-            self.message_counter.reset(channel)
-            self.message_history.add(message, is_self=True)
+            should_join = self.message_counter.increment(channel)
+            self.message_history.add(message)
             self.inactive_timer.reset()
-            self.conversation_watcher.reset(channel)
-            return
+            with tracer.span("history.format"):
+                history = self.message_history.get_formatted(channel)
+            self.conversation_watcher.mark_activity(channel)
 
-        elif message.author.bot:
-            return
-        
-        channel = message.channel.id
-        should_join = self.message_counter.increment(channel)
-        self.message_history.add(message)
-        self.inactive_timer.reset()
-        history = self.message_history.get_formatted(channel)
-        self.conversation_watcher.mark_activity(channel)
-        
-        if self._is_mention_to_me(message):
-            await self.message_handler.handle(message, trigger="mention", history=history)
-            return
+            if self._is_mention_to_me(message):
+                span.set("trigger", "mention")
+                await self.message_handler.handle(message, trigger="mention", history=history)
+                return
 
-        if await self._is_reply_to_me(message):
-            await self.message_handler.handle(message, trigger="reply", history=history)
-            return
+            if await self._is_reply_to_me(message):
+                span.set("trigger", "reply")
+                await self.message_handler.handle(message, trigger="reply", history=history)
+                return
 
-        if self._contains_keywords(message):
-            await self.message_handler.handle(message, trigger="keyword", history=history)
-            return
+            if self._contains_keywords(message):
+                span.set("trigger", "keyword")
+                await self.message_handler.handle(message, trigger="keyword", history=history)
+                return
 
-        if should_join:
-            self.message_counter.reset(channel)
-            self.conversation_watcher.reset(channel)
-            await self.message_handler.handle(message, trigger="join", history=history)
-            return
+            if should_join:
+                self.message_counter.reset(channel)
+                self.conversation_watcher.reset(channel)
+                span.set("trigger", "join")
+                await self.message_handler.handle(message, trigger="join", history=history)
+                return
 
     def _is_mention_to_me(self, message: discord.Message) -> bool:
         return self.user in message.mentions
@@ -107,8 +382,14 @@ class DiscordBot(discord.Client):
         if ref is None or ref.message_id is None:
             return False
 
+        # Discord usually sends the replied message along; fetch it only when it did not.
+        replied = getattr(ref, "resolved", None) or getattr(ref, "cached_message", None)
+        if isinstance(replied, discord.Message):
+            return replied.author.id == self.user.id
+
         try:
-            replied = await message.channel.fetch_message(ref.message_id)
+            with tracer.span("reply_lookup", message_id=ref.message_id):
+                replied = await message.channel.fetch_message(ref.message_id)
         except (discord.NotFound, discord.Forbidden):
             return False
 
@@ -0,0 +1,160 @@
+import re
+import time
+import asyncio
+from collections import deque
+import discord
+from Config import Config
+from Tracing import tracer
+
+# Discord rejects messages longer than this.
+MAX_MESSAGE_LENGTH = 2000
+
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> list[str]:
+    """
+    Split a message into parts of at most `limit` characters, cutting at the
+    last sentence boundary (or whitespace) that fits in each part.
+    """
+    parts = []
+    text = text.strip()
+    while len(text) > limit:
+        window = text[:limit + 1]
+        cut = max((m.start() for m in _SENTENCE_END.finditer(window)), default=0)
+        if cut == 0:
+            cut = window.rfind(" ")
+        if cut <= 0:
+            cut = limit
+
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+
+    if text:
+        parts.append(text)
+    return parts
+
+
+class TokenBucket:
+    """
+    Allows `capacity` sends per `period` seconds, refilled continuously.
+    """
+
+    def __init__(self, capacity: int, period: float, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.clock = clock
+        self.tokens = float(capacity)
+        self._updated = clock()
+
+    def delay(self) -> float:
+        """
+        Seconds to wait before a token is available.
+        """
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutboundDispatcher:
+    """
+    Sends the bot's messages through per-channel queues.
+
+    Handlers only enqueue and return. One worker per channel sends the queued
+    messages in order, paced by per-channel and global token buckets that
+    mirror Discord's send limits, so sends wait locally instead of hitting 429s.
+    Long replies are split on sentence boundaries, consecutive pending replies
+    to the same channel are merged when they fit in one message, and replies
+    older than `max_age` seconds are dropped instead of being sent late.
+    """
+
+    def __init__(self, channel_rate: tuple[int, float] = (5, 5), global_rate: tuple[int, float] = (50, 1),
+                 max_age: float = 60, clock=time.monotonic, sleep=asyncio.sleep):
+        """
+        Args:
+            channel_rate: (messages, seconds) allowed per channel.
+            global_rate: (messages, seconds) allowed across all channels.
+            max_age: Seconds after which a queued reply is dropped.
+            clock: Callable returning the current time in seconds.
+            sleep: Coroutine function used to wait for the rate limits, following `clock`.
+        """
+        self.channel_rate = channel_rate
+        self.max_age = max_age
+        self.clock = clock
+        self.sleep = sleep
+        self.global_bucket = TokenBucket(*global_rate, clock=clock)
+        # channel_id -> deque[(enqueued_at, text, span active when enqueued)]
+        self.queues: dict[int, deque[tuple]] = {}
+        self.buckets: dict[int, TokenBucket] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+        self.dropped = 0
+
+    @classmethod
+    def from_config(cls, config: Config, clock=time.monotonic, sleep=asyncio.sleep) -> "OutboundDispatcher":
+        return cls(tuple(config.channel_send_rate), tuple(config.global_send_rate), config.send_max_age, clock, sleep)
+
+    def enqueue(self, channel, text: str) -> None:
+        """
+        Queue a message for a channel and make sure its worker is running.
+        """
+        queue = self.queues.setdefault(channel.id, deque())
+        queue.append((self.clock(), text, tracer.current()))
+
+        worker = self._workers.get(channel.id)
+        if worker is None or worker.done():
+            self._workers[channel.id] = asyncio.create_task(self._run(channel))
+
+    async def drain(self):
+        """
+        Wait until every queued message has been sent or dropped.
+        """
+        while any(not worker.done() for worker in self._workers.values()):
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    async def _run(self, channel):
+        queue = self.queues[channel.id]
+        bucket = self.buckets.setdefault(channel.id, TokenBucket(*self.channel_rate, clock=self.clock))
+
+        while queue:
+            enqueued_at, text, parent = self._next(queue)
+            if text is None:
+                continue
+
+            with tracer.span("discord.send", parent=parent, channel=channel.id, length=len(text)) as span:
+                span.set("queued_ms", round((self.clock() - enqueued_at) * 1000, 1))
+                for part in split_message(text):
+                    await self._wait(bucket)
+                    try:
+                        await channel.send(part)
+                    except discord.HTTPException as e:
+                        print(f"Send failed in {channel.name}: {e}")
+                        span.set("error", repr(e))
+
+    def _next(self, queue: deque) -> tuple:
+        """
+        Pop the oldest fresh message, merged with the ones queued behind it while they fit.
+        Returns (enqueued_at, text, span), text being None if the message was stale.
+        """
+        enqueued_at, text, parent = queue.popleft()
+        if self.clock() - enqueued_at > self.max_age:
+            self.dropped += 1
+            return enqueued_at, None, parent
+
+        while queue and len(text) + 1 + len(queue[0][1]) <= MAX_MESSAGE_LENGTH:
+            text += "\n" + queue.popleft()[1]
+
+        return enqueued_at, text, parent
+
+    async def _wait(self, bucket: TokenBucket):
+        while True:
+            delay = max(bucket.delay(), self.global_bucket.delay())
+            if delay <= 0:
+                break
+            await self.sleep(delay)
+
+        bucket.take()
+        self.global_bucket.take()
@@ -0,0 +1,280 @@
+import re
+import sys
+import json
+import math
+import zlib
+import random
+import argparse
+from pathlib import Path
+from collections import Counter
+from Config import Config
+
+
+class GateClassifier:
+    """
+    Hashed n-gram logistic regression estimating the probability that the LLM
+    would reply (i.e. not return "response": null) to a trigger payload.
+
+    It runs on the CPU in microseconds, so speculative triggers can be
+    filtered before paying for a completion.
+    """
+
+    _WORD = re.compile(r"\w+", re.UNICODE)
+    # Only the tail of the history matters to decide whether to join.
+    HISTORY_LINES = 6
+
+    def __init__(self, buckets: int = 2 ** 18):
+        """
+        Args:
+            buckets: Size of the hashed feature space.
+        """
+        self.buckets = buckets
+        self.bias = 0.0
+        # bucket -> weight, sparse
+        self.weights: dict[int, float] = {}
+
+    def features(self, payload: dict) -> list[int]:
+        """
+        Hashes the trigger, the last history lines and the triggering message
+        into word unigrams and bigrams.
+        """
+        lines = (payload.get("history") or "").splitlines()[-self.HISTORY_LINES:]
+        tokens = [f"trigger={payload.get('trigger')}"]
+        if lines and "(you):" in lines[-1]:
+            tokens.append("last_is_self")
+
+        texts = [line.partition(": ")[2] for line in lines] + [payload.get("message") or ""]
+        for text in texts:
+            words = self._WORD.findall(text.lower())
+            tokens += words
+            tokens += [f"{a}_{b}" for a, b in zip(words, words[1:])]
+
+        return [zlib.crc32(token.encode("utf-8")) % self.buckets for token in tokens]
+
+    def score(self, payload: dict) -> float:
+        """
+        Returns the estimated probability of a non-null reply.
+        """
+        features = self.features(payload)
+        z = self.bias + sum(self.weights.get(f, 0.0) for f in features) / math.sqrt(len(features))
+        return 1 / (1 + math.exp(-max(min(z, 30), -30)))
+
+    def train(self, samples: list[tuple[dict, bool]], epochs: int = 10, learning_rate: float = 0.5, l2: float = 1e-5):
+        """
+        Fits the model with stochastic gradient descent.
+
+        Args:
+            samples: (payload, replied) pairs.
+        """
+        samples = list(samples)
+        rng = random.Random(0)
+        for _ in range(epochs):
+            rng.shuffle(samples)
+            for payload, replied in samples:
+                features = self.features(payload)
+                error = self.score(payload) - (1.0 if replied else 0.0)
+                step = learning_rate * error / math.sqrt(len(features))
+                self.bias -= learning_rate * error
+                for f in features:
+                    w = self.weights.get(f, 0.0)
+                    self.weights[f] = w - step - learning_rate * l2 * w
+
+    def evaluate(self, samples: list[tuple[dict, bool]], threshold: float) -> dict:
+        """
+        Precision and recall of the "reply" class at the given threshold,
+        plus the share of LLM calls the gate would skip.
+        """
+        tp = fp = fn = skipped = 0
+        for payload, replied in samples:
+            allowed = self.score(payload) >= threshold
+            skipped += not allowed
+            tp += allowed and replied
+            fp += allowed and not replied
+            fn += not allowed and replied
+
+        return {
+            "samples": len(samples),
+            "threshold": threshold,
+            "precision": tp / (tp + fp) if tp + fp else 0.0,
+            "recall": tp / (tp + fn) if tp + fn else 0.0,
+            "skipped_calls": skipped / len(samples) if samples else 0.0,
+        }
+
+    def save(self, path: str):
+        data = {"buckets": self.buckets, "bias": self.bias, "weights": self.weights}
+        Path(path).write_text(json.dumps(data), encoding="utf-8")
+
+    @classmethod
+    def load(cls, path: str) -> "GateClassifier":
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+        model = cls(data["buckets"])
+        model.bias = data["bias"]
+        model.weights = {int(k): v for k, v in data["weights"].items()}
+        return model
+
+
+class Gate:
+    """
+    Decides whether a speculative trigger is worth an LLM call, and logs
+    the outcome of the calls that were made so the classifier can be retrained.
+    """
+
+    def __init__(self, triggers: list[str], threshold: float,
+                 model: GateClassifier | None = None, log_file: str | None = None):
+        """
+        Args:
+            triggers: Triggers subject to gating.
+            threshold: Minimum reply probability to call the LLM.
+            model: Trained classifier. Without it every call goes through.
+            log_file: JSONL file where (payload, was_null) outcomes are appended.
+        """
+        self.triggers = triggers
+        self.threshold = threshold
+        self.model = model
+        self.log_file = log_file
+        self.skipped = 0
+
+    @classmethod
+    def from_config(cls, config: Config) -> "Gate":
+        model = None
+        if config.gate_model_file and Path(config.gate_model_file).exists():
+            model = GateClassifier.load(config.gate_model_file)
+        return cls(config.gate_triggers, config.gate_threshold, model, config.gate_log_file)
+
+    def should_call(self, payload: dict) -> bool:
+        if self.model is None or payload.get("trigger") not in self.triggers:
+            return True
+
+        if self.model.score(payload) >= self.threshold:
+            return True
+
+        self.skipped += 1
+        return False
+
+    def record(self, payload: dict, was_null: bool):
+        if not self.log_file or payload.get("trigger") not in self.triggers:
+            return
+
+        with open(self.log_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"payload": payload, "was_null": was_null}, ensure_ascii=False) + "\n")
+
+
+class ShortCircuit:
+    """
+    Deterministic rules skipping speculative triggers whose answer is known
+    without asking: the bot wrote the last message, there is no history, or
+    the history is the same as when the trigger last evaluated the channel.
+    """
+
+    SELF_LAST = "self_last"
+    EMPTY_HISTORY = "empty_history"
+    UNCHANGED = "unchanged"
+
+    def __init__(self, triggers: list[str]):
+        """
+        Args:
+            triggers: Triggers subject to the rules.
+        """
+        self.triggers = triggers
+        # reason -> triggers skipped
+        self.skipped: Counter = Counter()
+        # (trigger, channel id) -> fingerprint of the history last evaluated
+        self._fingerprints: dict[tuple[str, int], int] = {}
+
+    @classmethod
+    def from_config(cls, config: Config) -> "ShortCircuit":
+        return cls(config.shortcut_triggers)
+
+    def skip_reason(self, payload: dict, channel_id: int, last_is_self: bool = False) -> str | None:
+        """
+        Returns why the trigger needs no LLM call, or None if it does. Skips are counted by reason.
+
+        Args:
+            payload: Trigger payload.
+            channel_id: Channel the trigger evaluates.
+            last_is_self: Whether the bot wrote the newest stored message. It comes from the
+                history entries, since a multi-line message cannot be told apart in the text.
+        """
+        trigger = payload.get("trigger")
+        if trigger not in self.triggers:
+            return None
+
+        history = payload.get("history") or ""
+        if not history.strip():
+            reason = self.EMPTY_HISTORY
+        elif last_is_self:
+            reason = self.SELF_LAST
+        elif self._fingerprints.get((trigger, channel_id)) == _fingerprint(history):
+            reason = self.UNCHANGED
+        else:
+            return None
+
+        self.skipped[reason] += 1
+        return reason
+
+    def record(self, payload: dict, channel_id: int):
+        """ Remembers the history an LLM call evaluated, so the same one is not sent again. """
+        if payload.get("trigger") in self.triggers:
+            self._fingerprints[(payload["trigger"], channel_id)] = _fingerprint(payload.get("history") or "")
+
+    def summary(self) -> str:
+        if not self.skipped:
+            return "LLM calls skipped locally since start: none"
+        return "LLM calls skipped locally since start: " + ", ".join(f"{count} {reason}" for reason, count in self.skipped.most_common())
+
+
+def _fingerprint(history: str) -> int:
+    return zlib.crc32(history.encode("utf-8"))
+
+
+def read_log(path: str) -> list[tuple[dict, bool]]:
+    samples = []
+    for line in Path(path).read_text(encoding="utf-8").splitlines():
+        if line.strip():
+            entry = json.loads(line)
+            samples.append((entry["payload"], not entry["was_null"]))
+    return samples
+
+
+def split(samples: list[tuple[dict, bool]], holdout: float = 0.2):
+    """ Deterministic train/eval split, stable as the log grows. """
+    train, test = [], []
+    for sample in samples:
+        key = json.dumps(sample[0], sort_keys=True, ensure_ascii=False).encode("utf-8")
+        (test if zlib.crc32(key) % 100 < holdout * 100 else train).append(sample)
+    return train, test
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Train or evaluate the pre-LLM gating classifier.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    train_cmd = sub.add_parser("train", help="train on a gate log and report holdout precision/recall")
+    train_cmd.add_argument("log")
+    train_cmd.add_argument("model")
+    train_cmd.add_argument("--epochs", type=int, default=10)
+    train_cmd.add_argument("--threshold", type=float, default=Config().gate_threshold)
+
+    eval_cmd = sub.add_parser("eval", help="report precision/recall of a trained model on a gate log")
+    eval_cmd.add_argument("log")
+    eval_cmd.add_argument("model")
+    eval_cmd.add_argument("--threshold", type=float, default=Config().gate_threshold)
+
+    args = parser.parse_args(argv)
+    samples = read_log(args.log)
+
+    if args.command == "train":
+        train, test = split(samples)
+        model = GateClassifier()
+        model.train(train, epochs=args.epochs)
+        model.save(args.model)
+        report = model.evaluate(test or train, args.threshold)
+    else:
+        report = GateClassifier.load(args.model).evaluate(samples, args.threshold)
+
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
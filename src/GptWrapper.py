@@ -1,12 +1,17 @@
-import os
+import re
+import time
+import asyncio
 from Config import Config
-from openai import OpenAI
+from LlmBackend import BackendPool, Route
+from Ledger import CostLedger
+from Memory import MemoryIndex
+from Resilience import CircuitBreaker, CircuitOpenError, HedgeLostError, TRANSIENT_ERRORS, backoff_delay, hedged
+from Tracing import tracer
+from collections import Counter
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
 import json
 
-client = OpenAI(api_key=os.getenv("BISBOT_API_KEY"))
-
 RESPONSE_RULES = (
     "\n\nAlways respond in JSON using this exact format:\n"
     "{"
@@ -16,11 +21,46 @@ RESPONSE_RULES = (
     "Do not add any text outside the JSON.\n"
 )
 
+BATCH_RESPONSE_RULES = (
+    "\n\nYou are evaluating several Discord channels at once.\n"
+    "The user message maps each channel id to that channel's trigger and history.\n"
+    "Decide for each channel independently, as if it were the only one.\n"
+    "Always respond in JSON using this exact format:\n"
+    "{"
+    '"channels": {"<channel id>": {"response": string or null, "context": string or null}}'
+    "}\n"
+    "Include every channel id you were given. Do not add any text outside the JSON.\n"
+)
+
+SUMMARY_RULES = (
+    "You maintain a running summary of a Discord conversation for a participant who cannot see the old messages.\n"
+    "You are given the previous summary (possibly null) and the messages that came after it.\n"
+    "Write an updated summary: who talked about what, open questions, plans and the general mood.\n"
+    "Messages labeled \"(you)\" were written by the participant.\n"
+    "Be brief and factual, write in the language of the conversation and do not invent anything.\n"
+    "Always respond in JSON using this exact format:\n"
+    '{"summary": string}\n'
+    "Do not add any text outside the JSON.\n"
+)
+
+COMPACTION_RULES = (
+    "You keep the long-term memory of a participant in a Discord server.\n"
+    "You are given the memory lines they learned over time, oldest first.\n"
+    "Merge them into a compact digest: combine duplicates, keep only the latest version of facts that changed\n"
+    "and drop what is trivial. Keep names, preferences, relationships, running jokes and plans.\n"
+    "The digest must be shorter than {max_chars} characters, one fact per line.\n"
+    "Write in the language of the memories and do not invent anything.\n"
+    "Always respond in JSON using this exact format:\n"
+    '{{"memory": string}}\n'
+    "Do not add any text outside the JSON.\n"
+)
+
 INTERACTION_RULES = (
     "\n\nYou are simulating a real person in a Discord conversation.\n"
 
     "You are given:\n"
-    "- The recent conversation history.\n"
+    "- The recent conversation history. When it comes as \"new_history\", it only holds the messages\n"
+    "  written since your previous turn in this conversation; the earlier ones are in the previous turns.\n"
     "- The last message that triggered you.\n"
     "- The reason why you were triggered.\n\n"
 
@@ -95,61 +135,672 @@ DEBUG REASONING (temporary):\n"
 
 
 
+# How each completion envelope was recovered: direct, fenced, embedded or failed.
+PARSE_STATS: Counter = Counter()
+
+_FENCE = re.compile(r"```(?:json)?\s*(.*?)```", re.S | re.I)
+
+
+def parse_envelope(text: str, key: str = "response") -> dict | None:
+    """ Extracts the JSON envelope from a completion, tolerating markdown fences
+    and text around the object. Each recovery path is counted in PARSE_STATS.
+    params:
+        text: raw completion
+        key: field the envelope must contain
+    returns:
+        the envelope, or None if no JSON object with that field was found
+    """
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            PARSE_STATS["direct"] += 1
+            return data
+    except (TypeError, ValueError):
+        pass
+
+    if text:
+        for block in _FENCE.findall(text):
+            try:
+                data = json.loads(block)
+            except ValueError:
+                continue
+            if isinstance(data, dict) and key in data:
+                PARSE_STATS["fenced"] += 1
+                return data
+
+        decoder = json.JSONDecoder()
+        start = text.find("{")
+        while start != -1:
+            try:
+                data, _ = decoder.raw_decode(text, start)
+                if isinstance(data, dict) and key in data:
+                    PARSE_STATS["embedded"] += 1
+                    return data
+            except ValueError:
+                pass
+            start = text.find("{", start + 1)
+
+    PARSE_STATS["failed"] += 1
+    return None
+
+
 class Response:
     """ Defines which part of the response is for the user or for the system context.
     params:
-        received_message: is expected to be in json format
+        received_message: is expected to be in json format, possibly fenced or surrounded by text
     """
     def __init__(self, received_message: str):
-        try:
-            self._msg = json.loads(received_message)
-            self.message = self._msg.get("response")
-            self.memory_proposal = self._msg.get("context")
-        except Exception as e:
+        envelope = parse_envelope(received_message)
+        if envelope is None:
             print("Invalid LLM JSON:", received_message)
-            self.message = None
-            self.memory_proposal = None
+            envelope = {}
+        self._load(envelope)
+
+    @classmethod
+    def from_envelope(cls, envelope: dict) -> "Response":
+        """ A Response for an envelope that is already parsed, e.g. one channel of a batch. """
+        response = cls.__new__(cls)
+        response._load(envelope)
+        return response
+
+    def _load(self, envelope: dict):
+        # True when the message was already posted while streaming.
+        self.delivered = False
+        # (prompt, cached, completion) tokens, set by streaming requests.
+        self.usage: tuple[int, int, int] | None = None
+        self._msg = envelope
+        self.message = envelope.get("response")
+        self.memory_proposal = envelope.get("context")
+
+
+class BatchResponse:
+    """ Splits a batched completion into one Response per channel.
+    Channels missing from the completion, or not given as objects, get an empty (silent) Response.
+    params:
+        received_message: is expected to be in json format
+        keys: channel ids that were sent in the batch
+    """
+    def __init__(self, received_message: str, keys: list[str]):
+        envelope = parse_envelope(received_message, key="channels")
+        if envelope is None:
+            print("Invalid LLM batch JSON:", received_message)
+            envelope = {}
+
+        channels = envelope.get("channels")
+        if not isinstance(channels, dict):
+            if channels is not None:
+                print("Invalid LLM batch channels:", channels)
+            channels = {}
+
+        self.responses: dict[str, Response] = {}
+        for key in keys:
+            entry = channels.get(key)
+            self.responses[key] = Response.from_envelope(entry if isinstance(entry, dict) else {})
+
+
+def estimate_tokens(text: str) -> int:
+    """ Rough token count (about 4 characters per token), good enough for budgeting. """
+    return len(text) // 4 + 1
+
+
+def channel_scope(channel) -> tuple | None:
+    """ (guild id, channel id, channel name) of a Discord channel, as recorded in the cost ledger. """
+    if channel is None:
+        return None
+    guild = getattr(channel, "guild", None)
+    return guild.id if guild else None, channel.id, channel.name
+
+
+def memory_query(*payloads) -> str:
+    """ Text the relevant memories are searched with: who is talking, about what, and the recent history.
+    params:
+        payloads: payload dicts, or JSON prompts; other prompts are used as they are
+    """
+    parts = []
+    for payload in payloads:
+        if isinstance(payload, str):
+            try:
+                payload = json.loads(payload)
+            except ValueError:
+                parts.append(payload)
+                continue
+        if isinstance(payload, dict):
+            parts += [str(payload[key]) for key in ("author", "message", "command", "history") if payload.get(key)]
+        else:
+            parts.append(str(payload))
+    return "\n".join(parts)
+
+
+def usage_counts(usage, messages: list[dict], text: str | None) -> tuple[int, int, int]:
+    """ (prompt, cached, completion) tokens of a completion, estimated when the provider did not report them. """
+    if usage is None:
+        return sum(estimate_tokens(m["content"]) for m in messages), 0, estimate_tokens(text or "")
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    return usage.prompt_tokens, cached, usage.completion_tokens
+
+
+# Label of the summary line that MessageHistory puts before the raw messages.
+SUMMARY_LABEL = "(summary of earlier messages):"
+
+
+class HistorySession:
+    """ The turns already sent for a channel, so the next prompt only carries the new history lines.
+    The turns are resent as an identical message prefix, which providers serve from their prompt cache
+    as long as the system message before them is unchanged too.
+    """
+
+    def __init__(self, now: float, system: str):
+        # Fingerprint of the system message the turns follow
+        self.system = hash(system)
+        self.turns: list[dict] = []
+        # History lines the turns contain, oldest first
+        self.lines: list[str] = []
+        self.used_at = now
+        # Bumped by every commit, to detect turns taken concurrently
+        self.version = 0
+
+    def delta(self, lines: list[str]) -> list[str] | None:
+        """ The lines not sent yet, or None if the history no longer continues what was sent. """
+        if not self.lines:
+            return None
+        # The oldest lines may have left the history window since: find where the sent ones end.
+        for overlap in range(min(len(lines), len(self.lines)), 0, -1):
+            if lines[:overlap] == self.lines[-overlap:]:
+                return lines[overlap:]
+        return None
+
+    def commit(self, version: int, lines: list[str], prompt: str, reply: str, now: float):
+        if version != self.version:
+            # Another call took a turn meanwhile: the turns no longer match a single conversation.
+            self.turns, self.lines = [], []
+        else:
+            self.turns += [{"role": "user", "content": prompt}, {"role": "assistant", "content": reply}]
+            self.lines += lines
+        self.version += 1
+        self.used_at = now
+
+
+class StreamingEnvelopeParser:
+    """ Incrementally parses the JSON envelope while the completion is streamed.
+    The "response" field is considered complete as soon as its string literal is closed,
+    or as soon as it is known to be null. The "context" field is not needed for that.
+    """
+    _RESPONSE_FIELD = re.compile(r'"response"\s*:\s*(null|"(?:[^"\\]|\\.)*")', re.S)
+
+    def __init__(self):
+        self.buffer = ""
+        self.done = False
+        self.message: str | None = None
+
+    def feed(self, chunk: str) -> bool:
+        """ Adds a chunk of the completion. Returns True once the "response" field is complete. """
+        self.buffer += chunk
+        if not self.done:
+            match = self._RESPONSE_FIELD.search(self.buffer)
+            if match:
+                self.done = True
+                self.message = json.loads(match.group(1))
+
+        return self.done
+
+    @property
+    def is_null(self) -> bool:
+        return self.done and self.message is None
 
 
 class BisbalWrapper():
     def __init__(self, config: Config):
         self.config = config
         self.context: str = config.initial_context
+        # With memory_retrieval, learned memories live here instead of being appended to the context.
+        self.memory = MemoryIndex(config.memory_max_lines)
+        self.circuit_breaker = CircuitBreaker(config.circuit_failure_threshold, config.circuit_cooldown)
+        self.backend = BackendPool.from_config(config)
+        self.ledger = CostLedger.from_config(config)
+        self._compaction: asyncio.Task | None = None
+        # channel id -> turns already sent, with history_sessions
+        self.sessions: dict[int, HistorySession] = {}
 
-    def get_response(self, prompt: str) -> Response:
+    async def get_response(self, prompt: str, trigger: str | None = None, on_message=None, channel=None) -> Response:
+        """ Asks the LLM whether and what to reply.
+        params:
+            prompt: json payload describing the trigger and the conversation
+            trigger: reason why the bot was triggered, selects the deadline, hedging and priority
+            on_message: optional coroutine called with the reply as soon as it is known (streaming mode only)
+            channel: Discord channel the reply is for, recorded in the cost ledger
+        raises:
+            BudgetExceededError: a budget of the channel or trigger is spent
+            CircuitOpenError: the backend is unhealthy and the call was not sent
+            TimeoutError: the trigger deadline expired
+        """
         if not self.config.response_use_llm:
             print("=== LLM DISABLED ===")
             print(prompt)
             print("====================")
             return Response(json.dumps({"response": prompt, "context": None}))
 
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        RESPONSE_RULES +
-                        INTERACTION_RULES +
-                        # DEBUG_REASONING + # Only for manual testing
-                        self.context
+        with tracer.span("llm.get_response", trigger=trigger) as span:
+            scope = channel_scope(channel)
+            self.ledger.check(trigger, scope)
+            messages = self._build_messages(RESPONSE_RULES, prompt, memory_query(prompt))
+            session, lines, sent = self._session_prompt(channel, prompt, messages[0]["content"])
+            version = session.version if session else 0
+            if session:
+                messages = [messages[0], *session.turns, {"role": "user", "content": sent}]
+                span.set("session_turns", len(session.turns) // 2)
+            response = await self._call(messages, trigger, on_message=on_message, channels=[scope])
+            span.set("replied", response.message is not None)
+            if session:
+                reply = json.dumps({"response": response.message, "context": response.memory_proposal}, ensure_ascii=False)
+                session.commit(version, lines, sent, reply, time.monotonic())
+            self.store_context(response)
+            return response
+
+    def _session_prompt(self, channel, prompt: str, system: str) -> tuple[HistorySession | None, list[str], str]:
+        """ With history_sessions, replaces the history of the prompt by the lines the channel's session
+        has not sent yet. A session starts over, with the full history, when it is missing, idle for
+        history_session_ttl, has history_session_max_turns turns, the history diverged from it, or the
+        system message changed (new memories), since its turns would no longer be served from the cache.
+        The summary line is left out: it only covers messages the session turns already hold.
+        returns:
+            the session (None without one), the history lines the prompt carries, and the prompt to send
+        """
+        if not self.config.history_sessions or channel is None:
+            return None, [], prompt
+        try:
+            payload = json.loads(prompt)
+        except ValueError:
+            return None, [], prompt
+        if not isinstance(payload, dict) or not isinstance(payload.get("history"), str):
+            return None, [], prompt
+
+        now = time.monotonic()
+        for key in [key for key, s in self.sessions.items() if now - s.used_at > self.config.history_session_ttl]:
+            del self.sessions[key]
+
+        lines = [line for line in payload["history"].splitlines() if not line.startswith(SUMMARY_LABEL)]
+        session = self.sessions.get(channel.id)
+        delta = None
+        if session and session.system == hash(system) and len(session.turns) < 2 * self.config.history_session_max_turns:
+            delta = session.delta(lines)
+        if delta is None:
+            self.sessions[channel.id] = HistorySession(now, system)
+            return self.sessions[channel.id], lines, prompt
+
+        payload = {key: value for key, value in payload.items() if key != "history"}
+        payload["new_history"] = "\n".join(delta)
+        return session, delta, json.dumps(payload, indent=2, ensure_ascii=False)
+
+    async def get_batch_response(self, payloads: dict[str, dict], trigger: str = "conversation_activity",
+                                 channels: dict | None = None) -> dict[str, Response]:
+        """ Evaluates several channels, packing as many as fit in batch_token_budget into each request.
+        params:
+            payloads: channel id -> payload for that channel
+            trigger: trigger shared by every payload
+            channels: channel id -> Discord channel, recorded in the cost ledger
+        returns:
+            channel id -> Response, for every channel whose batch succeeded and whose budget was not spent
+        """
+        if not self.config.response_use_llm:
+            return {key: await self.get_response(json.dumps(payload, ensure_ascii=False), trigger) for key, payload in payloads.items()}
+
+        scopes = {key: channel_scope((channels or {}).get(key)) for key in payloads}
+        allowed = {key: payload for key, payload in payloads.items() if self.ledger.allows(trigger, scopes[key])}
+        self.ledger.rejected += len(payloads) - len(allowed)
+        payloads = allowed
+
+        batches: list[dict[str, dict]] = []
+        used = 0
+        for key, payload in payloads.items():
+            tokens = estimate_tokens(json.dumps(payload, ensure_ascii=False))
+            if not batches or used + tokens > self.config.batch_token_budget:
+                batches.append({})
+                used = 0
+            batches[-1][key] = payload
+            used += tokens
+
+        results = await asyncio.gather(*(self._batch_request(batch, trigger, scopes) for batch in batches), return_exceptions=True)
+
+        responses: dict[str, Response] = {}
+        for result in results:
+            if isinstance(result, BaseException):
+                print("LLM batch error:", result)
+                continue
+            responses.update(result)
+
+        return responses
+
+    async def _batch_request(self, payloads: dict[str, dict], trigger: str, scopes: dict[str, tuple | None]) -> dict[str, Response]:
+        prompt = json.dumps({"channels": payloads}, indent=2, ensure_ascii=False)
+        messages = self._build_messages(BATCH_RESPONSE_RULES, prompt, memory_query(*payloads.values()))
+        batch = await self._call(messages, trigger, parse=lambda raw: BatchResponse(raw, list(payloads)),
+                                 channels=[scopes[key] for key in payloads])
+        for response in batch.responses.values():
+            self.store_context(response)
+        return batch.responses
+
+    async def summarize(self, summary: str | None, lines: list[str], max_tokens: int) -> str | None:
+        """ Folds messages that left the raw history into the running summary of a channel.
+        params:
+            summary: previous summary, or None
+            lines: formatted messages to fold in, oldest first
+            max_tokens: size limit of the new summary
+        returns:
+            the updated summary, or None if the completion could not be parsed
+        """
+        prompt = json.dumps({"summary": summary, "messages": lines}, indent=2, ensure_ascii=False)
+        if not self.config.response_use_llm:
+            return "\n".join(([summary] if summary else []) + lines)[-max_tokens * 4:]
+
+        messages = [
+            {"role": "system", "content": SUMMARY_RULES},
+            {"role": "user", "content": prompt},
+        ]
+        envelope = await self._call(messages, "summary", parse=lambda raw: parse_envelope(raw, key="summary"), max_tokens=max_tokens)
+        return envelope.get("summary") if envelope else None
+
+    async def compact_context(self) -> bool:
+        """ Condenses the memories appended to the context into a digest shorter than context_compact_length.
+        The persona (initial_context) is kept verbatim, and memories learned while the digest
+        is written are kept after it.
+        returns:
+            whether the context was replaced
+        """
+        persona = self.config.initial_context
+        before = self.context
+        lines = [line for line in before[len(persona):].splitlines() if line.strip()]
+        if not lines:
+            return False
+
+        limit = self.config.context_compact_length
+        with tracer.span("llm.compact", lines=len(lines), chars=len(before) - len(persona)) as span:
+            if self.config.response_use_llm:
+                messages = [
+                    {"role": "system", "content": COMPACTION_RULES.format(max_chars=limit)},
+                    {"role": "user", "content": "\n".join(lines)},
+                ]
+                envelope = await self._call(messages, "compaction", parse=lambda raw: parse_envelope(raw, key="memory"),
+                                            max_tokens=limit // 4)
+                digest = (envelope or {}).get("memory")
+            else:
+                digest = "\n".join(lines)[-limit:]
+            if not digest:
+                return False
+
+            if len(digest) > limit:
+                # Cut at a line boundary rather than mid-fact
+                digest = digest[:limit].rsplit("\n", 1)[0]
+            if not self.context.startswith(before):
+                # The context was reset or restored meanwhile
+                return False
+
+            self.context = f"{persona}\n{digest.strip()}{self.context[len(before):]}"
+            span.set("digest_chars", len(digest))
+            print(f"Context compacted from {len(before)} to {len(self.context)} characters")
+            return True
+
+    def _start_compaction(self) -> bool:
+        """ Compacts the context in the background. False if it has to be reset instead. """
+        if not self.config.context_compaction or not self.context.startswith(self.config.initial_context):
+            return False
+        if len(self.context) > 2 * self.config.max_context_length:
+            # Compaction keeps failing or falls behind
+            return False
+        if self._compaction is None or self._compaction.done():
+            self._compaction = asyncio.create_task(self._compact())
+        return True
+
+    async def _compact(self):
+        try:
+            await self.compact_context()
+        except Exception as e:
+            # The next stored memory tries again
+            print("Context compaction error:", e)
+
+    def _build_messages(self, response_rules: str, prompt: str, query: str = "") -> list[dict]:
+        """ The static persona goes first so it stays a cacheable prefix;
+        with memory_retrieval, only the memories relevant to the query follow it.
+        """
+        return [
+            {
+                "role": "system",
+                "content": (
+                    response_rules +
+                    INTERACTION_RULES +
+                    # DEBUG_REASONING + # Only for manual testing
+                    self.context +
+                    self._relevant_memories(query)
+                )
+            },
+            {"role": "user", "content": prompt}
+        ]
+
+    def _relevant_memories(self, query: str) -> str:
+        if not self.config.memory_retrieval:
+            return ""
+        memories = self.memory.search(query, self.config.memory_top_k)
+        if not memories:
+            return ""
+        return "\n\nRelevant memories:\n" + "\n".join(memories)
+
+    async def _call(self, messages: list[dict], trigger: str | None, on_message=None, parse=None, max_tokens: int | None = None,
+                    channels: list[tuple | None] | None = None):
+        """ Sends the request through the circuit breaker, under the trigger deadline.
+        channels are the ledger scopes the request is made for; its cost is split evenly between them.
+        """
+        if trigger in self.config.low_priority_triggers and self.circuit_breaker.degraded:
+            raise CircuitOpenError(f"LLM backend unhealthy, shedding '{trigger}' trigger")
+
+        if not self.circuit_breaker.allow():
+            raise CircuitOpenError("LLM backend circuit is open")
+
+        deadline = self.config.llm_deadlines.get(trigger, self.config.llm_default_deadline)
+        try:
+            async with asyncio.timeout(deadline):
+                return await self._request_with_retries(messages, trigger, on_message, parse, max_tokens, channels)
+        except TimeoutError:
+            self.circuit_breaker.record_failure()
+            raise
+
+    async def _request_with_retries(self, messages: list[dict], trigger: str | None, on_message=None, parse=None,
+                                    max_tokens: int | None = None, channels: list[tuple | None] | None = None):
+        """ Sends the request, retrying transient errors with jittered backoff.
+        Hedged triggers send a second request when the first one is slow; only one of them may post.
+        A request that already posted its reply is never retried.
+        """
+        attempts = 0
+        poster = None
+
+        def request():
+            nonlocal attempts
+            attempts += 1
+            attempt = attempts
+
+            async def post(message: str):
+                nonlocal poster
+                if poster not in (None, attempt):
+                    # The other hedged request already posted: give up on this one.
+                    raise HedgeLostError()
+                poster = attempt
+                if on_message is not None:
+                    await on_message(message)
+
+            return self._request(messages, post, parse, max_tokens, trigger, channels)
+
+        for retry in range(self.config.llm_max_retries + 1):
+            if retry > 0:
+                await asyncio.sleep(backoff_delay(retry - 1, self.config.llm_retry_base_delay, self.config.llm_retry_max_delay))
+
+            try:
+                if trigger in self.config.hedge_triggers:
+                    response = await hedged(lambda _: request(), self.config.hedge_delay)
+                else:
+                    response = await request()
+            except TRANSIENT_ERRORS as e:
+                self.circuit_breaker.record_failure()
+                if poster is not None or retry == self.config.llm_max_retries or not self.circuit_breaker.allow():
+                    raise
+                print(f"LLM transient error, retrying: {e}")
+                continue
+            except BaseException:
+                # Cancelled, or a failure that says nothing about the backend health: a probe must not stay pending.
+                self.circuit_breaker.release()
+                raise
+
+            self.circuit_breaker.record_success()
+            return response
+
+    async def _request(self, messages: list[dict], on_message=None, parse=None, max_tokens: int | None = None,
+                       trigger: str | None = None, channels: list[tuple | None] | None = None):
+        """ Sends one request to an endpoint of the pool and records it in the cost ledger.
+        parse turns the raw completion into the result; it defaults to Response, which may be streamed.
+        """
+        start = time.perf_counter()
+        streamed = parse is None and self.config.stream_response
+        route = Route.for_trigger(self.config, trigger)
+        async with self.backend.lease() as endpoint:
+            options = route.request_options(self.config, endpoint, max_tokens)
+            with tracer.span("llm.request", endpoint=endpoint.name, model=options["model"],
+                             max_tokens=options["max_tokens"], temperature=options["temperature"]) as span:
+                if streamed:
+                    span.set("stream", True)
+                    result = await self._stream_response(endpoint, messages, on_message, options)
+                    usage = result.usage
+                else:
+                    completion = await endpoint.get_client().chat.completions.create(
+                        messages=messages,
+                        **options,
+                        **self._response_format(endpoint),
                     )
-                },
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=self.config.max_tokens_response,
-            temperature=0.9,
+                    raw = completion.choices[0].message.content
+                    usage = usage_counts(getattr(completion, "usage", None), messages, raw)
+                span.set("prompt_tokens", usage[0])
+                span.set("completion_tokens", usage[2])
+
+            if not streamed:
+                with tracer.span("llm.parse", length=len(raw or "")):
+                    result = (parse or Response)(raw)
+
+        self._record(trigger, channels or [None], options["model"], usage, time.perf_counter() - start, result)
+        return result
+
+    def _record(self, trigger: str | None, channels: list[tuple | None], model: str,
+                usage: tuple[int, int, int], latency: float, result):
+        """ Records a request in the ledger, splitting its tokens evenly between the channels it served. """
+        if isinstance(result, BatchResponse):
+            nulls = [response.message is None for response in result.responses.values()]
+        elif isinstance(result, Response):
+            nulls = [result.message is None]
+        else:
+            nulls = [result is None]
+
+        shares = [divmod(tokens, len(channels)) for tokens in usage]
+        for i, (scope, is_null) in enumerate(zip(channels, nulls)):
+            # The first channel takes the remainder so the totals add up.
+            prompt, cached, completion = (share + (rest if i == 0 else 0) for share, rest in shares)
+            self.ledger.record(trigger, scope, model, prompt, cached, completion, latency, is_null)
+
+    async def _stream_response(self, endpoint, messages: list[dict], on_message, options: dict) -> Response:
+        """ Streams the completion, stopping as soon as the reply is known to be null
+        and handing the reply to on_message before the "context" field is generated.
+        options are the route settings of the request (model, max_tokens, temperature, timeout).
+        """
+        stream = await endpoint.get_client().chat.completions.create(
+            messages=messages,
+            **options,
+            stream=True,
+            **self._response_format(endpoint),
+            **self._stream_options(endpoint),
         )
-        
-        raw = completion.choices[0].message.content
-        response = Response(raw)
-        self.store_context(response)
+
+        parser = StreamingEnvelopeParser()
+        delivered = False
+        usage = None
+        try:
+            async for chunk in stream:
+                # Providers asked for it report the usage in a last chunk without choices.
+                usage = getattr(chunk, "usage", None) or usage
+                if not chunk.choices:
+                    continue
+
+                delta = chunk.choices[0].delta.content
+                if not delta or not parser.feed(delta):
+                    continue
+
+                if parser.is_null:
+                    # Nothing to say: stop paying for the rest of the envelope.
+                    response = Response(json.dumps({"response": None, "context": None}))
+                    response.usage = usage_counts(None, messages, parser.buffer)
+                    return response
+
+                if not delivered and on_message is not None:
+                    # Its start marks when the reply was known, before the rest of the envelope.
+                    with tracer.span("llm.deliver", length=len(parser.message or "")):
+                        await on_message(parser.message)
+                    delivered = True
+        finally:
+            await stream.close()
+
+        response = Response(parser.buffer)
+        if response.message is None and parser.done:
+            # Keep the reply even if the envelope got truncated after it.
+            response.message = parser.message
+
+        response.delivered = delivered
+        response.usage = usage_counts(usage, messages, parser.buffer)
         return response
 
+    @staticmethod
+    def _stream_options(endpoint) -> dict:
+        """ Asks endpoints that support it to report the token usage of streamed completions. """
+        if endpoint.stream_usage:
+            return {"stream_options": {"include_usage": True}}
+        return {}
+
+    @staticmethod
+    def _response_format(endpoint) -> dict:
+        """ Requests the provider's JSON mode on endpoints that support it. """
+        if endpoint.json_mode:
+            return {"response_format": {"type": "json_object"}}
+        return {}
+
+    async def warm_up(self):
+        """ Opens the connections to the LLM endpoints before the first trigger needs them. """
+        if not self.config.response_use_llm:
+            return
+        start = time.perf_counter()
+        warmed = await self.backend.warm_up()
+        print(f"LLM connections warmed up: {warmed}/{len(self.backend.endpoints)} endpoints in {time.perf_counter() - start:.2f}s")
+
+    async def keep_warm(self, sleep=asyncio.sleep):
+        """ Keeps the LLM connections open through quiet periods. Runs until cancelled. """
+        if self.config.response_use_llm and self.config.llm_keepalive_interval:
+            await self.backend.keep_warm(self.config.llm_keepalive_interval, sleep)
+
+    async def close(self):
+        self.ledger.flush()
+        await self.backend.aclose()
+
+    def snapshot(self) -> dict:
+        """ Learned memory, to checkpoint. """
+        return {"context": self.context, "memories": self.memory.texts()}
+
+    def restore(self, state: dict):
+        self.context = state["context"]
+        for line in state["memories"]:
+            self.memory.add(line)
+
     def store_context(self, response: Response):
-        # Clear memory if context gets too big. Under investigation.
-        # This is done before saving the next proposal in order to remember the last interacion.
-        if len(self.context) > self.config.max_context_length:
+        if self.config.memory_retrieval:
+            if response.memory_proposal:
+                self.memory.add(response.memory_proposal)
+            return
+
+        # Past the high-water mark the memories are compacted in the background; if that is off or
+        # not possible, the context is cleared. This is done before saving the next proposal
+        # in order to remember the last interacion.
+        if len(self.context) > self.config.max_context_length and not self._start_compaction():
             self.context = self.config.initial_context
         
         if response.memory_proposal is not None:
@@ -168,7 +819,7 @@ if __name__ == "__main__":
             break
 
         try:
-            response = bot.get_response(user_input)
+            response = asyncio.run(bot.get_response(user_input))
             print(response._msg)
             print(f"\033[92mBisbal: {response.message}\033[0m\n")
         except Exception as e:
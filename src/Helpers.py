@@ -1,7 +1,86 @@
+import math
+import time
 import discord
 import asyncio
+import contextlib
 import json
 from collections import deque # ring buffer
+from Gating import Gate, ShortCircuit
+from Normalizer import MessageNormalizer
+from Dispatcher import OutboundDispatcher
+from Tracing import tracer
+
+
+class HistorySummarizer:
+    """
+    Keeps a running summary per channel of the messages that left the raw history.
+
+    Evicted messages are queued and folded into the summary by a background
+    task, `batch_size` messages per LLM call, so summarization never delays
+    a triggered reply.
+    """
+
+    def __init__(self, llm, batch_size: int = 5, max_tokens: int = 200):
+        """
+        Initialize the summarizer.
+
+        Args:
+            llm: Object exposing `async summarize(summary, lines, max_tokens)`.
+            batch_size: Evicted messages needed before a summary update.
+            max_tokens: Size limit of each summary.
+        """
+        self.llm = llm
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        # channel_id -> summary
+        self.summaries: dict[int, str] = {}
+        # channel_id -> formatted messages waiting to be summarized
+        self.pending: dict[int, list[str]] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def push(self, channel_id: int, line: str) -> None:
+        """
+        Queue a message that left the raw history and start a summary update
+        in the background once a full batch is waiting.
+        """
+        pending = self.pending.setdefault(channel_id, [])
+        pending.append(line)
+        # If the LLM keeps failing, forget the oldest lines rather than grow without limit.
+        del pending[:-self.batch_size * 4]
+
+        task = self._tasks.get(channel_id)
+        if len(pending) >= self.batch_size and (task is None or task.done()):
+            self._tasks[channel_id] = asyncio.create_task(self._run(channel_id))
+
+    def get(self, channel_id: int) -> str | None:
+        return self.summaries.get(channel_id)
+
+    def snapshot(self) -> dict:
+        return {"summaries": self.summaries, "pending": self.pending}
+
+    def restore(self, state: dict) -> None:
+        self.summaries = {int(channel_id): summary for channel_id, summary in state["summaries"].items()}
+        self.pending = {int(channel_id): lines for channel_id, lines in state["pending"].items()}
+
+    async def _run(self, channel_id: int):
+        pending = self.pending[channel_id]
+        while len(pending) >= self.batch_size:
+            lines = pending[:self.batch_size]
+            del pending[:self.batch_size]
+            try:
+                summary = await self.llm.summarize(self.summaries.get(channel_id), lines, self.max_tokens)
+            except Exception as e:
+                print("Summary error:", e)
+                # Retry with the next batch.
+                pending[:0] = lines
+                return
+
+            if summary:
+                self.summaries[channel_id] = summary
+
+    def cancel(self):
+        for task in self._tasks.values():
+            task.cancel()
 
 
 class MessageHistory:
@@ -10,18 +89,27 @@ class MessageHistory:
 
     The history is maintained as a fixed-size queue (FIFO) per channel,
     keeping only the most recent messages up to a configured limit.
+    With a summarizer, messages leaving the queue are folded into a
+    running summary that precedes the raw messages.
     """
 
-    def __init__(self, max_messages: int = 20):
+    def __init__(self, max_messages: int = 20, normalizer: MessageNormalizer | None = None,
+                 summarizer: HistorySummarizer | None = None, clock=time.monotonic):
         """
         Initialize the message history container.
 
         Args:
             max_messages: Maximum number of messages to keep per channel.
+            normalizer: Rewrites message markup before it is stored.
+            summarizer: Summarizes messages evicted from the history, if any.
+            clock: Callable returning the current time in seconds, stamped on each stored message.
         """
         self.max_messages = max_messages
-        # channel_id -> deque[(author, content)]
-        self.history: dict[int, deque[tuple[str, str]]] = {}
+        self.normalizer = normalizer or MessageNormalizer()
+        self.summarizer = summarizer
+        self.clock = clock
+        # channel_id -> deque[(author, content, stored_at, message_id)]
+        self.history: dict[int, deque[tuple[str, str, float, int]]] = {}
 
     def add(self, message: discord.Message, is_self: bool = False) -> None:
         """
@@ -29,6 +117,7 @@ class MessageHistory:
 
         If the channel does not yet have a history, it is created.
         When the maximum size is reached, older messages are discarded.
+        The content is normalized once here, so every prompt reuses the short form.
 
         Args:
             message: Discord message to store.
@@ -37,15 +126,93 @@ class MessageHistory:
         if channel_id not in self.history:
             self.history[channel_id] = deque(maxlen=self.max_messages)
 
+        messages = self.history[channel_id]
+        if self.summarizer and len(messages) == messages.maxlen:
+            author, content, _, _ = messages[0]
+            self.summarizer.push(channel_id, f"{author}: {content}")
+
+        messages.append(self._entry(message, is_self))
+
+    def backfill(self, channel_id: int, messages: list[tuple[discord.Message, bool]]) -> None:
+        """
+        Insert older messages before the ones already stored for a channel.
+
+        Only as many messages as there is room for are kept (the newest ones),
+        so messages received while backfilling are never pushed out. Messages
+        already stored, or not older than the oldest stored one, are skipped.
+
+        Args:
+            channel_id: Discord channel identifier.
+            messages: (message, is_self) pairs, oldest first.
+        """
+        current = list(self.history.get(channel_id, []))
+        oldest = self.oldest_id(channel_id)
+        messages = [(message, is_self) for message, is_self in messages if oldest is None or message.id < oldest]
+        room = self.max_messages - len(current)
+        older = [self._entry(message, is_self) for message, is_self in messages[-room:]] if room > 0 else []
+        self.history[channel_id] = deque(older + current, maxlen=self.max_messages)
+
+    def oldest_id(self, channel_id: int) -> int | None:
+        """
+        Id of the oldest stored message of a channel, or None if there is none.
+        """
+        messages = self.history.get(channel_id)
+        return min(message_id for *_, message_id in messages) if messages else None
+
+    def _entry(self, message: discord.Message, is_self: bool) -> tuple[str, str, float, int]:
         author = (f"{message.author.display_name} (you)" if is_self else message.author.display_name)
-        self.history[channel_id].append((author, message.content))
+        return author, self.normalizer.normalize_message(message), self.clock(), message.id
+
+    def snapshot(self) -> dict:
+        """
+        State to checkpoint. Timestamps are saved as ages, since clocks restart with the process.
+        """
+        now = self.clock()
+        return {
+            "history": {
+                channel_id: [(author, content, now - stored_at, message_id)
+                             for author, content, stored_at, message_id in messages]
+                for channel_id, messages in self.history.items()
+            },
+            "summarizer": self.summarizer.snapshot() if self.summarizer else None,
+        }
+
+    def restore(self, state: dict, elapsed: float = 0.0) -> None:
+        """
+        Restore a checkpoint taken `elapsed` seconds ago.
+        """
+        now = self.clock()
+        self.history = {
+            int(channel_id): deque(
+                ((author, content, now - age - elapsed, message_id) for author, content, age, message_id in messages),
+                maxlen=self.max_messages,
+            )
+            for channel_id, messages in state["history"].items()
+        }
+        if self.summarizer and state.get("summarizer"):
+            self.summarizer.restore(state["summarizer"])
+
+    def last_activity(self, channel_id: int) -> float | None:
+        """
+        Time at which the newest message of a channel was stored, or None if there is none.
+        """
+        messages = self.history.get(channel_id)
+        return messages[-1][2] if messages else None
+
+    def last_is_self(self, channel_id: int) -> bool:
+        """
+        Whether the newest stored message of a channel was written by the bot.
+        """
+        messages = self.history.get(channel_id)
+        return bool(messages) and messages[-1][0].endswith(" (you)")
 
     def get_formatted(self, channel_id: int) -> str:
         """
         Retrieve the formatted message history for a channel.
 
         Messages are returned as a single string in chronological order,
-        formatted as '<author>: <message>' per line.
+        formatted as '<author>: <message>' per line, preceded by the summary
+        of older messages when there is one.
 
         Args:
             channel_id: Discord channel identifier.
@@ -57,10 +224,16 @@ class MessageHistory:
         if channel_id not in self.history:
             return ""
 
-        return "\n".join(
+        lines = [
             f"{author}: {message}"
-            for author, message in self.history[channel_id]
-        )
+            for author, message, _, _ in self.history[channel_id]
+        ]
+
+        summary = self.summarizer.get(channel_id) if self.summarizer else None
+        if summary:
+            lines.insert(0, f"(summary of earlier messages): {summary}")
+
+        return "\n".join(lines)
 
 
 class MessageCounter:
@@ -69,18 +242,39 @@ class MessageCounter:
 
     Intended for rate limiting or triggering actions after a certain
     number of messages have been received.
+
+    With a target rate, the threshold of each channel adapts to its traffic:
+    an exponentially weighted message rate is tracked per channel and the
+    threshold is the number of messages that arrive, at that rate, between
+    two joins when joining `target_per_hour` times per hour. Until a channel
+    has been observed for one half-life, its estimate is too young to trust
+    and the fixed `max_messages` threshold applies.
     """
 
-    def __init__(self, max_messages: int = 10):
+    def __init__(self, max_messages: int = 10, target_per_hour: float | None = None,
+                 bounds: tuple[int, int] = (3, 60), half_life: float = 600, clock=time.monotonic):
         """
         Initialize the message counter.
 
         Args:
-            max_messages: Number of messages required to trigger the limit.
+            max_messages: Number of messages required to trigger the limit, without a target rate.
+            target_per_hour: Limits per channel and hour to aim for. None keeps the threshold fixed.
+            bounds: Lowest and highest adaptive threshold.
+            half_life: Seconds after which a message weighs half as much in the rate estimate.
+            clock: Callable returning the current time in seconds.
         """
         self.max_messages = max_messages
+        self.target_per_hour = target_per_hour
+        self.bounds = bounds
+        self.half_life = half_life
+        self.tau = half_life / math.log(2)
+        self.clock = clock
         # channel_id -> count
         self.counter: dict[int, int] = {}
+        # channel_id -> (decayed message count, time it was computed)
+        self.weights: dict[int, tuple[float, float]] = {}
+        # channel_id -> time the rate estimate started
+        self.since: dict[int, float] = {}
 
     def increment(self, channel_id: int) -> bool:
         """
@@ -94,7 +288,52 @@ class MessageCounter:
             False otherwise.
         """
         self.counter[channel_id] = self.counter.get(channel_id, 0) + 1
-        return self.counter[channel_id] >= self.max_messages
+        if self.target_per_hour:
+            self.since.setdefault(channel_id, self.clock())
+            self.weights[channel_id] = (self._weight(channel_id) + 1, self.clock())
+        return self.counter[channel_id] >= self.threshold(channel_id)
+
+    def rate(self, channel_id: int) -> float:
+        """
+        Estimated messages per hour in a channel.
+        """
+        age = self.clock() - self.since.get(channel_id, self.clock())
+        if age <= 0:
+            return 0.0
+        # A steady rate only builds up 1 - e^(-age/tau) of its full weight after `age` seconds.
+        return self._weight(channel_id) / (self.tau * -math.expm1(-age / self.tau)) * 3600
+
+    def threshold(self, channel_id: int) -> int:
+        """
+        Messages required to trigger the limit in a channel.
+        """
+        if not self.target_per_hour:
+            return self.max_messages
+        since = self.since.get(channel_id)
+        if since is None or self.clock() - since < self.half_life:
+            return self.max_messages
+        low, high = self.bounds
+        return max(low, min(high, round(self.rate(channel_id) / self.target_per_hour)))
+
+    def _weight(self, channel_id: int) -> float:
+        weight, updated = self.weights.get(channel_id, (0.0, self.clock()))
+        return weight * math.exp(-(self.clock() - updated) / self.tau)
+
+    def snapshot(self) -> dict:
+        """
+        Rate estimates to checkpoint, as (weight, seconds observed) since clocks restart with the process.
+        """
+        now = self.clock()
+        return {channel_id: (self._weight(channel_id), now - self.since[channel_id]) for channel_id in self.weights}
+
+    def restore(self, state: dict, elapsed: float = 0.0) -> None:
+        """
+        Restore rate estimates checkpointed `elapsed` seconds ago. The downtime counts as silence.
+        """
+        now = self.clock()
+        for channel_id, (weight, observed) in state.items():
+            self.weights[int(channel_id)] = (weight * math.exp(-elapsed / self.tau), now)
+            self.since[int(channel_id)] = now - observed - elapsed
 
     def reset(self, channel_id: int) -> None:
         """
@@ -114,29 +353,47 @@ class InactiveTimer:
     Only one timer task is active at any given time.
     """
 
-    def __init__(self, seconds: int, callback):
+    def __init__(self, seconds: int, callback, sleep=asyncio.sleep, clock=time.monotonic):
         """
         Initialize the inactivity timer.
 
         Args:
             seconds: Duration of inactivity before triggering the callback.
             callback: Asynchronous callable executed when the timer expires.
+            sleep: Coroutine function used to wait, e.g. the sleep of a virtual clock.
+            clock: Callable returning the current time in seconds, following `sleep`.
         """
         self.seconds = seconds
         self.callback = callback
+        self.sleep = sleep
+        self.clock = clock
+        self.deadline: float | None = None
         self._task: asyncio.Task | None = None
 
-    def init(self):
-        self.reset()
+    def init(self, seconds: float | None = None):
+        self.reset(seconds)
 
-    def reset(self):
+    def reset(self, seconds: float | None = None):
         """
         Reset the timer and restart the inactivity countdown.
 
         Any existing timer task is cancelled before starting a new one.
+
+        Args:
+            seconds: Countdown, if not the full inactivity period (e.g. what was left before a restart).
         """
         self.cancel()
-        self._task = asyncio.create_task(self._run())
+        seconds = self.seconds if seconds is None else seconds
+        self.deadline = self.clock() + seconds
+        self._task = asyncio.create_task(self._run(seconds))
+
+    def remaining(self) -> float | None:
+        """
+        Seconds until the callback runs, or None if the timer is not armed.
+        """
+        if self._task is None or self._task.done():
+            return None
+        return max(0.0, self.deadline - self.clock())
 
     def cancel(self):
         """
@@ -145,13 +402,13 @@ class InactiveTimer:
         if self._task and not self._task.done():
             self._task.cancel()
 
-    async def _run(self):
+    async def _run(self, seconds: float):
         """
         Internal coroutine that waits for the inactivity period
         and executes the callback if not cancelled.
         """
         try:
-            await asyncio.sleep(self.seconds)
+            await self.sleep(seconds)
             await self.callback()
         except asyncio.CancelledError:
             pass
@@ -160,15 +417,75 @@ class DiscordMessageHandler:
     """
     Handles incoming messages and sends the bot's response back to Discord.
     """
-    def __init__(self, llm):
+    def __init__(self, llm, normalizer: MessageNormalizer | None = None, dispatcher: OutboundDispatcher | None = None):
         self.llm = llm
+        self.shortcut = ShortCircuit.from_config(llm.config)
+        self.gate = Gate.from_config(llm.config)
+        self.normalizer = normalizer or MessageNormalizer()
+        self.dispatcher = dispatcher or OutboundDispatcher.from_config(llm.config)
 
-    async def handle(self,message: discord.Message, trigger: str, history: str):
-        content = message.content
-        for user in message.mentions:
-            content = content.replace(f"<@{user.id}>", "").replace(f"<@!{user.id}>", "")
+    async def _respond(self, channel, payload: dict, indent: int | None = 2, last_is_self: bool = False):
+        """
+        Sends the payload to the LLM and queues the reply, if any, for the channel.
 
-        content = content.strip()
+        Speculative triggers may be skipped by the local rules or the gate before any call.
+        Triggers listed in `typing_triggers` show the typing indicator until the
+        reply is posted. In streaming mode the reply is posted as soon as it is
+        complete, without waiting for the rest of the completion.
+
+        Args:
+            channel: Discord channel where the reply is posted.
+            payload: Trigger and conversation data for the LLM.
+            indent: JSON indentation of the prompt.
+            last_is_self: Whether the bot wrote the newest message of the channel history.
+
+        Returns:
+            The LLM response, or None if the call was skipped or failed.
+        """
+        trigger = payload["trigger"]
+        with tracer.span("handler.respond", trigger=trigger, channel=channel.id) as span:
+            reason = self.shortcut.skip_reason(payload, channel.id, last_is_self)
+            if reason:
+                print(f"Skipped '{trigger}' in {channel.name}: {reason}")
+                span.set("skipped", reason)
+                return None
+
+            if not self.gate.should_call(payload):
+                print(f"Gate: skipped '{trigger}' in {channel.name}")
+                span.set("skipped", "gate")
+                return None
+
+            with tracer.span("prompt.serialize"):
+                prompt = json.dumps(payload, indent=indent, ensure_ascii=False)
+            print("Send: " + prompt)
+            async with contextlib.AsyncExitStack() as typing:
+                if trigger in self.llm.config.typing_triggers:
+                    await typing.enter_async_context(channel.typing())
+
+                async def post(message: str):
+                    await typing.aclose()
+                    self.dispatcher.enqueue(channel, message)
+
+                try:
+                    response = await self.llm.get_response(prompt, trigger=trigger, on_message=post, channel=channel)
+                except Exception as e:
+                    print("LLM error:", e)
+                    span.set("error", repr(e))
+                    return None
+
+            self.shortcut.record(payload, channel.id)
+            self.gate.record(payload, was_null=response.message is None)
+            print(f"Response context: {response.memory_proposal}")
+            print(f"\033[92mResponse message: {response.message}\033[0m")
+            span.set("replied", bool(response.message))
+
+            if response.message and not response.delivered:
+                self.dispatcher.enqueue(channel, response.message)
+
+            return response
+
+    async def handle(self,message: discord.Message, trigger: str, history: str):
+        content = self.normalizer.normalize_message(message)
         payload = {
             "trigger": trigger,
             "channel_name": message.channel.name,
@@ -177,19 +494,7 @@ class DiscordMessageHandler:
             "history": history
         }
 
-        prompt = json.dumps(payload, indent=2, ensure_ascii=False)
-        print("Send: " + prompt)
-        try:
-            response = self.llm.get_response(prompt)
-        except Exception as e:
-            print("LLM error:", e)
-            return
-
-        print(f"Response context: {response.memory_proposal}")
-        print(f"\033[92mResponse message: {response.message}\033[0m")
-        
-        if response.message:
-            await message.channel.send(response.message)
+        await self._respond(message.channel, payload)
 
     async def handle_inactive(self, bot):
         """
@@ -211,24 +516,16 @@ class DiscordMessageHandler:
             "history": history
         }
 
-        prompt = json.dumps(payload, indent=2, ensure_ascii=False)
-        print("Send: " + prompt)
-        try:
-            response = self.llm.get_response(prompt)
-        except Exception as e:
-            print("LLM error:", e)
-            return
-
-        print(f"Response context: {response.memory_proposal}")
-        print(f"\033[92mResponse message: {response.message}\033[0m")
-
-        if response.message:
-            await channel.send(response.message)
+        await self._respond(channel, payload, last_is_self=bot.message_history.last_is_self(channel.id))
 
     async def handle_conversation_activity(self, bot, active_channels: set[int]):
         """
         Handles detected conversation activity in a channel.
+
+        With `batch_conversation_activity` enabled, all active channels are
+        evaluated together in as few LLM requests as possible.
         """
+        targets = []
         for channel_id in active_channels:
             channel = discord.utils.get(bot.get_all_channels(), id=channel_id)
             if not channel:
@@ -240,20 +537,51 @@ class DiscordMessageHandler:
                 "trigger": "conversation_activity",
                 "history": history
             }
+            targets.append((channel, payload, bot.message_history.last_is_self(channel_id)))
 
-            prompt = json.dumps(payload, indent=2, ensure_ascii=False)
-            print("Send: " + prompt)
-            try:
-                response = self.llm.get_response(prompt)
-            except Exception as e:
-                print("LLM error:", e)
-                return
+        if self.llm.config.batch_conversation_activity and len(targets) > 1:
+            await self._respond_batch(targets)
+            return
 
-            print(f"Response context: {response.memory_proposal}")
-            print(f"\033[92mResponse message: {response.message}\033[0m")
+        for channel, payload, last_is_self in targets:
+            await self._respond(channel, payload, last_is_self=last_is_self)
+
+    async def _respond_batch(self, targets: list[tuple]):
+        """
+        Evaluates several channels with batched LLM requests and posts each reply in its channel.
+
+        Args:
+            targets: (channel, payload, last_is_self) triples sharing the same trigger.
+        """
+        by_key = {
+            str(channel.id): (channel, payload)
+            for channel, payload, last_is_self in targets
+            if not self.shortcut.skip_reason(payload, channel.id, last_is_self) and self.gate.should_call(payload)
+        }
+        if not by_key:
+            return
+
+        trigger = targets[0][1]["trigger"]
+        print(f"Send batch: {trigger} in {len(by_key)} channels")
+        try:
+            with tracer.span("handler.respond_batch", trigger=trigger, channels=len(by_key)):
+                responses = await self.llm.get_batch_response(
+                    {key: payload for key, (_, payload) in by_key.items()}, trigger=trigger,
+                    channels={key: channel for key, (channel, _) in by_key.items()},
+                )
+        except Exception as e:
+            print("LLM error:", e)
+            return
+
+        for key, response in responses.items():
+            channel, payload = by_key[key]
+            self.shortcut.record(payload, channel.id)
+            self.gate.record(payload, was_null=response.message is None)
+            print(f"Response context ({channel.name}): {response.memory_proposal}")
+            print(f"\033[92mResponse message ({channel.name}): {response.message}\033[0m")
 
             if response.message:
-                await channel.send(response.message)
+                self.dispatcher.enqueue(channel, response.message)
 
     async def handle_command(self, bot, target_channel, prompt: str):
         history = bot.message_history.get_formatted(target_channel.id)
@@ -262,19 +590,9 @@ class DiscordMessageHandler:
             "command": prompt,
             "history": history,
         }
-        prompt = json.dumps(payload, ensure_ascii=False)
-        print("Send: " + prompt)
-        try:
-            response = self.llm.get_response(prompt)
-        except Exception as e:
-            print("LLM error:", e)
-            return
-
-        print(f"Response context: {response.memory_proposal}")
-        print(f"\033[92mResponse message: {response.message}\033[0m")
+        response = await self._respond(target_channel, payload, indent=None)
 
-        if response.message:
-            await target_channel.send(response.message)
+        if response and response.message:
             return response.message
 
         return "None"
@@ -285,9 +603,10 @@ class ConversationWatcher:
     in any channel since the last check.
     """
 
-    def __init__(self, seconds: int, callback):
+    def __init__(self, seconds: int, callback, sleep=asyncio.sleep):
         self.seconds = seconds
         self.callback = callback
+        self.sleep = sleep
         self._active_channels: set[int] = set()
         self._task: asyncio.Task | None = None
 
@@ -300,6 +619,9 @@ class ConversationWatcher:
     def is_active(self, channel_id: int) -> bool:
         return channel_id in self._active_channels
 
+    def active_channels(self) -> set[int]:
+        return self._active_channels.copy()
+
     def start(self):
         if not self._task:
             self._task = asyncio.create_task(self._run())
@@ -311,7 +633,7 @@ class ConversationWatcher:
     async def _run(self):
         try:
             while True:
-                await asyncio.sleep(self.seconds)
+                await self.sleep(self.seconds)
                 if self._active_channels:
                     await self.callback(self._active_channels.copy())
                     self._active_channels.clear()
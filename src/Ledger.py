@@ -0,0 +1,225 @@
+import sys
+import time
+import sqlite3
+import argparse
+from collections import Counter
+from pathlib import Path
+from Config import Config
+
+# Budget period -> strftime format of the period key (UTC).
+PERIODS = {"daily": "%Y-%m-%d", "monthly": "%Y-%m"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS calls (
+    ts REAL NOT NULL,
+    guild INTEGER,
+    channel_id INTEGER,
+    channel TEXT,
+    trigger TEXT,
+    model TEXT,
+    prompt_tokens INTEGER,
+    cached_tokens INTEGER,
+    completion_tokens INTEGER,
+    latency REAL,
+    is_null INTEGER,
+    cost REAL
+)
+"""
+
+
+class BudgetExceededError(Exception):
+    """ The call was not sent because a budget of its channel or trigger is spent. """
+
+
+class CostLedger:
+    """
+    Records every LLM call in a SQLite table and enforces spend budgets.
+
+    Calls are buffered and written `flush_size` at a time. The spend of the
+    current day and month is also kept in memory, per channel and trigger,
+    so checking a budget never touches the database.
+
+    A budget is a dict like {"channel": "general", "trigger": "*", "daily": 0.5, "monthly": 10}:
+    "*" matches every channel or trigger, and the limits (USD) apply to their combined spend.
+    """
+
+    def __init__(self, path: str | None = None, prices: dict | None = None, budgets: list[dict] | None = None,
+                 flush_size: int = 20, clock=time.time):
+        """
+        Args:
+            path: SQLite file. None keeps the ledger in memory.
+            prices: model -> [input, cached input, output] USD per million tokens.
+            budgets: Spend limits, see the class docstring.
+            flush_size: Calls buffered before they are written.
+            clock: Callable returning the current UNIX time.
+        """
+        self.path = path
+        self.prices = prices or {}
+        self.budgets = budgets or []
+        self.flush_size = flush_size
+        self.clock = clock
+        self.pending: list[tuple] = []
+        # (period key, channel, trigger) -> USD
+        self.spend: Counter = Counter()
+        self.rejected = 0
+
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path or ":memory:")
+        if path:
+            # Appends do not wait for a full fsync.
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(_SCHEMA)
+        self._load_spend()
+
+    @classmethod
+    def from_config(cls, config: Config) -> "CostLedger":
+        return cls(config.ledger_file, config.llm_prices, config.llm_budgets, config.ledger_flush_size)
+
+    def cost(self, model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+        """ USD cost of a call. Models without a price cost nothing. """
+        prices = self.prices.get(model)
+        if not prices:
+            return 0.0
+        input_price, cached_price, output_price = prices
+        return ((prompt_tokens - cached_tokens) * input_price
+                + cached_tokens * cached_price
+                + completion_tokens * output_price) / 1e6
+
+    def record(self, trigger: str | None, channel: tuple | None, model: str, prompt_tokens: int,
+               cached_tokens: int, completion_tokens: int, latency: float, is_null: bool) -> None:
+        """
+        Record one call.
+
+        Args:
+            trigger: Trigger that caused the call.
+            channel: (guild id, channel id, channel name), or None for calls not tied to a channel.
+        """
+        now = self.clock()
+        guild, channel_id, name = channel or (None, None, None)
+        cost = self.cost(model, prompt_tokens, cached_tokens, completion_tokens)
+        self.pending.append((now, guild, channel_id, name, trigger, model, prompt_tokens,
+                             cached_tokens, completion_tokens, latency, int(is_null), cost))
+        for key in self._period_keys(now).values():
+            self.spend[(key, name, trigger)] += cost
+
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def allows(self, trigger: str | None, channel: tuple | None) -> bool:
+        """ Whether every budget covering this channel and trigger still has money left. """
+        name = channel[2] if channel else None
+        keys = self._period_keys(self.clock())
+        for budget in self.budgets:
+            if not self._matches(budget, name, trigger):
+                continue
+            for period, key in keys.items():
+                if period in budget and self._spent(budget, key) >= budget[period]:
+                    return False
+        return True
+
+    def check(self, trigger: str | None, channel: tuple | None) -> None:
+        """
+        Raises:
+            BudgetExceededError: A budget covering this channel and trigger is spent.
+        """
+        if not self.allows(trigger, channel):
+            self.rejected += 1
+            name = channel[2] if channel else None
+            raise BudgetExceededError(f"LLM budget spent for '{trigger}' in {name}")
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        with self._db:
+            self._db.executemany("INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.pending)
+        self.pending.clear()
+
+    def close(self) -> None:
+        self.flush()
+        self._db.close()
+
+    def report(self, period: str = "daily", limit: int = 5) -> str:
+        """ Spend of the current day or month, by channel and route, and the state of the budgets. """
+        self.flush()
+        key = self._period_keys(self.clock())[period]
+        where = "WHERE strftime(?, ts, 'unixepoch') = ?"
+        args = (PERIODS[period], key)
+
+        calls, nulls, prompt, cached, completion, cost = self._db.execute(
+            "SELECT COUNT(*), SUM(is_null), SUM(prompt_tokens), SUM(cached_tokens), SUM(completion_tokens), SUM(cost) "
+            f"FROM calls {where}", args
+        ).fetchone()
+        lines = [
+            f"Spend {key}: ${cost or 0:.4f} in {calls} calls ({nulls or 0} null)",
+            f"Tokens: {prompt or 0} prompt ({cached or 0} cached), {completion or 0} completion",
+        ]
+        rows = self._db.execute(
+            f"SELECT channel, SUM(cost), COUNT(*) FROM calls {where} "
+            "GROUP BY channel ORDER BY SUM(cost) DESC LIMIT ?", args + (limit,)
+        ).fetchall()
+        if rows:
+            lines.append("By channel:")
+            lines += [f"  ${spent:.4f}  {calls:>5} calls  {channel or '-'}" for channel, spent, calls in rows]
+
+        # A route is a trigger and the model llm_routes sends it to.
+        rows = self._db.execute(
+            f"SELECT trigger, model, SUM(cost), COUNT(*), AVG(latency), SUM(is_null) FROM calls {where} "
+            "GROUP BY trigger, model ORDER BY SUM(cost) DESC LIMIT ?", args + (limit,)
+        ).fetchall()
+        if rows:
+            lines.append("By route:")
+            lines += [
+                f"  ${spent:.4f}  {calls:>5} calls  {latency * 1000:>5.0f} ms avg  {nulls:>4} null  {trigger or '-'} -> {model}"
+                for trigger, model, spent, calls, latency, nulls in rows
+            ]
+
+        budgets = [b for b in self.budgets if period in b]
+        if budgets:
+            lines.append("Budgets:")
+            lines += [
+                f"  {b.get('channel', '*')}/{b.get('trigger', '*')}: ${self._spent(b, key):.4f} of ${b[period]:.2f}"
+                for b in budgets
+            ]
+        return "\n".join(lines)
+
+    def _spent(self, budget: dict, key: str) -> float:
+        return sum(
+            cost for (period_key, channel, trigger), cost in self.spend.items()
+            if period_key == key and self._matches(budget, channel, trigger)
+        )
+
+    @staticmethod
+    def _matches(budget: dict, channel: str | None, trigger: str | None) -> bool:
+        return budget.get("channel", "*") in ("*", channel) and budget.get("trigger", "*") in ("*", trigger)
+
+    @staticmethod
+    def _period_keys(timestamp: float) -> dict[str, str]:
+        utc = time.gmtime(timestamp)
+        return {period: time.strftime(fmt, utc) for period, fmt in PERIODS.items()}
+
+    def _load_spend(self):
+        month = self._period_keys(self.clock())["monthly"]
+        rows = self._db.execute(
+            "SELECT strftime('%Y-%m-%d', ts, 'unixepoch'), channel, trigger, SUM(cost) FROM calls "
+            "WHERE strftime('%Y-%m', ts, 'unixepoch') = ? GROUP BY 1, 2, 3", (month,)
+        )
+        for day, channel, trigger, cost in rows:
+            self.spend[(day, channel, trigger)] += cost
+            self.spend[(month, channel, trigger)] += cost
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Summarize the LLM spend recorded in the ledger.")
+    parser.add_argument("ledger")
+    parser.add_argument("--period", choices=list(PERIODS), default="daily")
+    args = parser.parse_args(argv)
+
+    ledger = CostLedger(args.ledger)
+    print(ledger.report(args.period))
+    ledger.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
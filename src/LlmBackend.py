@@ -0,0 +1,278 @@
+import os
+import time
+import asyncio
+import contextlib
+import importlib.util
+from dataclasses import dataclass, field
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+try:
+    import httpx
+except ImportError:
+    # openai releases built on the httpx2 fork
+    import httpx2 as httpx
+from Config import Config
+from Resilience import TRANSIENT_ERRORS
+
+
+@dataclass
+class Endpoint:
+    """
+    One OpenAI-compatible endpoint of the pool and its observed state.
+    """
+    name: str
+    model: str = "gpt-4o-mini"
+    base_url: str | None = None
+    # Environment variable holding the API key, so keys never live in config.json.
+    api_key_env: str = "BISBOT_API_KEY"
+    # The endpoint supports response_format={"type": "json_object"}.
+    json_mode: bool = False
+    # The endpoint reports token usage at the end of streams (stream_options.include_usage).
+    stream_usage: bool = False
+    client: AsyncOpenAI | None = None
+    # Requests currently in flight.
+    outstanding: int = 0
+    # Exponentially weighted moving average of the request latency, in seconds.
+    latency: float | None = None
+    consecutive_failures: int = 0
+    # The endpoint is skipped until this time (monotonic seconds).
+    cooldown_until: float = 0.0
+    last_picked: int = field(default=0, repr=False)
+    # When the endpoint last sent or received anything (monotonic seconds), to find idle connections.
+    last_used: float = 0.0
+    # Connection pool shared with the other endpoints of the pool.
+    http_client: httpx.AsyncClient | None = field(default=None, repr=False)
+
+    def get_client(self) -> AsyncOpenAI:
+        if self.client is None:
+            # Retries are handled by BisbalWrapper so they can respect per-trigger deadlines.
+            self.client = AsyncOpenAI(
+                # Local servers (e.g. StubServer.py) take any key.
+                api_key=os.getenv(self.api_key_env) or ("unused" if self.base_url else None),
+                base_url=self.base_url,
+                max_retries=0,
+                http_client=self.http_client,
+            )
+        return self.client
+
+    def is_available(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+
+@dataclass
+class Route:
+    """
+    Request settings of one trigger, from llm_routes. Unset fields fall back to the endpoint and global settings.
+    """
+    # Model name, or endpoint name -> model name for pools of different providers.
+    model: str | dict | None = None
+    max_tokens: int | None = None
+    temperature: float | None = None
+    # Seconds allowed to each attempt; the trigger deadline still bounds the retries.
+    timeout: float | None = None
+
+    @classmethod
+    def for_trigger(cls, config: Config, trigger: str | None) -> "Route":
+        return cls(**config.llm_routes.get(trigger or "", {}))
+
+    def model_for(self, endpoint: Endpoint) -> str:
+        if isinstance(self.model, dict):
+            return self.model.get(endpoint.name, endpoint.model)
+        return self.model or endpoint.model
+
+    def request_options(self, config: Config, endpoint: Endpoint, max_tokens: int | None = None) -> dict:
+        """ Keyword arguments of chat.completions.create for this route on an endpoint.
+        An explicit max_tokens (size of a summary or a digest) wins over the route.
+        """
+        options = {
+            "model": self.model_for(endpoint),
+            "max_tokens": max_tokens or self.max_tokens or config.max_tokens_response,
+            "temperature": config.llm_temperature if self.temperature is None else self.temperature,
+        }
+        if self.timeout is not None:
+            options["timeout"] = self.timeout
+        return options
+
+
+def http_client(config: Config) -> httpx.AsyncClient:
+    """
+    Connection pool of the LLM clients. HTTP/2 needs the h2 package and falls back to HTTP/1.1 without it.
+    """
+    http2 = config.llm_http2 and importlib.util.find_spec("h2") is not None
+    if config.llm_http2 and not http2:
+        print("[LLM] HTTP/2 disabled: the h2 package is not installed")
+    return DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=config.llm_max_connections,
+            max_keepalive_connections=config.llm_max_keepalive_connections,
+            keepalive_expiry=config.llm_keepalive_expiry,
+        ),
+        http2=http2,
+    )
+
+
+class BackendPool:
+    """
+    Spreads LLM requests across several OpenAI-compatible endpoints.
+
+    Endpoints are picked by least outstanding requests or by observed latency.
+    An endpoint answering 429 cools down for its Retry-After (or `endpoint_cooldown`)
+    and one failing repeatedly is taken out of rotation for the same period,
+    after which it is tried again.
+    """
+
+    LEAST_OUTSTANDING = "least_outstanding"
+    LATENCY = "latency"
+
+    # Weight of the newest sample in the latency average.
+    LATENCY_ALPHA = 0.3
+
+    def __init__(self, endpoints: list[Endpoint], balance: str = LEAST_OUTSTANDING,
+                 cooldown: float = 30, failure_threshold: int = 3, clock=time.monotonic,
+                 http_client: httpx.AsyncClient | None = None):
+        """
+        Args:
+            endpoints: Endpoints of the pool, at least one.
+            balance: "least_outstanding" or "latency".
+            cooldown: Seconds an endpoint is skipped after a 429 without Retry-After, or after repeated failures.
+            failure_threshold: Consecutive transient failures that take an endpoint out of rotation.
+            clock: Callable returning the current time in seconds.
+            http_client: Connection pool shared by the endpoints. None keeps the openai defaults.
+        """
+        if not endpoints:
+            raise ValueError("The LLM backend pool needs at least one endpoint")
+
+        self.endpoints = endpoints
+        self.balance = balance
+        self.cooldown = cooldown
+        self.failure_threshold = failure_threshold
+        self.clock = clock
+        self.http_client = http_client
+        for endpoint in endpoints:
+            endpoint.http_client = endpoint.http_client or http_client
+        self._picks = 0
+
+    @classmethod
+    def from_config(cls, config: Config) -> "BackendPool":
+        endpoints = [
+            Endpoint(
+                name=data.get("name", f"endpoint-{i}"),
+                model=data.get("model", "gpt-4o-mini"),
+                base_url=data.get("base_url"),
+                api_key_env=data.get("api_key_env", "BISBOT_API_KEY"),
+                json_mode=data.get("json_mode", False),
+                stream_usage=data.get("stream_usage", False),
+            )
+            for i, data in enumerate(config.llm_endpoints)
+        ]
+        return cls(endpoints, config.llm_balance, config.endpoint_cooldown, config.endpoint_failure_threshold,
+                   http_client=http_client(config))
+
+    def pick(self) -> Endpoint:
+        """
+        Selects the endpoint for the next request.
+        If every endpoint is cooling down, the one that recovers first is used.
+        """
+        now = self.clock()
+        candidates = [e for e in self.endpoints if e.is_available(now)]
+        if not candidates:
+            return min(self.endpoints, key=lambda e: e.cooldown_until)
+
+        if self.balance == self.LATENCY:
+            # Expected wait: unknown latencies are tried first so every endpoint gets measured.
+            key = lambda e: ((e.latency or 0.0) * (e.outstanding + 1), e.last_picked)
+        else:
+            key = lambda e: (e.outstanding, e.last_picked)
+
+        endpoint = min(candidates, key=key)
+        self._picks += 1
+        endpoint.last_picked = self._picks
+        return endpoint
+
+    @contextlib.asynccontextmanager
+    async def lease(self):
+        """
+        Yields an endpoint for one request and records how it went.
+        """
+        endpoint = self.pick()
+        endpoint.outstanding += 1
+        start = endpoint.last_used = self.clock()
+        try:
+            yield endpoint
+        except openai.RateLimitError as e:
+            self._cool_down(endpoint, self._retry_after(e))
+            raise
+        except TRANSIENT_ERRORS:
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.failure_threshold:
+                self._cool_down(endpoint, self.cooldown)
+            raise
+        else:
+            self._record_latency(endpoint, self.clock() - start)
+            endpoint.consecutive_failures = 0
+        finally:
+            endpoint.outstanding -= 1
+            endpoint.last_used = self.clock()
+
+    async def warm_up(self, endpoints: list[Endpoint] | None = None) -> int:
+        """
+        Opens (or keeps open) a connection to each endpoint with a free request listing the models,
+        so the next completion skips DNS, TCP and TLS setup. Returns the endpoints that answered.
+        """
+        endpoints = self.endpoints if endpoints is None else endpoints
+
+        async def ping(endpoint: Endpoint) -> bool:
+            endpoint.last_used = self.clock()
+            try:
+                await endpoint.get_client().models.list()
+                return True
+            except Exception as e:
+                print(f"[LLM] Warm-up of endpoint '{endpoint.name}' failed: {e}")
+                return False
+
+        results = await asyncio.gather(*(ping(e) for e in endpoints))
+        return sum(results)
+
+    async def keep_warm(self, interval: float, sleep=asyncio.sleep):
+        """
+        Pings the endpoints idle for `interval` seconds, every `interval` seconds, so quiet periods
+        do not let the server or the pool close their connections. Runs until cancelled.
+        """
+        while True:
+            await sleep(interval)
+            idle = [e for e in self.endpoints if self.clock() - e.last_used >= interval and e.outstanding == 0]
+            if idle:
+                await self.warm_up(idle)
+
+    async def aclose(self):
+        if self.http_client is not None:
+            await self.http_client.aclose()
+
+    def status(self) -> list[dict]:
+        now = self.clock()
+        return [
+            {
+                "name": e.name,
+                "model": e.model,
+                "outstanding": e.outstanding,
+                "latency": e.latency,
+                "available": e.is_available(now),
+            }
+            for e in self.endpoints
+        ]
+
+    def _cool_down(self, endpoint: Endpoint, seconds: float):
+        endpoint.cooldown_until = self.clock() + seconds
+        print(f"[LLM] Endpoint '{endpoint.name}' cooling down for {seconds:.0f}s")
+
+    def _record_latency(self, endpoint: Endpoint, seconds: float):
+        if endpoint.latency is None:
+            endpoint.latency = seconds
+        else:
+            endpoint.latency += self.LATENCY_ALPHA * (seconds - endpoint.latency)
+
+    def _retry_after(self, error: openai.RateLimitError) -> float:
+        try:
+            return float(error.response.headers.get("retry-after"))
+        except (AttributeError, TypeError, ValueError):
+            return self.cooldown
@@ -0,0 +1,96 @@
+import re
+import math
+import unicodedata
+from collections import Counter
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Lowercase words without accents, so "Qué" and "que" match. Single characters are dropped.
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [word for word in _WORD.findall(text) if len(word) > 1]
+
+
+class MemoryIndex:
+    """
+    BM25 index over the memory lines learned from the conversations.
+
+    Lines are indexed as they are stored, in an inverted index
+    (term -> {line id: term frequency}), so a search only visits the lines
+    sharing a term with the query. Past `max_lines`, the oldest line is dropped.
+    """
+
+    def __init__(self, max_lines: int = 2000, k1: float = 1.2, b: float = 0.75):
+        """
+        Args:
+            max_lines: Lines kept in the index.
+            k1: BM25 term frequency saturation.
+            b: BM25 length normalization.
+        """
+        self.max_lines = max_lines
+        self.k1 = k1
+        self.b = b
+        # line id -> (text, term frequencies)
+        self.lines: dict[int, tuple[str, Counter]] = {}
+        self.postings: dict[str, dict[int, int]] = {}
+        self._next_id = 0
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def texts(self) -> list[str]:
+        """ Every line, oldest first. """
+        return [text for text, _ in self.lines.values()]
+
+    def add(self, text: str) -> None:
+        terms = Counter(tokenize(text))
+        if not terms:
+            return
+
+        line_id = self._next_id
+        self._next_id += 1
+        self.lines[line_id] = (text, terms)
+        self._total_length += terms.total()
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[line_id] = count
+
+        while len(self.lines) > self.max_lines:
+            self._remove(next(iter(self.lines)))
+
+    def search(self, query: str, k: int) -> list[str]:
+        """
+        The k lines most relevant to the query, in the order they were learned.
+        """
+        if not self.lines or k <= 0:
+            return []
+
+        n = len(self.lines)
+        average_length = self._total_length / n
+        scores: Counter = Counter()
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for line_id, tf in postings.items():
+                length = self.lines[line_id][1].total()
+                norm = self.k1 * (1 - self.b + self.b * length / average_length)
+                scores[line_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        best = sorted(line_id for line_id, _ in scores.most_common(k))
+        return [self.lines[line_id][0] for line_id in best]
+
+    def _remove(self, line_id: int):
+        _, terms = self.lines.pop(line_id)
+        self._total_length -= terms.total()
+        for term in terms:
+            postings = self.postings[term]
+            del postings[line_id]
+            if not postings:
+                del self.postings[term]
@@ -0,0 +1,125 @@
+import re
+import sys
+import argparse
+from pathlib import Path
+import discord
+
+
+class MessageNormalizer:
+    """
+    Rewrites Discord markup into the shortest text that keeps its meaning
+    for the LLM. Applied once when a message enters the history, so every
+    prompt including that history pays for the short version only.
+
+    - <@123> / <@!123>  -> @DisplayName
+    - <@&123>           -> @RoleName
+    - <#123>            -> #channel-name
+    - <:name:123>       -> :name:
+    - https://host/path -> host
+    - jajajajajaja      -> jajaja, !!!!!!! -> !!!
+
+    Numbers are never shortened, and fenced code blocks are kept as written.
+    """
+
+    # One alternation so the text is scanned once for all Discord markup.
+    _MARKUP = re.compile(
+        r"<@!?(?P<user>\d+)>"
+        r"|<@&(?P<role>\d+)>"
+        r"|<#(?P<channel>\d+)>"
+        r"|<a?:(?P<emoji>\w+):\d+>"
+        r"|https?://(?:www\.)?(?P<host>[^/\s>]+)[^\s>]*"
+    )
+    # A unit of 1 to 4 letters, or of 1 to 4 symbols, repeated more than 3 times. Digits are left alone
+    # so scores and ids survive.
+    _REPEAT = re.compile(r"([^\W\d]{1,4}?|[^\w\s]{1,4}?)\1{3,}")
+    _SPACES = re.compile(r"[ \t]{2,}")
+    # A ``` block, up to its closing fence or the end of the message.
+    _FENCE = re.compile(r"```.*?(?:```|$)", re.S)
+
+    def normalize(self, content: str | None, users: dict[int, str] | None = None,
+                  roles: dict[int, str] | None = None, channels: dict[int, str] | None = None) -> str | None:
+        """
+        Normalize the content of a message.
+
+        Args:
+            content: Raw message content.
+            users: user id -> display name, for mentions.
+            roles: role id -> name, for role mentions.
+            channels: channel id -> name, for channel mentions.
+
+        Returns:
+            The normalized content.
+        """
+        if not content:
+            return content
+
+        users = users or {}
+        roles = roles or {}
+        channels = channels or {}
+
+        def replace(match: re.Match) -> str:
+            if match["user"]:
+                return f"@{users.get(int(match['user']), 'alguien')}"
+            if match["role"]:
+                return f"@{roles.get(int(match['role']), 'rol')}"
+            if match["channel"]:
+                return f"#{channels.get(int(match['channel']), 'canal')}"
+            if match["emoji"]:
+                return f":{match['emoji']}:"
+            return match["host"]
+
+        def shorten(text: str) -> str:
+            text = self._MARKUP.sub(replace, text)
+            text = self._REPEAT.sub(r"\1\1\1", text)
+            return self._SPACES.sub(" ", text)
+
+        # Code keeps its indentation and literals: only the prose around it is shortened.
+        parts = []
+        last = 0
+        for fence in self._FENCE.finditer(content):
+            parts += [shorten(content[last:fence.start()]), fence.group()]
+            last = fence.end()
+        parts.append(shorten(content[last:]))
+        return "".join(parts).strip()
+
+    def normalize_message(self, message: discord.Message) -> str | None:
+        """
+        Normalize a Discord message, resolving its mentions with the objects
+        Discord already attached to it.
+        """
+        return self.normalize(
+            message.content,
+            users={u.id: u.display_name for u in message.mentions},
+            roles={r.id: r.name for r in getattr(message, "role_mentions", [])},
+            channels={c.id: c.name for c in getattr(message, "channel_mentions", [])},
+        )
+
+
+def main(argv: list[str] | None = None):
+    """
+    Measures the token reduction on recorded traffic: one message per line,
+    optionally prefixed with '<author>: '.
+    """
+    from GptWrapper import estimate_tokens
+
+    parser = argparse.ArgumentParser(description="Measure the token reduction of message normalization.")
+    parser.add_argument("recording")
+    args = parser.parse_args(argv)
+
+    normalizer = MessageNormalizer()
+    lines = Path(args.recording).read_text(encoding="utf-8").splitlines()
+    before = after = 0
+    for line in lines:
+        author, sep, content = line.partition(": ")
+        if not sep:
+            author, content = "", line
+        before += estimate_tokens(line)
+        after += estimate_tokens(f"{author}{sep}{normalizer.normalize(content)}")
+
+    reduction = 1 - after / before if before else 0.0
+    print(f"{len(lines)} messages: {before} -> {after} estimated tokens ({reduction:.1%} less)")
+    return before, after
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
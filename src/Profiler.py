@@ -0,0 +1,262 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from pathlib import Path
+
+
+@dataclass
+class ProfileReport:
+    """
+    Result of one profiling run.
+    """
+    seconds: float
+    samples: int = 0
+    # Samples taken while the event loop was waiting for I/O.
+    idle: int = 0
+    # Samples taken while the event loop had not run for longer than the blocking threshold.
+    blocked: int = 0
+    # Distinct periods during which the event loop was blocked, and the longest one in seconds.
+    blocks: int = 0
+    longest_block: float = 0.0
+    # Collapsed stack (root first, ';'-separated) -> samples.
+    stacks: Counter = field(default_factory=Counter)
+    # Function -> samples in which it was the innermost frame, excluding idle samples.
+    functions: Counter = field(default_factory=Counter)
+    # Collapsed stack -> samples taken while the loop was blocked.
+    blocking_stacks: Counter = field(default_factory=Counter)
+    path: str | None = None
+
+    def summary(self, limit: int = 5) -> str:
+        """ Short text report, sized for a Discord message. """
+        busy = self.samples - self.idle
+        lines = [
+            f"Profiled {self.seconds:.0f}s: {self.samples} samples, "
+            f"{busy / self.samples:.0%} busy" if self.samples else f"Profiled {self.seconds:.0f}s: no samples",
+            f"Event loop blocked {self.blocks} times, longest {self.longest_block * 1000:.0f} ms",
+        ]
+        if self.functions:
+            lines.append("Hot functions:")
+            lines += [f"  {count:>5}  {name}" for name, count in self.functions.most_common(limit)]
+        if self.blocking_stacks:
+            lines.append("Blocking stacks:")
+            lines += [f"  {count:>5}  {_leaves(stack)}" for stack, count in self.blocking_stacks.most_common(limit)]
+        if self.path:
+            lines.append(f"Flamegraph (collapsed): {self.path}")
+        return "\n".join(lines)[:1900]
+
+
+class SamplingProfiler:
+    """
+    Samples the event loop thread's stack from a background thread.
+
+    Reading another thread's frames through sys._current_frames() needs no
+    tracing hooks, so the profiled code runs at full speed; the cost is one
+    stack walk every `interval` seconds. A heartbeat task measures how late
+    the event loop runs, and samples taken while it is later than
+    `block_threshold` point at the code blocking it.
+    """
+
+    HEARTBEAT = 0.01
+
+    def __init__(self, interval: float = 0.005, block_threshold: float = 0.1, output_dir: str | None = "profiles"):
+        """
+        Args:
+            interval: Seconds between samples.
+            block_threshold: Seconds without a heartbeat after which the event loop is considered blocked.
+            output_dir: Directory receiving the collapsed stacks, for flamegraph tools. None skips the file.
+        """
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.output_dir = output_dir
+        self.running = False
+        self._heartbeat = 0.0
+
+    async def run(self, seconds: float) -> ProfileReport:
+        """
+        Profile the running event loop for `seconds`. Must be awaited from the loop to profile.
+        """
+        if self.running:
+            raise RuntimeError("A profile is already running")
+
+        self.running = True
+        report = ProfileReport(seconds=seconds)
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample, args=(threading.get_ident(), report, stop),
+                                   name="profiler", daemon=True)
+        self._heartbeat = time.perf_counter()
+        sampler.start()
+        try:
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                self._heartbeat = time.perf_counter()
+                await asyncio.sleep(self.HEARTBEAT)
+        finally:
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            self.running = False
+
+        if self.output_dir and report.stacks:
+            report.path = self._write(report)
+        return report
+
+    def _sample(self, thread_id: int, report: ProfileReport, stop: threading.Event):
+        in_block = False
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+
+            stack = _collapse(frame)
+            report.samples += 1
+            report.stacks[stack] += 1
+
+            if _is_idle(frame):
+                report.idle += 1
+            else:
+                report.functions[_name(frame)] += 1
+
+            lag = time.perf_counter() - self._heartbeat - self.HEARTBEAT
+            if lag > self.block_threshold:
+                report.blocked += 1
+                report.blocking_stacks[stack] += 1
+                report.blocks += not in_block
+                report.longest_block = max(report.longest_block, lag)
+                in_block = True
+            else:
+                in_block = False
+
+    def _write(self, report: ProfileReport) -> str:
+        directory = Path(self.output_dir)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / time.strftime("profile-%Y%m%d-%H%M%S.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in report.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return str(path)
+
+
+class LoopLagMonitor:
+    """
+    Watchdog measuring how late the event loop runs its callbacks.
+
+    A task sleeps `interval` seconds in a loop and records by how much each
+    wake-up was late. A helper thread watches the task's heartbeat: when the
+    loop has not run for `threshold` seconds, it captures the stack of the
+    loop thread while it is still blocked and logs it, naming the function
+    that holds the loop. Lag percentiles are logged every `report_interval`.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25, report_interval: float = 300,
+                 stack_depth: int = 8):
+        """
+        Args:
+            interval: Seconds between lag measurements.
+            threshold: Lag in seconds considered a stall, whose stack is logged.
+            report_interval: Seconds between lag summaries in the log. 0 disables them,
+                and the percentiles then cover the last minute.
+            stack_depth: Innermost frames logged for each stall.
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.report_interval = report_interval
+        self.stack_depth = stack_depth
+        # Lags (seconds) measured since the last report, bounded in case the report never comes
+        self.window: deque[float] = deque(maxlen=max(1, int((report_interval or 60) / interval)))
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        # Innermost function -> stalls it caused
+        self.blockers: Counter = Counter()
+        self._heartbeat = time.perf_counter()
+        self._task: asyncio.Task | None = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._task:
+            return
+        self._stop.clear()
+        self._heartbeat = time.perf_counter()
+        self._task = asyncio.create_task(self._run())
+        threading.Thread(target=self._watch, args=(threading.get_ident(),), name="loop-monitor", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        """ Lag metrics in milliseconds, over the current report window. """
+        window = sorted(self.window)
+        percentile = lambda q: window[min(len(window) - 1, int(q * len(window)))] * 1000 if window else 0.0
+        return {
+            "lag_ms": self.last_lag * 1000,
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+            "max_ms": self.max_lag * 1000,
+            "stalls": self.stalls,
+        }
+
+    async def _run(self):
+        last_report = time.perf_counter()
+        try:
+            while True:
+                self._heartbeat = time.perf_counter()
+                await asyncio.sleep(self.interval)
+                self.last_lag = max(0.0, time.perf_counter() - self._heartbeat - self.interval)
+                self.max_lag = max(self.max_lag, self.last_lag)
+                self.window.append(self.last_lag)
+
+                if self.report_interval and time.perf_counter() - last_report >= self.report_interval:
+                    last_report = time.perf_counter()
+                    stats = self.stats()
+                    print(f"[LOOP] lag p50 {stats['p50_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms, "
+                          f"max {stats['max_ms']:.0f} ms, {self.stalls} stalls")
+                    self.window.clear()
+        except asyncio.CancelledError:
+            pass
+
+    def _watch(self, thread_id: int):
+        reported = None
+        while not self._stop.wait(min(self.threshold / 2, self.interval)):
+            heartbeat = self._heartbeat
+            stalled = time.perf_counter() - heartbeat - self.interval
+            if stalled < self.threshold or heartbeat == reported:
+                continue
+
+            # Report each stall once, while the loop is still blocked.
+            reported = heartbeat
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            self.stalls += 1
+            self.blockers[_name(frame)] += 1
+            stack = "".join(traceback.format_stack(frame, limit=self.stack_depth))
+            print(f"[LOOP] Event loop blocked for {stalled * 1000:.0f} ms in {_name(frame)}:\n{stack}", end="")
+
+
+def _name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _leaves(stack: str, depth: int = 3) -> str:
+    return " <- ".join(reversed(stack.split(";")[-depth:]))
+
+
+def _is_idle(frame) -> bool:
+    # The loop waits for I/O inside the selector.
+    return os.path.basename(frame.f_code.co_filename) == "selectors.py"
@@ -0,0 +1,154 @@
+import asyncio
+import random
+import time
+import openai
+
+
+# Errors worth retrying: the same request may succeed a moment later.
+TRANSIENT_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling the backend while the circuit breaker is open,
+    or when a low-priority trigger is shed because the backend is unhealthy.
+    """
+
+
+class HedgeLostError(Exception):
+    """
+    Raised by the slower of two hedged requests when the other one already posted its reply.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing backend for a while instead of letting every
+    trigger pay a full timeout.
+
+    - closed: calls go through, consecutive failures are counted.
+    - open: every call fails fast until the cooldown expires.
+    - half-open: after the cooldown, a single probe call is let through.
+      Its result closes the circuit again or reopens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30, clock=time.monotonic):
+        """
+        Args:
+            failure_threshold: Consecutive failures that open the circuit.
+            cooldown: Seconds the circuit stays open before probing the backend.
+            clock: Callable returning the current time in seconds.
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._last_failure = 0.0
+        self._probing = False
+
+    @property
+    def degraded(self) -> bool:
+        """
+        True while the backend is failing or recovering: the circuit is open,
+        a probe is in flight, or a failure happened within the last cooldown period.
+        Once the cooldown of an open circuit expires any call may be the probe.
+        """
+        if self.state == self.OPEN:
+            return self.clock() - self._opened_at < self.cooldown
+        if self.state == self.HALF_OPEN:
+            return True
+        return self.failures > 0 and self.clock() - self._last_failure < self.cooldown
+
+    def allow(self) -> bool:
+        """
+        Returns True if a call may be sent to the backend now.
+        """
+        if self.state == self.OPEN:
+            if self.clock() - self._opened_at < self.cooldown:
+                return False
+            self.state = self.HALF_OPEN
+            self._probing = False
+
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.state = self.CLOSED
+        self._probing = False
+
+    def release(self):
+        """
+        Ends a call whose outcome says nothing about the backend health (cancelled, or failed
+        for a non-transient reason). If it was the probe, the next call probes again.
+        """
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._last_failure = self.clock()
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self._opened_at = self.clock()
+            self._probing = False
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """
+    Exponential backoff with full jitter for the given retry attempt (0-based).
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+async def hedged(factory, delay: float):
+    """
+    Runs factory() and, if it has not finished after `delay` seconds,
+    starts a second identical request. The first successful result wins
+    and the other request is cancelled.
+
+    Args:
+        factory: Callable receiving the attempt index (0 or 1) and returning a coroutine.
+        delay: Seconds to wait before sending the hedged request.
+    """
+    first = asyncio.create_task(factory(0))
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+    except asyncio.CancelledError:
+        first.cancel()
+        raise
+
+    if done:
+        return first.result()
+
+    pending = {first, asyncio.create_task(factory(1))}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    continue
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    raise error or asyncio.CancelledError()
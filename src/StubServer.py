@@ -0,0 +1,266 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from pathlib import Path
+from collections import Counter
+from aiohttp import web
+from GptWrapper import COMPACTION_RULES
+
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class StubLLMServer:
+    """
+    Local server speaking the OpenAI chat completions API, for load and latency tests.
+
+    Every request waits a latency drawn from the configured distribution, may
+    fail with 429 or 500 at the configured rates, and answers with the next
+    scripted reply or, without a script, with an envelope shaped after the
+    request (single reply, batch of channels, summary or memory digest). Streaming and usage
+    reporting (stream_options.include_usage) behave like the real API.
+
+    Point an endpoint at it with "base_url": "http://127.0.0.1:<port>/v1".
+    """
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.0, distribution: str = "uniform",
+                 rate_429: float = 0.0, rate_500: float = 0.0, retry_after: float = 1.0,
+                 null_rate: float = 0.0, replies: list | None = None,
+                 chunk_size: int = 8, chunk_interval: float = 0.01, seed: int | None = None):
+        """
+        Args:
+            latency: Seconds before the first byte (median for "lognormal").
+            jitter: Spread of the latency: +- seconds for "uniform", sigma for "lognormal".
+            distribution: "uniform" or "lognormal".
+            rate_429: Fraction of requests answered with 429 Too Many Requests.
+            rate_500: Fraction of requests answered with 500 Internal Server Error.
+            retry_after: Retry-After header of the 429 answers, in seconds.
+            null_rate: Fraction of generated replies that are "response": null.
+            replies: Scripted replies, used in order and then repeated. Each one is the completion text,
+                an envelope object, or a dict with "content" and optionally "latency" and "status"
+                overriding the defaults.
+            chunk_size: Characters per streamed chunk.
+            chunk_interval: Seconds between streamed chunks.
+            seed: Seed of the random draws, for reproducible runs.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.retry_after = retry_after
+        self.null_rate = null_rate
+        self.replies = replies or []
+        self.chunk_size = chunk_size
+        self.chunk_interval = chunk_interval
+        self.random = random.Random(seed)
+        self.stats: Counter = Counter()
+        self.in_flight = 0
+        self._next_reply = 0
+        # Client addresses seen, to count the connections opened
+        self._peers: set = set()
+        self._runner: web.AppRunner | None = None
+
+        self.app = web.Application()
+        self.app.router.add_post("/v1/chat/completions", self.handle_completion)
+        self.app.router.add_get("/v1/models", self.handle_models)
+        self.app.router.add_get("/stats", self.handle_stats)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """ Start serving. Returns the base URL of the API (port 0 picks a free port). """
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def handle_models(self, request: web.Request) -> web.Response:
+        self._track(request)
+        self.stats["models"] += 1
+        return web.json_response({"object": "list", "data": [{"id": "stub", "object": "model"}]})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, "in_flight": self.in_flight})
+
+    async def handle_completion(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self._track(request)
+        self.stats["requests"] += 1
+        self.in_flight += 1
+        self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.in_flight)
+        try:
+            reply = self._reply(body)
+            await asyncio.sleep(reply.get("latency", self._draw_latency()))
+
+            status = reply.get("status") or self._draw_status()
+            if status == 429:
+                self.stats["429"] += 1
+                return web.json_response(
+                    {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}},
+                    status=429, headers={"Retry-After": str(self.retry_after)},
+                )
+            if status >= 400:
+                self.stats[str(status)] += 1
+                return web.json_response({"error": {"message": "Stub failure", "type": "server_error"}}, status=status)
+
+            usage = {
+                "prompt_tokens": sum(_estimate_tokens(m.get("content") or "") for m in body.get("messages", [])),
+                "completion_tokens": _estimate_tokens(reply["content"]),
+            }
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+            if body.get("stream"):
+                return await self._stream(request, body, reply["content"], usage)
+
+            self.stats["200"] += 1
+            return web.json_response({
+                "id": f"chatcmpl-stub-{self.stats['requests']}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "stub"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": reply["content"]},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(self, request: web.Request, body: dict, content: str, usage: dict) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        base = {
+            "id": f"chatcmpl-stub-{self.stats['requests']}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+        }
+
+        async def send(data: dict | str):
+            payload = data if isinstance(data, str) else json.dumps({**base, **data})
+            await response.write(f"data: {payload}\n\n".encode("utf-8"))
+
+        try:
+            await send({"choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})
+            for i in range(0, len(content), self.chunk_size):
+                await asyncio.sleep(self.chunk_interval)
+                await send({"choices": [{"index": 0, "delta": {"content": content[i:i + self.chunk_size]}, "finish_reason": None}]})
+            await send({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                await send({"choices": [], "usage": usage})
+            await send("[DONE]")
+            self.stats["200"] += 1
+        except ConnectionResetError:
+            # The client stopped reading, e.g. after an early "response": null
+            self.stats["aborted"] += 1
+        return response
+
+    def _track(self, request: web.Request):
+        self._peers.add(request.transport.get_extra_info("peername") if request.transport else None)
+        self.stats["connections"] = len(self._peers)
+
+    def _draw_latency(self) -> float:
+        if self.distribution == "lognormal":
+            return self.random.lognormvariate(0, self.jitter) * self.latency
+        return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def _draw_status(self) -> int:
+        draw = self.random.random()
+        if draw < self.rate_429:
+            return 429
+        if draw < self.rate_429 + self.rate_500:
+            return 500
+        return 200
+
+    def _reply(self, body: dict) -> dict:
+        if self.replies:
+            reply = self.replies[self._next_reply % len(self.replies)]
+            self._next_reply += 1
+            if not isinstance(reply, dict):
+                return {"content": reply}
+            if "content" not in reply:
+                # An envelope given as an object
+                return {"content": json.dumps(reply, ensure_ascii=False)}
+            return dict(reply)
+        return {"content": json.dumps(self._generate(body), ensure_ascii=False)}
+
+    def _generate(self, body: dict) -> dict:
+        """ A plausible envelope for the request: per channel for batches, a summary for summaries,
+        a digest for context compactions. """
+        messages = body.get("messages") or [{}]
+        if (messages[0].get("content") or "").startswith(COMPACTION_RULES.split("{max_chars}")[0]):
+            return {"memory": self._digest(messages[-1].get("content") or "", body.get("max_tokens"))}
+        try:
+            payload = json.loads(messages[-1].get("content") or "")
+        except ValueError:
+            payload = {}
+        if not isinstance(payload, dict):
+            payload = {}
+
+        if isinstance(payload.get("channels"), dict):
+            return {"channels": {key: self._single() for key in payload["channels"]}}
+        if "messages" in payload and "summary" in payload:
+            return {"summary": f"Resumen de {len(payload['messages'])} mensajes"}
+        return self._single()
+
+    @staticmethod
+    def _digest(memories: str, max_tokens: int | None) -> str:
+        """ The newest distinct memory lines, within half the digest budget. """
+        budget = (max_tokens or 1000) * 2
+        kept = []
+        for line in reversed(list(dict.fromkeys(memories.splitlines()))):
+            if sum(len(k) + 1 for k in kept) + len(line) > budget:
+                break
+            kept.append(line)
+        return "\n".join(reversed(kept))
+
+    def _single(self) -> dict:
+        if self.random.random() < self.null_rate:
+            return {"response": None, "context": None}
+        return {"response": "Vale, vale, ya os leo", "context": None}
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stub server for load and latency tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--distribution", choices=["uniform", "lognormal"], default="uniform")
+    parser.add_argument("--error-429", type=float, default=0.0)
+    parser.add_argument("--error-500", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--null-rate", type=float, default=0.0)
+    parser.add_argument("--replies", help="JSONL file with one scripted reply per line")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    replies = None
+    if args.replies:
+        lines = Path(args.replies).read_text(encoding="utf-8").splitlines()
+        replies = [json.loads(line) for line in lines if line.strip()]
+
+    server = StubLLMServer(args.latency, args.jitter, args.distribution, args.error_429, args.error_500,
+                           args.retry_after, args.null_rate, replies, seed=args.seed)
+
+    async def serve():
+        url = await server.start(args.host, args.port)
+        print(f"Stub LLM listening on {url}")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import random
+import threading
+import contextvars
+from pathlib import Path
+from Config import Config
+
+_current_span: contextvars.ContextVar["Span | None"] = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    One timed operation of a trace. Spans opened while another span is active
+    (in the same task, or in tasks created from it) become its children.
+    """
+
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "sampled",
+                 "attributes", "start_ns", "end_ns", "status", "_token")
+
+    def __init__(self, tracer: "Tracer", name: str, parent: "Span | None", sampled: bool, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.sampled = sampled
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.start_ns = 0
+        self.end_ns = 0
+        self.status = "ok"
+        self._token = None
+
+    def set(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        self.start_ns = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.status = "cancelled" if exc_type.__name__ == "CancelledError" else "error"
+            self.attributes.setdefault("error", repr(exc))
+        if self.sampled:
+            self.tracer.export(self)
+        return False
+
+    def to_dict(self) -> dict:
+        # Field names follow the OTLP JSON span encoding.
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "durationMs": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """ Returned while tracing is disabled, so instrumentation costs next to nothing. """
+
+    def set(self, key: str, value) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class Tracer:
+    """
+    Records nested spans to a rotating JSONL file, one span per line.
+
+    Spans are buffered and written `flush_size` at a time, so finishing a
+    span does not open the file on the event loop.
+    The sampling decision is taken once per trace, at its root span,
+    and inherited by every child so traces are always complete.
+    """
+
+    def __init__(self, path: str | None = None, sample_rate: float = 1.0,
+                 max_bytes: int = 10 * 1024 * 1024, backups: int = 3, flush_size: int = 50):
+        """
+        Args:
+            path: JSONL file receiving the spans. None disables tracing.
+            sample_rate: Fraction of traces recorded.
+            max_bytes: Size at which the file is rotated.
+            backups: Rotated files kept (<path>.1 ... <path>.N).
+            flush_size: Spans buffered before they are written.
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_size = flush_size
+        self.pending: list[str] = []
+        self._lock = threading.Lock()
+
+    def configure(self, config: Config) -> None:
+        self.flush()
+        self.path = config.trace_file
+        self.sample_rate = config.trace_sample_rate
+        self.max_bytes = config.trace_max_bytes
+        self.flush_size = config.trace_flush_size
+
+    def span(self, name: str, parent: Span | None = None, **attributes):
+        """
+        Open a span, to be used as a context manager:
+
+            with tracer.span("llm.request", trigger=trigger) as span:
+                span.set("prompt_tokens", usage.prompt_tokens)
+
+        Args:
+            name: Operation name.
+            parent: Explicit parent, for work handed over to another task. Defaults to the active span.
+        """
+        if not self.path:
+            return _NOOP
+
+        parent = parent or _current_span.get()
+        if parent is None:
+            sampled = random.random() < self.sample_rate
+        else:
+            sampled = parent.sampled
+        return Span(self, name, parent, sampled, attributes)
+
+    @staticmethod
+    def current() -> Span | None:
+        """ The active span, to hand over to work running later in another task. """
+        return _current_span.get()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            self.pending.append(line)
+            if len(self.pending) < self.flush_size:
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        """ Writes the buffered spans, rotating the file as it fills up. """
+        with self._lock:
+            lines, self.pending = self.pending, []
+            if not lines or not self.path:
+                return
+            path = Path(self.path)
+            size = path.stat().st_size if path.exists() else None
+            f = open(path, "a", encoding="utf-8")
+            try:
+                for line in lines:
+                    if size is not None and size + len(line) > self.max_bytes:
+                        f.close()
+                        self._rotate(path)
+                        f = open(path, "a", encoding="utf-8")
+                        size = None
+                    f.write(line)
+                    size = (size or 0) + len(line)
+            finally:
+                f.close()
+
+    def _rotate(self, path: Path) -> None:
+        for i in range(self.backups - 1, 0, -1):
+            older = path.with_name(f"{path.name}.{i}")
+            if older.exists():
+                older.replace(path.with_name(f"{path.name}.{i + 1}"))
+        if self.backups > 0:
+            path.replace(path.with_name(f"{path.name}.1"))
+        else:
+            path.unlink()
+
+
+# Shared by every module; configured once at startup.
+tracer = Tracer()
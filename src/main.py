@@ -2,11 +2,15 @@ import os
 from DiscordBot import DiscordBot
 from GptWrapper import BisbalWrapper
 from  Config import Config
+from Tracing import tracer
 
 TOKEN = os.getenv("BISBOT_DISCORD_TOKEN")
 
 if not TOKEN:
     raise RuntimeError("BISBOT_DISCORD_TOKEN not set")
 
-bot = DiscordBot(BisbalWrapper(Config().read()))
+config = Config().read()
+tracer.configure(config)
+
+bot = DiscordBot(BisbalWrapper(config))
 bot.run(TOKEN)
@@ -1,9 +1,16 @@
 import discord
+import asyncio
+import itertools
+import contextlib
+from types import SimpleNamespace
+from Config import Config
 from DiscordBot import DiscordBot
+from Dispatcher import OutboundDispatcher
   
 class MockMessageHandler:
     def __init__(self, llm):
         self.llm = llm
+        self.dispatcher = OutboundDispatcher()
         self.handled_messages = []
         self.inactive_calls = 0
         
@@ -25,10 +32,50 @@ class MockAuthor:
         self.id = id
 
 
+class MockTyping:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def __aenter__(self):
+        self.channel.typing_active = True
+
+    async def __aexit__(self, *exc):
+        self.channel.typing_active = False
+
+
 class MockChannel:
-    def __init__(self, id=123, replied_message=None):
+    def __init__(self, id=123, replied_message=None, name="general"):
         self.id = id
+        self.name = name
         self._replied_message = replied_message
+        self.sent = []
+        self.typing_active = False
+        # Whether the typing indicator was on when each message was sent
+        self.typing_on_send = []
+        # Past messages returned by history(), oldest first
+        self.past_messages = []
+        self.history_delay = 0
+        # Shared by the channels whose concurrent history() calls are counted
+        self.history_concurrency: MockConcurrency | None = None
+
+    async def send(self, content):
+        self.sent.append(content)
+        self.typing_on_send.append(self.typing_active)
+
+    def typing(self):
+        return MockTyping(self)
+
+    async def history(self, limit=100, before=None):
+        """
+        Mock implementation of discord.TextChannel.history(): newest message first,
+        only messages older than `before` when it is a message or an object with an id.
+        """
+        with self.history_concurrency or contextlib.nullcontext():
+            await asyncio.sleep(self.history_delay)
+        before_id = getattr(before, "id", None)
+        messages = [m for m in self.past_messages if before_id is None or m.id < before_id]
+        for message in reversed(messages[-limit:]):
+            yield message
 
     async def fetch_message(self, message_id):
         """
@@ -45,15 +92,96 @@ class MockChannel:
         return self._replied_message
 
 
+class MockConcurrency:
+    """
+    Context manager counting how many holders it has at once, and the peak.
+    """
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+
+    def __enter__(self):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+
+    def __exit__(self, *exc):
+        self.active -= 1
+
+
+class MockLLM:
+    """
+    Stand-in for BisbalWrapper returning a fixed reply.
+    """
+    def __init__(self, message="ok", memory_proposal=None, config=None):
+        self.config = config or Config()
+        self.message = message
+        self.memory_proposal = memory_proposal
+        self.prompts = []
+
+    def snapshot(self):
+        return {"message": self.message}
+
+    def restore(self, state):
+        self.message = state["message"]
+
+    async def warm_up(self):
+        pass
+
+    async def keep_warm(self, sleep=None):
+        pass
+
+    async def close(self):
+        pass
+
+    async def get_response(self, prompt, trigger=None, on_message=None, channel=None):
+        self.prompts.append(prompt)
+        return SimpleNamespace(message=self.message, memory_proposal=self.memory_proposal, delivered=False)
+
+
+class MockOpenAI:
+    """
+    Stand-in for AsyncOpenAI: chat.completions.create is the given coroutine function.
+    """
+    def __init__(self, create):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create))
+
+
+# Increasing like Discord snowflakes, so later messages have larger ids
+_message_ids = itertools.count(1)
+
+
 class MockMessage:
     def __init__(self, content: str, author: MockAuthor, channel: MockChannel, mentions=None, reference=None):
+        self.id = next(_message_ids)
         self.content = content
         self.author = author
         self.channel = channel
         self.mentions = mentions or []
         self.reference = reference
         
+class MockInteraction:
+    """
+    Stand-in for discord.Interaction, recording the ephemeral replies.
+    """
+    def __init__(self, channel_id, administrator=False):
+        self.channel_id = channel_id
+        self.permissions = SimpleNamespace(administrator=administrator)
+        self.replies = []
+        self.deferred = False
+        self.response = SimpleNamespace(send_message=self._reply, defer=self._defer)
+        self.followup = SimpleNamespace(send=self._reply)
+
+    async def _reply(self, content, ephemeral=False):
+        self.replies.append(content)
+
+    async def _defer(self, ephemeral=False):
+        self.deferred = True
+
+
 class MockDiscordBot(DiscordBot):
     @property
     def user(self):
         return self._test_user
+
+    async def close(self):
+        self.closed = True
@@ -0,0 +1,116 @@
+import sys
+import json
+import asyncio
+import pytest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+import Checkpoint
+from Clock import VirtualClock
+from Mocks import MockAuthor, MockChannel, MockDiscordBot, MockLLM, MockMessage, MockMessageHandler
+
+
+def make_bot(clock, llm=None):
+    bot = MockDiscordBot(llm or MockLLM(), clock=clock)
+    bot._test_user = MockAuthor("BisbalBot", bot=True, id=999)
+    bot.message_handler = MockMessageHandler(bot.llm)
+    return bot
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "state" / "checkpoint.json")
+    Checkpoint.save(path, {"counters": {"1": 3}})
+    snapshot = Checkpoint.load(path)
+    assert snapshot["version"] == Checkpoint.SNAPSHOT_VERSION
+    assert snapshot["counters"] == {"1": 3}
+    assert not Path(path + ".tmp").exists()
+
+def test_unusable_snapshots_are_ignored(tmp_path):
+    assert Checkpoint.load(str(tmp_path / "missing.json")) is None
+
+    corrupt = tmp_path / "corrupt.json"
+    corrupt.write_text('{"version": 1, "count', encoding="utf-8")
+    assert Checkpoint.load(str(corrupt)) is None
+
+    old = tmp_path / "old.json"
+    old.write_text(json.dumps({"version": 0}), encoding="utf-8")
+    assert Checkpoint.load(str(old)) is None
+
+@pytest.mark.asyncio
+async def test_state_survives_a_restart(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    clock = VirtualClock(start=1000)
+    bot = make_bot(clock, MockLLM(message="recuerdo"))
+    channel = MockChannel()
+    bot.inactive_timer.init()
+    for text in ("hola", "que tal", "bien"):
+        await bot.on_message(MockMessage(text, MockAuthor("Ana"), channel))
+        await clock.advance(60)
+    Checkpoint.save(path, bot.snapshot())
+
+    # The new process has its own clock
+    new_clock = VirtualClock(start=5)
+    restored = make_bot(new_clock)
+    restored.restore(Checkpoint.load(path))
+
+    assert restored.message_counter.counter == {channel.id: 3}
+    assert restored.message_history.get_formatted(channel.id) == "Ana: hola\nAna: que tal\nAna: bien"
+    assert restored.message_history.last_activity(channel.id) == pytest.approx(5 - 60, abs=1)
+    assert restored.conversation_watcher.is_active(channel.id)
+    assert restored.llm.message == "recuerdo"
+
+    # The inactivity timer continues where it was, not from scratch
+    fired = []
+    async def on_inactive():
+        fired.append(new_clock())
+    restored.inactive_timer.callback = on_inactive
+    restored.inactive_timer.init(restored._inactive_remaining)
+    await new_clock.advance(30 * 60)
+    assert fired and fired[0] == pytest.approx(5 + 30 * 60 - 60, abs=1)
+
+@pytest.mark.asyncio
+async def test_backfill_after_restore_keeps_history_once(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    channel = MockChannel()
+    channel.past_messages = [MockMessage(f"m{i}", MockAuthor("Ana"), channel) for i in range(4)]
+    bot = make_bot(VirtualClock())
+    for message in channel.past_messages[1:]:
+        await bot.on_message(message)
+    Checkpoint.save(path, bot.snapshot())
+
+    restored = make_bot(VirtualClock())
+    restored.config.backfill_messages = 10
+    restored.restore(Checkpoint.load(path))
+    await restored.backfill_history([channel])
+
+    assert restored.message_history.get_formatted(channel.id) == "Ana: m0\nAna: m1\nAna: m2\nAna: m3"
+
+@pytest.mark.asyncio
+async def test_shutdown_drains_work_and_saves(tmp_path):
+    clock = VirtualClock()
+    bot = make_bot(clock)
+    bot.config.checkpoint_file = str(tmp_path / "checkpoint.json")
+    channel = MockChannel()
+    finished = []
+
+    async def slow_handle(message, trigger, history=""):
+        await asyncio.sleep(0.05)
+        bot.message_handler.dispatcher.enqueue(channel, "ya voy")
+        finished.append(trigger)
+    bot.message_handler.handle = slow_handle
+
+    mention = MockMessage("bisbal?", MockAuthor("Ana"), channel, mentions=[bot.user])
+    task = asyncio.create_task(bot.on_message(mention))
+    await asyncio.sleep(0)
+    await bot.shutdown()
+    await task
+
+    assert finished == ["mention"]
+    assert channel.sent == ["ya voy"]
+    assert bot.closed
+    assert Checkpoint.load(bot.config.checkpoint_file)["counters"] == {str(channel.id): 1}
+
+    # Messages arriving while closing are ignored
+    await bot.on_message(MockMessage("hola", MockAuthor("Ana"), channel))
+    assert bot.message_counter.counter[channel.id] == 1
@@ -0,0 +1,110 @@
+import sys
+import time
+import asyncio
+import pytest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+from Clock import VirtualClock
+from Helpers import ConversationWatcher, InactiveTimer, MessageHistory
+from Mocks import MockAuthor, MockChannel, MockDiscordBot, MockLLM, MockMessage, MockMessageHandler
+
+
+@pytest.mark.asyncio
+async def test_sleepers_wake_in_deadline_order():
+    clock = VirtualClock()
+    woken = []
+
+    async def sleeper(seconds):
+        await clock.sleep(seconds)
+        woken.append((seconds, clock()))
+
+    tasks = [asyncio.create_task(sleeper(s)) for s in (30, 10, 20)]
+    await clock.advance(15)
+    assert woken == [(10, 10)]
+
+    await clock.advance(100)
+    assert woken == [(10, 10), (20, 20), (30, 30)]
+    assert clock() == 115
+    await asyncio.gather(*tasks)
+
+@pytest.mark.asyncio
+async def test_cancelled_sleeper_is_skipped():
+    clock = VirtualClock()
+    task = asyncio.create_task(clock.sleep(10))
+    await asyncio.sleep(0)
+    task.cancel()
+    await clock.advance(20)
+    assert task.cancelled()
+    assert clock.next_deadline is None
+
+@pytest.mark.asyncio
+async def test_inactive_timer_runs_in_virtual_time():
+    clock = VirtualClock()
+    fired = []
+
+    async def callback():
+        fired.append(clock())
+
+    timer = InactiveTimer(seconds=30 * 60, callback=callback, sleep=clock.sleep)
+    timer.init()
+    await clock.advance(29 * 60)
+    timer.reset()
+    await clock.advance(29 * 60)
+    assert fired == []
+
+    await clock.advance(60)
+    assert fired == [29 * 60 + 30 * 60]
+
+@pytest.mark.asyncio
+async def test_conversation_watcher_runs_in_virtual_time():
+    clock = VirtualClock()
+    sweeps = []
+
+    async def callback(channels):
+        sweeps.append((clock(), channels))
+
+    watcher = ConversationWatcher(seconds=30, callback=callback, sleep=clock.sleep)
+    watcher.start()
+    watcher.mark_activity(1)
+    await clock.advance(30)
+    await clock.advance(60)
+    watcher.cancel()
+
+    assert sweeps == [(30, {1})]
+
+def test_history_stamps_messages_with_the_clock():
+    clock = VirtualClock(start=100)
+    history = MessageHistory(clock=clock)
+    channel = MockChannel()
+    assert history.last_activity(channel.id) is None
+
+    history.add(MockMessage("hola", MockAuthor("Ana"), channel))
+    assert history.last_activity(channel.id) == 100
+
+@pytest.mark.asyncio
+async def test_day_of_traffic_is_simulated_in_seconds():
+    clock = VirtualClock()
+    bot = MockDiscordBot(MockLLM(), clock=clock)
+    bot._test_user = MockAuthor("BisbalBot", bot=True, id=999)
+    bot.message_handler = MockMessageHandler(bot.llm)
+    channel = MockChannel()
+    sender = MockAuthor("Pepe")
+
+    start = time.perf_counter()
+    bot.inactive_timer.init()
+    bot.conversation_watcher.start()
+    # One message every 10 minutes during the first 12 hours, then silence.
+    for _ in range(72):
+        await bot.on_message(MockMessage("que tal", sender, channel))
+        await clock.advance(10 * 60)
+    await clock.advance(12 * 3600)
+    bot.inactive_timer.cancel()
+    bot.conversation_watcher.cancel()
+
+    assert time.perf_counter() - start < 10
+    assert bot.message_handler.inactive_calls == 24
+    # Every 10th message joins the conversation instead of waiting for the watcher
+    assert bot.message_handler.handled_messages.count("join") == 7
+    assert bot.message_handler.handled_messages.count("conversation_activity") == 72 - 7
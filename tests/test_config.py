@@ -80,3 +80,14 @@ def test_read_raises_if_context_file_missing(mock):
     with pytest.raises(FileNotFoundError):
         Config().read(str(mock.config_path))
 
+def test_read_drops_unknown_route_settings(mock, capsys):
+    mock.config_dir.mkdir()
+    mock.config_path.write_text(json.dumps({"llm_routes": {
+        "join": {"max_token": 100, "temperature": 0.5},
+        "mention": "gpt-4.1",
+    }}), encoding="utf-8")
+    cfg = Config().read(str(mock.config_path))
+
+    assert cfg.llm_routes == {"join": {"temperature": 0.5}}
+    out = capsys.readouterr().out
+    assert "'max_token'" in out and "llm_routes['mention']" in out
@@ -11,10 +11,13 @@ from Config import Config
 from Mocks import (
     MockAuthor,
     MockChannel,
+    MockConcurrency,
     MockMessage,
     MockMessageHandler,
     MockDiscordBot,
+    MockLLM,
 )
+from Helpers import DiscordMessageHandler
 
 
 @pytest.fixture
@@ -25,12 +28,7 @@ async def server():
     - channel: The channel where the conversation takes place (MockChannel)
     - sender: The user who sent the message (MockAuthor)
     """
-    fake_llm = SimpleNamespace(
-        get_response=lambda prompt: SimpleNamespace(
-            message="ok",
-            memory_proposal=None
-        )
-    )
+    fake_llm = MockLLM()
     bot = MockDiscordBot(fake_llm)
     bot._test_user = MockAuthor("BisbalBot", bot=True, id=999)
     bot.message_handler = MockMessageHandler(fake_llm)
@@ -201,7 +199,7 @@ async def test_invalid_llm_json_does_not_crash(server, monkeypatch):
         message = None
         memory_proposal = None
 
-    def fake_get_response(_):
+    async def fake_get_response(*_, **__):
         raise ValueError("LLM exploded")
 
     monkeypatch.setattr(
@@ -238,3 +236,85 @@ async def test_bot_responds_in_permitted_channel(server):
     await server.bot.on_message(msg)
 
     assert "keyword" in server.bot.message_handler.handled_messages
+
+@pytest.mark.asyncio
+async def test_handler_posts_reply_with_typing_indicator(server):
+    handler = DiscordMessageHandler(MockLLM(message="hola"))
+    msg = MockMessage("hola bisbal", server.sender, server.channel, mentions=[server.bot.user])
+    await handler.handle(msg, trigger="mention", history="")
+    await handler.dispatcher.drain()
+    assert server.channel.sent == ["hola"]
+    assert server.channel.typing_on_send == [False]
+
+@pytest.mark.asyncio
+async def test_handler_stays_silent_on_null_reply(server):
+    handler = DiscordMessageHandler(MockLLM(message=None))
+    msg = MockMessage("spam", server.sender, server.channel)
+    await handler.handle(msg, trigger="join", history="")
+    await handler.dispatcher.drain()
+    assert server.channel.sent == []
+
+@pytest.mark.asyncio
+async def test_backfill_loads_recent_messages_with_self_labels(server):
+    server.bot.config.backfill_messages = 3
+    server.channel.past_messages = [
+        MockMessage("viejo", server.sender, server.channel),
+        MockMessage("hola", server.sender, server.channel),
+        MockMessage("soy un bot", MockAuthor("OtherBot", bot=True, id=2), server.channel),
+        MockMessage("¡hola!", server.bot.user, server.channel),
+        MockMessage("que tal", server.sender, server.channel),
+    ]
+    await server.bot.on_message(MockMessage("nuevo", server.sender, server.channel))
+    await server.bot.backfill_history([server.channel])
+
+    assert server.bot.message_history.get_formatted(server.channel.id).splitlines() == [
+        "BisbalBot (you): ¡hola!",
+        "Pepe: que tal",
+        "Pepe: nuevo",
+    ]
+
+@pytest.mark.asyncio
+async def test_backfill_skips_messages_already_stored(server):
+    server.bot.config.backfill_messages = 5
+    server.channel.past_messages = [MockMessage(text, server.sender, server.channel) for text in ("uno", "dos", "tres")]
+    # Received through on_message before the backfill started
+    await server.bot.on_message(server.channel.past_messages[-1])
+
+    await server.bot.backfill_history([server.channel])
+    await server.bot.backfill_history([server.channel])
+
+    assert server.bot.message_history.get_formatted(server.channel.id) == "Pepe: uno\nPepe: dos\nPepe: tres"
+
+@pytest.mark.asyncio
+async def test_backfill_respects_concurrency_limit(server):
+    server.bot.config.backfill_messages = 5
+    server.bot.config.backfill_concurrency = 2
+    channels = [MockChannel(id=i) for i in range(6)]
+    concurrency = MockConcurrency()
+    for channel in channels:
+        channel.history_delay = 0.01
+        channel.history_concurrency = concurrency
+        channel.past_messages = [MockMessage("hola", server.sender, channel)]
+
+    await server.bot.backfill_history(channels)
+
+    assert concurrency.peak == 2
+    assert all(server.bot.message_history.get_formatted(c.id) == "Pepe: hola" for c in channels)
+
+def test_lean_client_requests_only_what_it_uses():
+    config = Config()
+    config.lean_client = True
+    config.message_cache_size = 50
+    bot = MockDiscordBot(MockLLM(config=config))
+
+    intents = bot.intents
+    assert intents.guilds and intents.guild_messages and intents.message_content
+    assert not (intents.members or intents.presences or intents.typing or intents.guild_reactions or intents.voice_states)
+    assert bot._connection.member_cache_flags.value == 0
+    assert not bot._connection._chunk_guilds
+    assert bot._connection.max_messages == 50
+
+def test_default_client_keeps_default_intents():
+    bot = MockDiscordBot(MockLLM())
+    assert bot.intents.guild_reactions and bot.intents.message_content
+    assert bot._connection.max_messages == 1000
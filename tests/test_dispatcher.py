@@ -0,0 +1,72 @@
+import sys
+import asyncio
+from collections import deque
+import pytest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+from Dispatcher import OutboundDispatcher, split_message
+from Mocks import MockChannel
+
+
+def test_short_message_is_not_split():
+    assert split_message("hola") == ["hola"]
+
+def test_long_message_is_split_on_sentence_boundaries():
+    sentence = "Esto es una frase bastante larga para rellenar. "
+    text = sentence * 100
+    parts = split_message(text, limit=500)
+
+    assert all(len(part) <= 500 for part in parts)
+    assert all(part.endswith(".") for part in parts)
+    assert " ".join(parts) == text.strip()
+
+def test_message_without_spaces_is_hard_cut():
+    assert split_message("a" * 25, limit=10) == ["a" * 10, "a" * 10, "a" * 5]
+
+@pytest.mark.asyncio
+async def test_enqueue_returns_before_sending():
+    dispatcher = OutboundDispatcher()
+    channel = MockChannel()
+    dispatcher.enqueue(channel, "hola")
+    assert channel.sent == []
+    await dispatcher.drain()
+    assert channel.sent == ["hola"]
+
+@pytest.mark.asyncio
+async def test_pending_replies_to_same_channel_are_merged():
+    dispatcher = OutboundDispatcher()
+    channel = MockChannel()
+    dispatcher.enqueue(channel, "uno")
+    dispatcher.enqueue(channel, "dos")
+    dispatcher.enqueue(channel, "tres")
+    await dispatcher.drain()
+    assert channel.sent == ["uno\ndos\ntres"]
+
+@pytest.mark.asyncio
+async def test_sends_are_paced_by_channel_rate():
+    dispatcher = OutboundDispatcher(channel_rate=(2, 0.2))
+    channel = MockChannel()
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    dispatcher.enqueue(channel, "x" * 1500)
+    dispatcher.enqueue(channel, "y" * 1500)
+    dispatcher.enqueue(channel, "z" * 1500)
+    await dispatcher.drain()
+
+    assert len(channel.sent) == 3
+    assert loop.time() - start >= 0.09
+
+@pytest.mark.asyncio
+async def test_stale_replies_are_dropped():
+    now = [0.0]
+    dispatcher = OutboundDispatcher(max_age=10, clock=lambda: now[0])
+    channel = MockChannel()
+    dispatcher.queues[channel.id] = deque([(0.0, "tarde", None)])
+    now[0] = 11
+    dispatcher.enqueue(channel, "a tiempo")
+    await dispatcher.drain()
+
+    assert channel.sent == ["a tiempo"]
+    assert dispatcher.dropped == 1
@@ -0,0 +1,125 @@
+import sys
+import json
+import pytest
+from types import SimpleNamespace
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+import Gating
+from Gating import Gate, GateClassifier, ShortCircuit
+from Helpers import DiscordMessageHandler, MessageHistory
+from Mocks import MockLLM, MockChannel, MockMessage, MockAuthor
+
+
+def samples(n: int = 40):
+    """ Greetings get a reply, technical chatter between others does not. """
+    data = []
+    for i in range(n):
+        data.append(({"trigger": "join", "history": f"Ana: bomba dia {i}\nRex: bombona dia"}, True))
+        data.append(({"trigger": "join", "history": f"Ana: el drop del mapa {i} es raro\nRex: es muy largo"}, False))
+    return data
+
+
+@pytest.fixture
+def model():
+    model = GateClassifier(buckets=2 ** 12)
+    model.train(samples())
+    return model
+
+
+def test_classifier_separates_reply_from_silence(model):
+    report = model.evaluate(samples(10), threshold=0.5)
+    assert report["precision"] == 1.0
+    assert report["recall"] == 1.0
+    assert report["skipped_calls"] == 0.5
+
+def test_gate_only_filters_configured_triggers(model):
+    gate = Gate(["join"], threshold=0.5, model=model)
+    silent = {"trigger": "join", "history": "Ana: el drop del mapa es raro"}
+    assert not gate.should_call(silent)
+    assert gate.should_call({**silent, "trigger": "mention"})
+    assert gate.skipped == 1
+
+def test_gate_without_model_lets_everything_through():
+    assert Gate(["join"], threshold=0.99).should_call({"trigger": "join", "history": ""})
+
+def test_train_command_reports_precision_and_recall(tmp_path, capsys):
+    log = tmp_path / "gate.jsonl"
+    gate = Gate(["join"], threshold=0.5, log_file=str(log))
+    for payload, replied in samples():
+        gate.record(payload, was_null=not replied)
+
+    report = Gating.main(["train", str(log), str(tmp_path / "gate.json")])
+    assert (tmp_path / "gate.json").exists()
+    assert report["recall"] > 0.9
+    assert json.loads(capsys.readouterr().out)["samples"] == report["samples"]
+
+@pytest.mark.asyncio
+async def test_handler_skips_llm_call_when_gated(model):
+    llm = MockLLM()
+    handler = DiscordMessageHandler(llm)
+    handler.gate = Gate(["conversation_activity"], threshold=0.5, model=model)
+    channel = MockChannel()
+    bot = SimpleNamespace(
+        get_all_channels=lambda: [channel],
+        message_history=SimpleNamespace(get_formatted=lambda _: "Ana: el drop del mapa es raro", last_is_self=lambda _: False),
+    )
+
+    await handler.handle_conversation_activity(bot, {channel.id})
+    assert llm.prompts == []
+    assert channel.sent == []
+
+def test_short_circuit_rules():
+    shortcut = ShortCircuit(["conversation_activity", "inactive"])
+    payload = lambda trigger, history: {"trigger": trigger, "history": history}
+
+    assert shortcut.skip_reason(payload("inactive", ""), 1) == "empty_history"
+    assert shortcut.skip_reason(payload("conversation_activity", "Ana: hola\nBisbal (you): hola Ana"), 1, last_is_self=True) == "self_last"
+    # Authorship comes from the stored entry, not from the text
+    assert shortcut.skip_reason(payload("conversation_activity", "Ana: Bisbal (you): hola"), 1) is None
+    # Direct triggers are never skipped
+    assert shortcut.skip_reason(payload("mention", "Bisbal (you): hola"), 1, last_is_self=True) is None
+
+    shortcut.record(payload("conversation_activity", "Ana: hola"), 1)
+    assert shortcut.skip_reason(payload("conversation_activity", "Ana: hola"), 1) == "unchanged"
+    assert shortcut.skip_reason(payload("conversation_activity", "Ana: hola"), 2) is None
+    assert shortcut.skip_reason(payload("inactive", "Ana: hola"), 1) is None
+    assert shortcut.skip_reason(payload("conversation_activity", "Ana: hola\nRex: buenas"), 1) is None
+
+    assert shortcut.skipped == {"empty_history": 1, "self_last": 1, "unchanged": 1}
+    assert shortcut.summary() == "LLM calls skipped locally since start: 1 empty_history, 1 self_last, 1 unchanged"
+
+@pytest.mark.asyncio
+async def test_handler_does_not_resend_unchanged_history():
+    llm = MockLLM(message=None)
+    handler = DiscordMessageHandler(llm)
+    channel = MockChannel()
+    history = ["Ana: hola"]
+    bot = SimpleNamespace(
+        get_all_channels=lambda: [channel],
+        message_history=SimpleNamespace(get_formatted=lambda _: "\n".join(history), last_is_self=lambda _: False),
+    )
+
+    await handler.handle_inactive(bot)
+    await handler.handle_inactive(bot)
+    assert len(llm.prompts) == 1
+
+    history.append("Rex: buenas")
+    await handler.handle_inactive(bot)
+    assert len(llm.prompts) == 2
+    assert handler.shortcut.skipped == {"unchanged": 1}
+
+@pytest.mark.asyncio
+async def test_handler_skips_after_multiline_self_message():
+    llm = MockLLM()
+    handler = DiscordMessageHandler(llm)
+    channel = MockChannel()
+    history = MessageHistory()
+    history.add(MockMessage("hola", MockAuthor("Ana"), channel))
+    history.add(MockMessage("hola Ana\n¿qué tal?", MockAuthor("Bisbal"), channel), is_self=True)
+    bot = SimpleNamespace(get_all_channels=lambda: [channel], message_history=history)
+
+    await handler.handle_conversation_activity(bot, {channel.id})
+    assert llm.prompts == []
+    assert handler.shortcut.skipped == {"self_last": 1}
@@ -0,0 +1,345 @@
+import sys
+import json
+import asyncio
+import pytest
+from types import SimpleNamespace
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+from Config import Config
+from Mocks import MockOpenAI, MockChannel
+from Helpers import DiscordMessageHandler
+import GptWrapper
+from GptWrapper import BisbalWrapper, Response, StreamingEnvelopeParser
+
+
+class FakeStream:
+    """
+    Mimics the async stream returned by chat.completions.create(stream=True).
+    """
+    def __init__(self, text: str, chunk_size: int = 3):
+        self.chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+        self.consumed = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.consumed >= len(self.chunks):
+            raise StopAsyncIteration
+        delta = self.chunks[self.consumed]
+        self.consumed += 1
+        return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def llm():
+    config = Config()
+    config.response_use_llm = True
+    config.stream_response = True
+    wrapper = BisbalWrapper(config)
+
+    def use_stream(text):
+        stream = FakeStream(text)
+
+        async def create(**kwargs):
+            assert kwargs["stream"] is True
+            return stream
+
+        wrapper.backend.endpoints[0].client = MockOpenAI(create)
+        return stream
+
+    return SimpleNamespace(wrapper=wrapper, use_stream=use_stream)
+
+
+def test_parser_detects_complete_response():
+    parser = StreamingEnvelopeParser()
+    assert not parser.feed('{"response": "hola ')
+    assert parser.feed('\\"amigo\\"", "cont')
+    assert parser.message == 'hola "amigo"'
+    assert not parser.is_null
+
+def test_parser_detects_null_response():
+    parser = StreamingEnvelopeParser()
+    assert parser.feed('{"response":  null')
+    assert parser.is_null
+
+@pytest.mark.asyncio
+async def test_stream_stops_early_on_null(llm):
+    envelope = json.dumps({"response": None, "context": "x" * 300})
+    stream = llm.use_stream(envelope)
+    response = await llm.wrapper.get_response("{}")
+
+    assert response.message is None
+    assert stream.closed
+    assert stream.consumed < len(stream.chunks)
+
+@pytest.mark.asyncio
+async def test_stream_posts_before_context_is_generated(llm):
+    stream = llm.use_stream(json.dumps({"response": "¡Hola!", "context": "Pepe saluda"}))
+    posted = []
+
+    async def on_message(message):
+        posted.append((message, stream.consumed))
+
+    response = await llm.wrapper.get_response("{}", on_message=on_message)
+
+    assert posted[0][0] == "¡Hola!"
+    assert posted[0][1] < len(stream.chunks)
+    assert response.delivered
+    assert response.memory_proposal == "Pepe saluda"
+
+@pytest.fixture
+def batch_llm():
+    config = Config()
+    config.response_use_llm = True
+    wrapper = BisbalWrapper(config)
+    requests = []
+
+    async def create(**kwargs):
+        channels = json.loads(kwargs["messages"][1]["content"])["channels"]
+        requests.append(channels)
+        replies = {key: {"response": f"hola {key}" if key != "2" else None, "context": None} for key in channels}
+        content = json.dumps({"channels": replies})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    wrapper.backend.endpoints[0].client = MockOpenAI(create)
+    return SimpleNamespace(wrapper=wrapper, config=config, requests=requests)
+
+
+@pytest.mark.asyncio
+async def test_batch_routes_each_decision_to_its_channel(batch_llm):
+    payloads = {str(i): {"trigger": "conversation_activity", "history": "Ana: hola"} for i in range(1, 4)}
+    responses = await batch_llm.wrapper.get_batch_response(payloads)
+
+    assert len(batch_llm.requests) == 1
+    assert responses["1"].message == "hola 1"
+    assert responses["2"].message is None
+    assert responses["3"].message == "hola 3"
+
+@pytest.mark.asyncio
+async def test_batch_is_split_by_token_budget(batch_llm):
+    batch_llm.config.batch_token_budget = 60
+    payloads = {str(i): {"trigger": "conversation_activity", "history": "Ana: " + "x" * 150} for i in range(1, 4)}
+    responses = await batch_llm.wrapper.get_batch_response(payloads)
+
+    assert [len(r) for r in batch_llm.requests] == [1, 1, 1]
+    assert set(responses) == {"1", "2", "3"}
+
+@pytest.mark.asyncio
+async def test_batched_conversation_activity_posts_in_each_channel(batch_llm):
+    batch_llm.config.batch_conversation_activity = True
+    channels = [MockChannel(id=1, name="general"), MockChannel(id=2, name="memes")]
+    bot = SimpleNamespace(
+        get_all_channels=lambda: channels,
+        message_history=SimpleNamespace(get_formatted=lambda _: "Ana: hola", last_is_self=lambda _: False),
+    )
+    handler = DiscordMessageHandler(batch_llm.wrapper)
+
+    await handler.handle_conversation_activity(bot, {1, 2})
+    await handler.dispatcher.drain()
+
+    assert len(batch_llm.requests) == 1
+    assert channels[0].sent == ["hola 1"]
+    assert channels[1].sent == []
+
+@pytest.mark.parametrize("raw, path", [
+    ('{"response": "hola", "context": null}', "direct"),
+    ('```json\n{"response": "hola", "context": null}\n```', "fenced"),
+    ('Claro: {"response": "hola", "context": null} espero que sirva', "embedded"),
+])
+def test_response_recovers_noisy_envelopes(raw, path):
+    before = GptWrapper.PARSE_STATS[path]
+    response = Response(raw)
+    assert response.message == "hola"
+    assert GptWrapper.PARSE_STATS[path] == before + 1
+
+def test_response_without_envelope_is_silent():
+    before = GptWrapper.PARSE_STATS["failed"]
+    response = Response("lo siento, no puedo")
+    assert response.message is None
+    assert response.memory_proposal is None
+    assert GptWrapper.PARSE_STATS["failed"] == before + 1
+
+@pytest.mark.asyncio
+async def test_json_mode_is_requested_when_endpoint_supports_it(batch_llm):
+    sent = {}
+
+    async def create(**kwargs):
+        sent.update(kwargs)
+        content = 'Aquí tienes:\n```json\n{"response": "hola", "context": null}\n```'
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    endpoint = batch_llm.wrapper.backend.endpoints[0]
+    endpoint.client = MockOpenAI(create)
+    assert endpoint.json_mode
+
+    response = await batch_llm.wrapper.get_response("{}")
+    assert sent["response_format"] == {"type": "json_object"}
+    assert response.message == "hola"
+
+@pytest.mark.asyncio
+async def test_summarize_uses_its_own_token_limit(batch_llm):
+    sent = {}
+
+    async def create(**kwargs):
+        sent.update(kwargs)
+        content = json.dumps({"summary": "Ana y Rex hablan de mapas"})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    batch_llm.wrapper.backend.endpoints[0].client = MockOpenAI(create)
+    summary = await batch_llm.wrapper.summarize(None, ["Ana: hola", "Rex: mapas"], max_tokens=80)
+
+    assert summary == "Ana y Rex hablan de mapas"
+    assert sent["max_tokens"] == 80
+    assert batch_llm.wrapper.context == batch_llm.config.initial_context
+
+@pytest.mark.asyncio
+async def test_context_is_compacted_past_the_limit(batch_llm):
+    wrapper, config = batch_llm.wrapper, batch_llm.config
+    config.initial_context = "Eres Bisbal."
+    config.max_context_length = 50
+    wrapper.context = config.initial_context
+    sent = {}
+    release = asyncio.Event()
+
+    async def create(**kwargs):
+        sent.update(kwargs)
+        await release.wait()
+        content = json.dumps({"memory": "Ana vive en Almería\nRex odia los lunes"})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    wrapper.backend.endpoints[0].client = MockOpenAI(create)
+    for memory in ["Ana vive en Madrid", "Ana se mudó a Almería", "Rex odia los lunes", "Rex odia los lunes"]:
+        wrapper.store_context(Response(json.dumps({"response": None, "context": memory})))
+    while not sent:
+        await asyncio.sleep(0)
+    # Learned while the digest is being written
+    wrapper.store_context(Response(json.dumps({"response": None, "context": "Leo toca la guitarra"})))
+    release.set()
+    await wrapper._compaction
+
+    assert "Eres Bisbal." not in sent["messages"][1]["content"]
+    assert sent["messages"][1]["content"].splitlines()[-1] == "Rex odia los lunes"
+    assert wrapper.context == "Eres Bisbal.\nAna vive en Almería\nRex odia los lunes\nLeo toca la guitarra"
+
+@pytest.mark.asyncio
+async def test_context_is_reset_without_compaction(batch_llm):
+    wrapper, config = batch_llm.wrapper, batch_llm.config
+    config.context_compaction = False
+    config.max_context_length = 30
+    for memory in ["Ana vive en Madrid", "Rex odia los lunes", "Leo toca la guitarra"]:
+        wrapper.store_context(Response(json.dumps({"response": None, "context": memory})))
+
+    assert wrapper.context == f"{config.initial_context}\nLeo toca la guitarra"
+    assert wrapper._compaction is None
+
+@pytest.mark.asyncio
+async def test_routes_set_the_request_of_each_trigger(batch_llm):
+    wrapper, config = batch_llm.wrapper, batch_llm.config
+    config.llm_routes = {
+        "conversation_activity": {"model": "gpt-4.1-nano", "max_tokens": 120, "temperature": 0.5, "timeout": 4},
+        "mention": {"model": {"other": "llama"}},
+    }
+    sent = []
+
+    async def create(**kwargs):
+        sent.append(kwargs)
+        content = json.dumps({"response": None, "context": None})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    wrapper.backend.endpoints[0].client = MockOpenAI(create)
+    await wrapper.get_response("{}", trigger="conversation_activity")
+    await wrapper.get_response("{}", trigger="mention")
+
+    speculative, mention = sent
+    assert (speculative["model"], speculative["max_tokens"], speculative["temperature"], speculative["timeout"]) == \
+        ("gpt-4.1-nano", 120, 0.5, 4)
+    # Unrouted settings, and models of other endpoints, keep the defaults
+    assert (mention["model"], mention["max_tokens"], mention["temperature"]) == ("gpt-4o-mini", 500, 0.9)
+    assert "timeout" not in mention
+    assert "conversation_activity -> gpt-4.1-nano" in wrapper.ledger.report("daily")
+
+@pytest.mark.asyncio
+async def test_history_session_sends_only_new_messages(batch_llm):
+    wrapper, config = batch_llm.wrapper, batch_llm.config
+    config.history_sessions = True
+    config.history_session_max_turns = 3
+    sent = []
+
+    async def create(**kwargs):
+        sent.append(kwargs["messages"])
+        content = json.dumps({"response": "vale", "context": None})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    wrapper.backend.endpoints[0].client = MockOpenAI(create)
+    channel = MockChannel(id=7)
+
+    async def ask(history):
+        await wrapper.get_response(json.dumps({"trigger": "mention", "history": history}), trigger="mention", channel=channel)
+        return json.loads(sent[-1][-1]["content"]), sent[-1]
+
+    first, _ = await ask("(summary of earlier messages): saludos\nAna: hola\nRex: buenas")
+    assert first["history"].startswith("(summary of earlier messages)")
+
+    second, messages = await ask("(summary of earlier messages): saludos y mapas\nAna: hola\nRex: buenas\nAna: @Bisbal")
+    assert second == {"trigger": "mention", "new_history": "Ana: @Bisbal"}
+    # The previous turn is resent unchanged, as a cacheable prefix
+    assert messages[1:3] == sent[0][1:] + [{"role": "assistant", "content": '{"response": "vale", "context": null}'}]
+
+    # The oldest messages left the window
+    third, messages = await ask("Ana: @Bisbal\nBisbal (you): vale\nLeo: yo también")
+    assert third["new_history"] == "Bisbal (you): vale\nLeo: yo también"
+    assert len(messages) == 6
+
+    # After history_session_max_turns the session starts over with the full history
+    fourth, messages = await ask("Ana: @Bisbal\nBisbal (you): vale\nLeo: yo también\nRex: adiós")
+    assert "new_history" not in fourth and len(messages) == 2
+
+    # A history that does not continue the session also starts over
+    fifth, _ = await ask("Eva: ¿alguien juega?")
+    assert fifth["history"] == "Eva: ¿alguien juega?"
+
+@pytest.mark.asyncio
+async def test_history_session_starts_over_when_memory_changes(batch_llm):
+    wrapper, config = batch_llm.wrapper, batch_llm.config
+    config.history_sessions = True
+    contexts = iter(["Ana vive en Almería", None, None])
+    sent = []
+
+    async def create(**kwargs):
+        sent.append(kwargs["messages"])
+        content = json.dumps({"response": "vale", "context": next(contexts)})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    wrapper.backend.endpoints[0].client = MockOpenAI(create)
+    channel = MockChannel(id=7)
+    history = ["Ana: hola"]
+
+    async def ask():
+        await wrapper.get_response(json.dumps({"trigger": "mention", "history": "\n".join(history)}), trigger="mention", channel=channel)
+        return json.loads(sent[-1][-1]["content"])
+
+    await ask()
+    history.append("Rex: buenas")
+    # The learned memory changed the system message: resending the turns would not hit the cache
+    assert (await ask())["history"] == "Ana: hola\nRex: buenas"
+    history.append("Leo: hey")
+    assert (await ask())["new_history"] == "Leo: hey"
+    assert sent[-1][0]["content"] == sent[-2][0]["content"]
+
+@pytest.mark.parametrize("channels", [["1", "2"], "ninguno", {"1": "hola", "2": {"response": "buenas", "context": None}}])
+def test_malformed_batch_channels_stay_silent(channels):
+    GptWrapper.PARSE_STATS.clear()
+    batch = GptWrapper.BatchResponse(json.dumps({"channels": channels}), ["1", "2"])
+
+    assert batch.responses["1"].message is None
+    expected = "buenas" if isinstance(channels, dict) else None
+    assert batch.responses["2"].message == expected
+    # The completion is parsed once, not once per channel
+    assert GptWrapper.PARSE_STATS == {"direct": 1}
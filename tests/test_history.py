@@ -0,0 +1,124 @@
+import sys
+import json
+import asyncio
+import pytest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+from Helpers import HistorySummarizer, MessageCounter, MessageHistory
+from Mocks import MockAuthor, MockChannel, MockMessage
+
+
+class SlowSummaryLLM:
+    def __init__(self, delay: float = 0.05):
+        self.delay = delay
+        self.calls = []
+
+    async def summarize(self, summary, lines, max_tokens):
+        self.calls.append((summary, list(lines)))
+        await asyncio.sleep(self.delay)
+        return f"{summary or ''}[{len(lines)} msgs]"
+
+
+@pytest.fixture
+def history():
+    llm = SlowSummaryLLM()
+    history = MessageHistory(max_messages=3, summarizer=HistorySummarizer(llm, batch_size=2))
+    return history, llm, MockChannel(), MockAuthor("Pepe")
+
+
+@pytest.mark.asyncio
+async def test_evicted_messages_are_summarized_in_background(history):
+    history, llm, channel, author = history
+    for i in range(5):
+        history.add(MockMessage(f"m{i}", author, channel))
+
+    # The summary is not awaited by add() nor by get_formatted()
+    assert history.get_formatted(channel.id) == "Pepe: m2\nPepe: m3\nPepe: m4"
+    await asyncio.sleep(0.1)
+
+    assert llm.calls == [(None, ["Pepe: m0", "Pepe: m1"])]
+    assert history.get_formatted(channel.id).splitlines() == [
+        "(summary of earlier messages): [2 msgs]",
+        "Pepe: m2",
+        "Pepe: m3",
+        "Pepe: m4",
+    ]
+
+@pytest.mark.asyncio
+async def test_summary_is_updated_incrementally(history):
+    history, llm, channel, author = history
+    for i in range(7):
+        history.add(MockMessage(f"m{i}", author, channel))
+        await asyncio.sleep(0.06)
+
+    assert [lines for _, lines in llm.calls] == [["Pepe: m0", "Pepe: m1"], ["Pepe: m2", "Pepe: m3"]]
+    assert llm.calls[1][0] == "[2 msgs]"
+    assert history.summarizer.get(channel.id) == "[2 msgs][2 msgs]"
+
+def test_history_without_summarizer_only_keeps_tail():
+    history = MessageHistory(max_messages=2)
+    channel, author = MockChannel(), MockAuthor("Pepe")
+    for i in range(3):
+        history.add(MockMessage(f"m{i}", author, channel))
+    assert history.get_formatted(channel.id) == "Pepe: m1\nPepe: m2"
+
+def simulate_joins(counter: MessageCounter, now: list, interval: float, hours: float) -> int:
+    joins = 0
+    for _ in range(int(hours * 3600 / interval)):
+        now[0] += interval
+        if counter.increment(1):
+            counter.reset(1)
+            joins += 1
+    return joins
+
+def test_fixed_threshold_without_target():
+    counter = MessageCounter(max_messages=3)
+    assert [counter.increment(1) for _ in range(3)] == [False, False, True]
+
+@pytest.mark.parametrize("interval", [5, 30, 120])
+def test_adaptive_threshold_aims_for_target_joins(interval):
+    now = [0.0]
+    counter = MessageCounter(target_per_hour=6, bounds=(2, 200), half_life=600, clock=lambda: now[0])
+    simulate_joins(counter, now, interval, hours=1)  # warm up the rate estimate
+
+    assert counter.rate(1) == pytest.approx(3600 / interval, rel=0.1)
+    assert simulate_joins(counter, now, interval, hours=2) == pytest.approx(12, abs=1)
+
+def test_adaptive_threshold_stays_within_bounds():
+    now = [0.0]
+    counter = MessageCounter(target_per_hour=6, bounds=(3, 20), clock=lambda: now[0])
+    simulate_joins(counter, now, interval=1, hours=1)
+    assert counter.threshold(1) == 20
+
+    # After a long silence the rate decays and the threshold falls to its floor
+    now[0] += 6 * 3600
+    assert counter.threshold(1) == 3
+
+def test_young_rate_estimate_keeps_fixed_threshold():
+    now = [0.0]
+    counter = MessageCounter(max_messages=10, target_per_hour=6, bounds=(2, 200), half_life=600, clock=lambda: now[0])
+    # A busy channel: one message every 5 seconds, 720 per hour
+    simulate_joins(counter, now, interval=5, hours=0.16)
+    assert counter.threshold(1) == 10
+
+    simulate_joins(counter, now, interval=5, hours=0.01)
+    assert counter.rate(1) == pytest.approx(720, rel=0.05)
+    assert counter.threshold(1) == pytest.approx(120, rel=0.05)
+
+def test_rate_estimate_survives_checkpoint():
+    now = [0.0]
+    counter = MessageCounter(target_per_hour=6, bounds=(2, 200), half_life=600, clock=lambda: now[0])
+    simulate_joins(counter, now, interval=5, hours=1)
+    state = json.loads(json.dumps(counter.snapshot()))
+
+    later = [5000.0]
+    restored = MessageCounter(target_per_hour=6, bounds=(2, 200), half_life=600, clock=lambda: later[0])
+    restored.restore(state, elapsed=0)
+    assert restored.rate(1) == pytest.approx(counter.rate(1))
+    assert restored.threshold(1) == counter.threshold(1)
+
+    # Ten minutes down count as one half-life of silence
+    restored.restore(state, elapsed=600)
+    assert restored.rate(1) == pytest.approx(counter.rate(1) / 2, rel=0.05)
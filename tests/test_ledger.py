@@ -0,0 +1,121 @@
+import sys
+import json
+import pytest
+from types import SimpleNamespace
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+from Config import Config
+from Ledger import BudgetExceededError, CostLedger
+from GptWrapper import BisbalWrapper
+from Mocks import MockChannel, MockOpenAI
+
+PRICES = {"gpt-4o-mini": [1.0, 0.5, 2.0]}
+# 2026-10-18 12:00 UTC
+NOW = 1792324800.0
+
+
+def test_cost_uses_cached_price():
+    ledger = CostLedger(prices=PRICES)
+    assert ledger.cost("gpt-4o-mini", 1_000_000, 400_000, 500_000) == pytest.approx(0.6 + 0.2 + 1.0)
+    assert ledger.cost("unknown", 1000, 0, 1000) == 0.0
+
+def test_calls_are_written_in_batches(tmp_path):
+    path = tmp_path / "ledger.sqlite"
+    ledger = CostLedger(str(path), PRICES, flush_size=3)
+    for _ in range(2):
+        ledger.record("mention", (1, 123, "general"), "gpt-4o-mini", 100, 0, 10, 0.5, False)
+    assert len(ledger.pending) == 2
+
+    ledger.record("join", (1, 123, "general"), "gpt-4o-mini", 100, 0, 10, 0.5, True)
+    assert ledger.pending == []
+    ledger.close()
+
+    reopened = CostLedger(str(path), PRICES)
+    rows = reopened._db.execute("SELECT trigger, channel, is_null FROM calls").fetchall()
+    assert rows == [("mention", "general", 0), ("mention", "general", 0), ("join", "general", 1)]
+
+def test_spend_survives_a_restart(tmp_path):
+    path = str(tmp_path / "ledger.sqlite")
+    ledger = CostLedger(path, PRICES, clock=lambda: NOW)
+    ledger.record("mention", (1, 123, "general"), "gpt-4o-mini", 1_000_000, 0, 0, 0.5, False)
+    ledger.close()
+
+    budgets = [{"channel": "general", "daily": 1.0}]
+    reopened = CostLedger(path, PRICES, budgets, clock=lambda: NOW)
+    assert not reopened.allows("mention", (1, 123, "general"))
+
+def test_budgets_match_channel_and_trigger():
+    now = [NOW]
+    budgets = [{"channel": "*", "trigger": "conversation_activity", "daily": 0.5}]
+    ledger = CostLedger(prices=PRICES, budgets=budgets, clock=lambda: now[0])
+    ledger.record("conversation_activity", (1, 123, "general"), "gpt-4o-mini", 500_000, 0, 0, 1.0, True)
+
+    with pytest.raises(BudgetExceededError):
+        ledger.check("conversation_activity", (1, 456, "mapping"))
+    ledger.check("mention", (1, 123, "general"))
+    assert ledger.rejected == 1
+
+    # The next day starts with a fresh daily budget
+    now[0] += 24 * 3600
+    ledger.check("conversation_activity", (1, 456, "mapping"))
+
+def test_report_summarizes_spend():
+    budgets = [{"channel": "general", "trigger": "*", "daily": 2.0}]
+    ledger = CostLedger(prices=PRICES, budgets=budgets, clock=lambda: NOW)
+    ledger.record("mention", (1, 123, "general"), "gpt-4o-mini", 1_000_000, 0, 0, 0.5, False)
+    ledger.record("join", (1, 456, "mapping"), "gpt-4o-mini", 0, 0, 1_000_000, 0.5, True)
+
+    report = ledger.report("daily")
+    assert report.startswith("Spend 2026-10-18: $3.0000 in 2 calls (1 null)")
+    assert "$2.0000      1 calls  mapping" in report
+    assert "$2.0000      1 calls    500 ms avg     1 null  join -> gpt-4o-mini" in report
+    assert "general/*: $1.0000 of $2.00" in report
+
+
+@pytest.fixture
+def llm():
+    config = Config()
+    config.response_use_llm = True
+    config.stream_response = False
+    config.llm_prices = PRICES
+    wrapper = BisbalWrapper(config)
+
+    async def create(**kwargs):
+        content = json.dumps({"response": None, "context": None})
+        usage = SimpleNamespace(prompt_tokens=1000, completion_tokens=10,
+                                prompt_tokens_details=SimpleNamespace(cached_tokens=800))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+    wrapper.backend.endpoints[0].client = MockOpenAI(create)
+    return wrapper
+
+@pytest.mark.asyncio
+async def test_responses_are_recorded_with_usage(llm):
+    await llm.get_response("{}", trigger="mention", channel=MockChannel())
+    llm.ledger.flush()
+
+    row = llm.ledger._db.execute(
+        "SELECT channel_id, channel, trigger, prompt_tokens, cached_tokens, completion_tokens, is_null FROM calls"
+    ).fetchone()
+    assert row == (123, "general", "mention", 1000, 800, 10, 1)
+
+@pytest.mark.asyncio
+async def test_batch_cost_is_split_between_channels(llm):
+    channels = {"1": MockChannel(id=1), "2": MockChannel(id=2, name="mapping")}
+    await llm.get_batch_response({"1": {}, "2": {}}, channels=channels)
+    llm.ledger.flush()
+
+    rows = llm.ledger._db.execute("SELECT channel, prompt_tokens, completion_tokens FROM calls").fetchall()
+    assert rows == [("general", 500, 5), ("mapping", 500, 5)]
+
+@pytest.mark.asyncio
+async def test_spent_budget_blocks_the_call(llm):
+    llm.ledger.budgets = [{"channel": "general", "daily": 0.0}]
+    with pytest.raises(BudgetExceededError):
+        await llm.get_response("{}", trigger="mention", channel=MockChannel())
+
+    responses = await llm.get_batch_response({"123": {}, "2": {}},
+                                             channels={"123": MockChannel(), "2": MockChannel(id=2, name="mapping")})
+    assert list(responses) == ["2"]
@@ -0,0 +1,133 @@
+import sys
+import dataclasses
+import asyncio
+import openai
+import pytest
+from types import SimpleNamespace
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+from Config import Config, ROUTE_KEYS
+from Clock import VirtualClock
+from GptWrapper import BisbalWrapper
+from LlmBackend import BackendPool, Endpoint, Route
+from StubServer import StubLLMServer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def rate_limit_error(retry_after=None):
+    headers = {"retry-after": retry_after} if retry_after else {}
+    response = SimpleNamespace(status_code=429, headers=headers, request=None)
+    return openai.RateLimitError("slow down", response=response, body=None)
+
+
+@pytest.fixture
+def pool():
+    clock = FakeClock()
+    endpoints = [Endpoint("a"), Endpoint("b")]
+    return BackendPool(endpoints, cooldown=30, failure_threshold=2, clock=clock)
+
+
+def test_pool_is_built_from_config():
+    config = Config()
+    config.llm_endpoints = [
+        {"name": "main", "model": "gpt-4o-mini"},
+        {"name": "local", "model": "llama", "base_url": "http://localhost:8000/v1"},
+    ]
+    pool = BackendPool.from_config(config)
+    assert [e.name for e in pool.endpoints] == ["main", "local"]
+    assert pool.endpoints[1].base_url == "http://localhost:8000/v1"
+    # One connection pool for every endpoint
+    assert pool.http_client is not None
+    assert pool.endpoints[0].http_client is pool.endpoints[1].http_client is pool.http_client
+
+@pytest.mark.asyncio
+async def test_least_outstanding_spreads_concurrent_requests(pool):
+    async with pool.lease() as first:
+        async with pool.lease() as second:
+            assert first is not second
+            assert first.outstanding == second.outstanding == 1
+
+    assert all(e.outstanding == 0 for e in pool.endpoints)
+
+@pytest.mark.asyncio
+async def test_rate_limited_endpoint_cools_down(pool):
+    with pytest.raises(openai.RateLimitError):
+        async with pool.lease() as endpoint:
+            raise rate_limit_error("7")
+
+    limited = endpoint
+    for _ in range(3):
+        assert pool.pick() is not limited
+
+    pool.clock.now = 8
+    assert limited.is_available(pool.clock())
+
+@pytest.mark.asyncio
+async def test_latency_balance_prefers_fastest_endpoint(pool):
+    pool.balance = BackendPool.LATENCY
+    pool.endpoints[0].latency = 2.0
+    pool.endpoints[1].latency = 0.5
+    assert pool.pick().name == "b"
+
+@pytest.mark.asyncio
+async def test_failing_endpoint_is_taken_out_of_rotation(pool):
+    for _ in range(2):
+        with pytest.raises(TimeoutError):
+            async with pool.lease() as endpoint:
+                pool.endpoints[1].last_picked = 10 ** 6  # keep picking the same endpoint
+                raise TimeoutError()
+
+    assert not endpoint.is_available(pool.clock())
+    assert pool.status()[0]["available"] is False
+
+@pytest.mark.asyncio
+async def test_warm_connection_is_reused():
+    server = StubLLMServer(latency=0, chunk_interval=0)
+    config = Config()
+    config.response_use_llm = True
+    config.llm_endpoints = [{"name": "stub", "base_url": await server.start()}]
+    wrapper = BisbalWrapper(config)
+    try:
+        await wrapper.warm_up()
+        for _ in range(3):
+            await wrapper.get_response("{}", trigger="mention")
+    finally:
+        await wrapper.close()
+        await server.stop()
+
+    assert server.stats["models"] == 1
+    assert server.stats["requests"] == 3
+    assert server.stats["connections"] == 1
+
+@pytest.mark.asyncio
+async def test_keep_warm_pings_idle_endpoints_only():
+    clock = VirtualClock()
+    pings = []
+
+    async def list_models():
+        pings.append(clock())
+
+    endpoint = Endpoint("a", client=SimpleNamespace(models=SimpleNamespace(list=list_models)))
+    pool = BackendPool([endpoint], clock=clock)
+    task = asyncio.create_task(pool.keep_warm(60, clock.sleep))
+
+    await clock.advance(90)
+    async with pool.lease():
+        pass
+    await clock.advance(90)
+    task.cancel()
+
+    # Idle at 60 and at 180; at 120 the request of 90 kept the connection open
+    assert pings == [60, 180]
+
+def test_route_keys_match_route_fields():
+    assert set(ROUTE_KEYS) == {field.name for field in dataclasses.fields(Route)}
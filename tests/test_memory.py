@@ -0,0 +1,78 @@
+import sys
+import json
+import pytest
+from types import SimpleNamespace
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+from Config import Config
+from Memory import MemoryIndex, tokenize
+from GptWrapper import BisbalWrapper, memory_query
+from Mocks import MockOpenAI
+
+MEMORIES = [
+    "Rex juega Beat Saber en dificultad Expert+",
+    "Ana está haciendo un mapa de Bad Apple",
+    "Pepe odia los mapas con muchas bombas",
+    "A Rex le gusta el café sin azúcar",
+    "Ana vive en Valencia",
+]
+
+
+def test_tokenize_ignores_case_and_accents():
+    assert tokenize("¿Qué tal, Ana? Café!") == ["que", "tal", "ana", "cafe"]
+
+def test_search_ranks_relevant_lines():
+    index = MemoryIndex()
+    for line in MEMORIES:
+        index.add(line)
+
+    assert index.search("Ana: he terminado el mapa", k=1) == ["Ana está haciendo un mapa de Bad Apple"]
+    # Results keep the order in which they were learned
+    assert index.search("que toma Rex? cafe", k=2) == [MEMORIES[0], MEMORIES[3]]
+    assert index.search("nada que ver", k=3) == []
+
+def test_oldest_lines_are_forgotten():
+    index = MemoryIndex(max_lines=2)
+    for line in MEMORIES[:3]:
+        index.add(line)
+
+    assert len(index) == 2
+    assert index.search("Rex Beat Saber", k=5) == []
+    assert "rex" not in index.postings
+
+def test_memory_query_uses_the_payload_fields():
+    prompt = json.dumps({"trigger": "mention", "author": "Ana", "message": "hola", "history": "Rex: ey"})
+    assert memory_query(prompt) == "Ana\nhola\nRex: ey"
+    assert memory_query("texto libre") == "texto libre"
+
+
+@pytest.mark.asyncio
+async def test_only_relevant_memories_are_sent():
+    config = Config()
+    config.response_use_llm = True
+    config.stream_response = False
+    config.initial_context = "Eres Bisbal."
+    config.memory_retrieval = True
+    config.memory_top_k = 1
+    wrapper = BisbalWrapper(config)
+    for line in MEMORIES:
+        wrapper.memory.add(line)
+
+    sent = []
+
+    async def create(**kwargs):
+        sent.append(kwargs["messages"][0]["content"])
+        content = json.dumps({"response": "hola", "context": "Pepe se ha comprado un mando nuevo"})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    wrapper.backend.endpoints[0].client = MockOpenAI(create)
+    await wrapper.get_response(json.dumps({"author": "Pepe", "message": "otra vez bombas..."}))
+
+    system = sent[0]
+    assert system.index("Eres Bisbal.") < system.index("Pepe odia los mapas con muchas bombas")
+    assert "Valencia" not in system
+    # The proposal goes to the index, the context stays the static persona
+    assert wrapper.context == "Eres Bisbal."
+    assert len(wrapper.memory) == len(MEMORIES) + 1
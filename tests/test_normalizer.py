@@ -0,0 +1,48 @@
+import sys
+import pytest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+import Normalizer
+from Normalizer import MessageNormalizer
+from Helpers import MessageHistory
+from Mocks import MockAuthor, MockChannel, MockMessage
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("<@42> mira esto", "@Rex mira esto"),
+    ("<@!42> y <@7>", "@Rex y @alguien"),
+    ("pasaos por <#5>", "pasaos por #mapping"),
+    ("<@&9> atentos", "@mods atentos"),
+    ("que risa <:pepega:123456789012345678> <a:dance:98765>", "que risa :pepega: :dance:"),
+    ("https://replay.beatleader.com/?scoreId=28568255 que swing", "replay.beatleader.com que swing"),
+    ("mira https://www.youtube.com/watch?v=abc", "mira youtube.com"),
+    ("jajajajajajaja", "jajaja"),
+    ("noooooooo!!!!!!!", "nooo!!!"),
+    ("sin   cambios  aqui", "sin cambios aqui"),
+    ("bomba dia", "bomba dia"),
+    ("saqué 1000000 puntos, id 77777777", "saqué 1000000 puntos, id 77777777"),
+    ("mira:\n```py\nif  x:\n    print('aaaaaaa')\n```\njajajajaja", "mira:\n```py\nif  x:\n    print('aaaaaaa')\n```\njajaja"),
+])
+def test_normalize(raw, expected):
+    normalizer = MessageNormalizer()
+    assert normalizer.normalize(raw, users={42: "Rex"}, roles={9: "mods"}, channels={5: "mapping"}) == expected
+
+def test_history_stores_normalized_content():
+    history = MessageHistory()
+    rex = MockAuthor("Rex", id=42)
+    msg = MockMessage("<@42> jajajajajaja https://example.com/a/b", MockAuthor("Pepe"), MockChannel(), mentions=[rex])
+    history.add(msg)
+    assert history.get_formatted(msg.channel.id) == "Pepe: @Rex jajaja example.com"
+
+def test_measurement_reports_token_reduction(tmp_path):
+    recording = tmp_path / "recording.txt"
+    recording.write_text(
+        "Limpiaparabrisas Bosch: https://replay.beatleader.com/?scoreId=28568255\n"
+        "Rex: jajajajajajajajajajaja <:pepega:123456789012345678>\n"
+        "Ana: hola\n",
+        encoding="utf-8",
+    )
+    before, after = Normalizer.main([str(recording)])
+    assert after < before
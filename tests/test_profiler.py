@@ -0,0 +1,106 @@
+import sys
+import time
+import asyncio
+import pytest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+from Profiler import LoopLagMonitor, SamplingProfiler
+from Mocks import MockDiscordBot, MockInteraction, MockLLM
+
+
+def busy_wait(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+@pytest.mark.asyncio
+async def test_blocking_call_is_reported(tmp_path):
+    profiler = SamplingProfiler(interval=0.002, block_threshold=0.05, output_dir=str(tmp_path))
+
+    async def block_soon():
+        await asyncio.sleep(0.05)
+        busy_wait(0.3)
+
+    task = asyncio.create_task(block_soon())
+    report = await profiler.run(0.6)
+    await task
+
+    assert report.samples > 0
+    assert report.blocks >= 1
+    assert report.longest_block >= 0.2
+    assert any("busy_wait" in stack for stack in report.blocking_stacks)
+    assert "busy_wait" in report.summary()
+    assert not profiler.running
+
+    folded = Path(report.path).read_text(encoding="utf-8").splitlines()
+    assert folded and all(line.rsplit(" ", 1)[1].isdigit() for line in folded)
+
+@pytest.mark.asyncio
+async def test_only_one_profile_runs_at_a_time():
+    profiler = SamplingProfiler(output_dir=None)
+    task = asyncio.create_task(profiler.run(0.2))
+    await asyncio.sleep(0.05)
+    with pytest.raises(RuntimeError):
+        await profiler.run(0.1)
+    report = await task
+    assert report.path is None
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("channel_id, administrator", [(123, False), (456, True)])
+async def test_profile_command_is_restricted(channel_id, administrator):
+    bot = MockDiscordBot(MockLLM())
+    bot.test_channels = {123}
+    interaction = MockInteraction(channel_id, administrator=administrator)
+
+    await bot.on_profile_command(interaction, 1)
+    assert interaction.replies == ["This command is restricted to admins in test channels."]
+    assert not interaction.deferred
+
+@pytest.mark.asyncio
+async def test_profile_command_replies_with_summary(tmp_path):
+    bot = MockDiscordBot(MockLLM())
+    bot.test_channels = {123}
+    bot.config.profile_dir = str(tmp_path)
+    bot.config.profile_max_seconds = 1
+    interaction = MockInteraction(123, administrator=True)
+
+    await bot.on_profile_command(interaction, 30)
+    assert interaction.deferred
+    reply, = interaction.replies
+    assert reply.startswith("```\nProfiled 1s")
+    assert "Loop lag:" in reply
+
+@pytest.mark.asyncio
+async def test_loop_monitor_logs_blocking_stack(capsys):
+    monitor = LoopLagMonitor(interval=0.01, threshold=0.1, report_interval=0)
+    monitor.start()
+    await asyncio.sleep(0.05)
+    busy_wait(0.3)
+    await asyncio.sleep(0.05)
+    monitor.stop()
+
+    assert monitor.stalls == 1
+    assert any("busy_wait" in name for name in monitor.blockers)
+    assert monitor.stats()["max_ms"] >= 250
+    out = capsys.readouterr().out
+    assert "Event loop blocked" in out and "busy_wait(0.3)" in out
+
+@pytest.mark.asyncio
+async def test_loop_monitor_reports_lag_percentiles(capsys):
+    monitor = LoopLagMonitor(interval=0.01, threshold=1, report_interval=0.1)
+    monitor.start()
+    await asyncio.sleep(0.25)
+    monitor.stop()
+
+    stats = monitor.stats()
+    assert monitor.stalls == 0
+    assert 0 <= stats["p50_ms"] <= stats["p99_ms"] <= stats["max_ms"]
+    assert "[LOOP] lag p50" in capsys.readouterr().out
+
+def test_loop_monitor_window_is_bounded_without_reports():
+    # Without reports nothing clears the window: it keeps the last minute of samples.
+    assert LoopLagMonitor(interval=0.1, report_interval=0).window.maxlen == 600
+    assert LoopLagMonitor(interval=0.1, report_interval=300).window.maxlen == 3000
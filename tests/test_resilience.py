@@ -0,0 +1,166 @@
+import sys
+import json
+import asyncio
+import pytest
+from types import SimpleNamespace
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+from Config import Config
+from Mocks import MockOpenAI
+from GptWrapper import BisbalWrapper
+from Resilience import CircuitBreaker, CircuitOpenError, hedged
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def completion(message):
+    content = json.dumps({"response": message, "context": None})
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+@pytest.fixture
+def llm():
+    config = Config()
+    config.response_use_llm = True
+    config.llm_retry_base_delay = 0
+    wrapper = BisbalWrapper(config)
+    calls = []
+
+    def use(create):
+        async def fake_create(**kwargs):
+            calls.append(kwargs)
+            return await create(len(calls))
+
+        wrapper.backend.endpoints[0].client = MockOpenAI(fake_create)
+
+    return SimpleNamespace(wrapper=wrapper, config=config, calls=calls, use=use)
+
+
+def test_circuit_opens_after_threshold_and_probes_after_cooldown():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=10, clock=clock)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    clock.now = 11
+    assert breaker.allow()      # probe
+    assert not breaker.allow()  # only one probe at a time
+    breaker.record_success()
+    assert breaker.allow()
+    assert not breaker.degraded
+
+@pytest.mark.asyncio
+async def test_hedged_returns_fastest_request():
+    async def request(index):
+        await asyncio.sleep(1 if index == 0 else 0.01)
+        return index
+
+    assert await hedged(request, delay=0.02) == 1
+
+@pytest.mark.asyncio
+async def test_transient_errors_are_retried(llm):
+    async def create(call):
+        if call == 1:
+            raise TimeoutError()
+        return completion("hola")
+
+    llm.use(create)
+    response = await llm.wrapper.get_response("{}", trigger="mention")
+    assert response.message == "hola"
+    assert len(llm.calls) == 2
+
+@pytest.mark.asyncio
+async def test_deadline_cancels_slow_request(llm):
+    async def create(call):
+        await asyncio.sleep(1)
+        return completion("tarde")
+
+    llm.use(create)
+    llm.config.llm_deadlines = {"join": 0.05}
+    with pytest.raises(TimeoutError):
+        await llm.wrapper.get_response("{}", trigger="join")
+
+@pytest.mark.asyncio
+async def test_open_circuit_fails_fast_and_sheds_low_priority(llm):
+    async def create(call):
+        raise TimeoutError()
+
+    llm.use(create)
+    llm.config.llm_max_retries = 0
+    llm.config.circuit_failure_threshold = 1
+    llm.wrapper.circuit_breaker = CircuitBreaker(1, cooldown=60)
+
+    with pytest.raises(TimeoutError):
+        await llm.wrapper.get_response("{}", trigger="mention")
+    with pytest.raises(CircuitOpenError):
+        await llm.wrapper.get_response("{}", trigger="mention")
+    with pytest.raises(CircuitOpenError):
+        await llm.wrapper.get_response("{}", trigger="join")
+    assert len(llm.calls) == 1
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("error", [ValueError("unparseable"), asyncio.CancelledError()])
+async def test_probe_ending_without_verdict_lets_the_next_call_probe(llm, error):
+    async def create(call):
+        raise error
+
+    llm.use(create)
+    clock = FakeClock()
+    breaker = llm.wrapper.circuit_breaker = CircuitBreaker(1, cooldown=10, clock=clock)
+    breaker.record_failure()
+    clock.now = 11
+
+    with pytest.raises(type(error)):
+        await llm.wrapper.get_response("{}", trigger="mention")
+    # The probe is over, so another call may probe the backend
+    assert breaker.allow()
+
+@pytest.mark.asyncio
+async def test_losing_hedged_request_does_not_post(llm):
+    class SlowStream:
+        """ Streams a whole envelope in one chunk after a delay. """
+        def __init__(self, delay, message):
+            self.delay, self.message, self.sent = delay, message, False
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            if self.sent:
+                raise StopAsyncIteration
+            await asyncio.sleep(self.delay)
+            self.sent = True
+            content = json.dumps({"response": self.message, "context": None})
+            return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+        async def close(self):
+            pass
+
+    async def create(call):
+        # The hedged request posts first; the original one then finds the reply taken.
+        return SlowStream(0.01 if call == 2 else 0.05, f"respuesta {call}")
+
+    llm.use(create)
+    llm.config.stream_response = True
+    llm.config.hedge_triggers = ["mention"]
+    llm.config.hedge_delay = 0.02
+    posted = []
+
+    async def on_message(message):
+        posted.append(message)
+        await asyncio.sleep(0.1)
+
+    response = await llm.wrapper.get_response("{}", trigger="mention", on_message=on_message)
+    assert posted == ["respuesta 2"]
+    assert response.message == "respuesta 2"
+    assert llm.wrapper.circuit_breaker.state == CircuitBreaker.CLOSED
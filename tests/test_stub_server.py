@@ -0,0 +1,103 @@
+import sys
+import json
+import pytest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+import openai
+from Config import Config
+from GptWrapper import BisbalWrapper
+from StubServer import StubLLMServer
+
+
+async def make_llm(server: StubLLMServer, **settings) -> BisbalWrapper:
+    url = await server.start()
+    config = Config()
+    config.response_use_llm = True
+    config.llm_retry_base_delay = 0.01
+    config.llm_endpoints = [{"name": "stub", "model": "stub", "base_url": url, "api_key_env": "BISBOT_STUB_KEY",
+                             "json_mode": True, "stream_usage": True}]
+    for key, value in settings.items():
+        setattr(config, key, value)
+    return BisbalWrapper(config)
+
+
+@pytest.mark.asyncio
+async def test_completion_reports_usage():
+    server = StubLLMServer(latency=0.01, replies=[{"response": "hola", "context": "le gusta el flamenco"}])
+    llm = await make_llm(server, stream_response=False)
+    try:
+        response = await llm.get_response(json.dumps({"trigger": "mention", "message": "hola"}), trigger="mention")
+    finally:
+        await server.stop()
+
+    assert response.message == "hola"
+    assert response.memory_proposal == "le gusta el flamenco"
+    llm.ledger.flush()
+    prompt, completion = llm.ledger._db.execute("SELECT prompt_tokens, completion_tokens FROM calls").fetchone()
+    assert prompt > 0 and completion > 0
+
+@pytest.mark.asyncio
+async def test_streamed_reply_is_posted_early():
+    server = StubLLMServer(latency=0.01, chunk_size=4, replies=['{"response": "ya estoy", "context": "x"}'])
+    llm = await make_llm(server, stream_response=True)
+    posted = []
+
+    async def post(message):
+        posted.append(message)
+
+    try:
+        response = await llm.get_response("{}", trigger="mention", on_message=post)
+    finally:
+        await server.stop()
+
+    assert posted == ["ya estoy"]
+    assert response.delivered
+    assert response.usage[2] == len('{"response": "ya estoy", "context": "x"}') // 4 + 1
+
+@pytest.mark.asyncio
+async def test_rate_limit_is_retried():
+    server = StubLLMServer(latency=0.01, retry_after=0, replies=[
+        {"content": "", "status": 429},
+        {"response": "ahora sí", "context": None},
+    ])
+    llm = await make_llm(server, stream_response=False, llm_max_retries=2)
+    try:
+        response = await llm.get_response("{}", trigger="mention")
+    finally:
+        await server.stop()
+
+    assert response.message == "ahora sí"
+    assert server.stats["429"] == 1
+    assert server.stats["requests"] == 2
+
+@pytest.mark.asyncio
+async def test_server_errors_surface_after_retries():
+    server = StubLLMServer(latency=0.0, rate_500=1.0)
+    llm = await make_llm(server, stream_response=False, llm_max_retries=1)
+    try:
+        with pytest.raises(openai.InternalServerError):
+            await llm.get_response("{}", trigger="mention")
+    finally:
+        await server.stop()
+    assert server.stats["500"] == 2
+
+@pytest.mark.asyncio
+async def test_generated_replies_follow_the_request_shape():
+    server = StubLLMServer(latency=0.0, null_rate=0.0)
+    llm = await make_llm(server, stream_response=False)
+    try:
+        responses = await llm.get_batch_response({"1": {"history": "a"}, "2": {"history": "b"}})
+        summary = await llm.summarize(None, ["Ana: hola", "Rex: ey"], max_tokens=50)
+        llm.context = llm.config.initial_context + "".join(f"\nAna tiene {i} gatos" for i in range(200))
+        compacted = await llm.compact_context()
+    finally:
+        await server.stop()
+
+    assert set(responses) == {"1", "2"}
+    assert all(r.message for r in responses.values())
+    assert summary == "Resumen de 2 mensajes"
+    assert compacted
+    assert llm.context.endswith("Ana tiene 199 gatos")
+    assert len(llm.context) - len(llm.config.initial_context) <= llm.config.context_compact_length
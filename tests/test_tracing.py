@@ -0,0 +1,126 @@
+import sys
+import json
+import pytest
+from types import SimpleNamespace
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+from Config import Config
+from Mocks import MockOpenAI, MockChannel, MockMessage, MockAuthor
+from Helpers import DiscordMessageHandler
+from GptWrapper import BisbalWrapper
+from Dispatcher import OutboundDispatcher
+import Tracing
+from Tracing import Tracer
+
+
+def read_spans(path: Path) -> list[dict]:
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_children_share_trace_and_point_to_parent(tmp_path):
+    tracer = Tracer(str(tmp_path / "trace.jsonl"))
+    with tracer.span("on_message", channel=1) as root:
+        with tracer.span("llm.request") as child:
+            child.set("prompt_tokens", 12)
+    tracer.flush()
+
+    child_span, root_span = read_spans(tmp_path / "trace.jsonl")
+    assert root_span["name"] == "on_message"
+    assert root_span["parentSpanId"] is None
+    assert child_span["parentSpanId"] == root.span_id
+    assert child_span["traceId"] == root_span["traceId"]
+    assert child_span["attributes"] == {"prompt_tokens": 12}
+
+def test_errors_are_recorded(tmp_path):
+    tracer = Tracer(str(tmp_path / "trace.jsonl"))
+    with pytest.raises(ValueError):
+        with tracer.span("llm.parse"):
+            raise ValueError("bad json")
+    tracer.flush()
+
+    span, = read_spans(tmp_path / "trace.jsonl")
+    assert span["status"] == "error"
+    assert "bad json" in span["attributes"]["error"]
+
+def test_sampling_is_decided_per_trace(tmp_path):
+    tracer = Tracer(str(tmp_path / "trace.jsonl"), sample_rate=0.0)
+    with tracer.span("on_message"):
+        with tracer.span("llm.request"):
+            pass
+    tracer.flush()
+    assert not (tmp_path / "trace.jsonl").exists()
+
+def test_disabled_tracer_is_a_noop(tmp_path):
+    tracer = Tracer()
+    with tracer.span("on_message") as span:
+        span.set("trigger", "mention")
+        assert tracer.current() is None
+
+def test_spans_are_written_in_batches(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    tracer = Tracer(str(path), flush_size=3)
+    for _ in range(2):
+        with tracer.span("discord.send"):
+            pass
+    assert not path.exists()
+
+    with tracer.span("discord.send"):
+        pass
+    assert len(read_spans(path)) == 3
+
+    with tracer.span("discord.send"):
+        pass
+    tracer.flush()
+    assert len(read_spans(path)) == 4
+    assert tracer.pending == []
+
+def test_file_is_rotated(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    tracer = Tracer(str(path), max_bytes=600, backups=2)
+    for _ in range(10):
+        with tracer.span("discord.send"):
+            pass
+    tracer.flush()
+
+    assert path.exists()
+    assert (tmp_path / "trace.jsonl.1").exists()
+    assert (tmp_path / "trace.jsonl.2").exists()
+    assert not (tmp_path / "trace.jsonl.3").exists()
+    assert path.stat().st_size <= 600
+
+@pytest.mark.asyncio
+async def test_reply_is_traced_from_handler_to_send(tmp_path, monkeypatch):
+    path = tmp_path / "trace.jsonl"
+    monkeypatch.setattr(Tracing.tracer, "path", str(path))
+    monkeypatch.setattr(Tracing.tracer, "sample_rate", 1.0)
+
+    config = Config()
+    config.response_use_llm = True
+    config.stream_response = False
+    wrapper = BisbalWrapper(config)
+
+    async def create(**kwargs):
+        content = json.dumps({"response": "hola", "context": None})
+        usage = SimpleNamespace(prompt_tokens=100, completion_tokens=8)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+    wrapper.backend.endpoints[0].client = MockOpenAI(create)
+    dispatcher = OutboundDispatcher()
+    handler = DiscordMessageHandler(wrapper, dispatcher=dispatcher)
+    channel = MockChannel()
+    msg = MockMessage("hola", MockAuthor("Ana"), channel)
+
+    with Tracing.tracer.span("on_message", channel=channel.id):
+        await handler.handle(msg, trigger="mention", history="Ana: hola")
+    await dispatcher.drain()
+    Tracing.tracer.flush()
+
+    spans = {span["name"]: span for span in read_spans(path)}
+    assert channel.sent == ["hola"]
+    assert {"on_message", "handler.respond", "prompt.serialize", "llm.get_response",
+            "llm.request", "llm.parse", "discord.send"} <= spans.keys()
+    assert len({span["traceId"] for span in spans.values()}) == 1
+    assert spans["llm.request"]["attributes"]["prompt_tokens"] == 100
+    assert spans["discord.send"]["parentSpanId"] == spans["handler.respond"]["spanId"]